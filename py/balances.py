@@ -0,0 +1,119 @@
+from argparse import ArgumentParser
+from collections import defaultdict
+from decimal import Decimal
+
+def posting_amounts(trans):
+    """
+    Yields (account, commodity, quantity) for the postings of trans.  Like
+    ledger, a posting without an amount balances all the others, where a
+    posting with a unit price costs quantity * unit price dollars.
+    """
+    elided = None
+    # commodity -> what the postings with amounts add up to
+    costs = defaultdict(Decimal)
+    for p in trans.postings:
+        if p.quantity is None:
+            if elided is not None:
+                raise Exception('more than one posting without an amount:\n{}'.format(trans))
+            elided = p
+            continue
+        yield p.account, p.commodity, p.quantity
+        if p.unit_price:
+            costs['$'] += p.quantity * p.unit_price
+        else:
+            costs[p.commodity] += p.quantity
+
+    if elided is not None:
+        for commodity, cost in costs.items():
+            if cost:
+                yield elided.account, commodity, -cost
+
+def format_amount(quantity, commodity):
+    if commodity == '$':
+        return '${}'.format(quantity)
+    return '{} {}'.format(quantity, commodity)
+
+class BalanceEngine(object):
+    """
+    Per-account, per-commodity balances of a list of transactions, rolled
+    up so that every account also includes everything posted to the
+    accounts below it in the ':' hierarchy.  The rollup is built on first
+    use and from then on kept current by add_transaction.
+    """
+
+    def __init__(self, transactions=()):
+        # account -> commodity -> total of postings made to exactly that account
+        self.own = defaultdict(lambda: defaultdict(Decimal))
+        # the same with every parent account included; see rollup
+        self.totals = None
+        # account -> itself and its parents, nearest first
+        self.lineage = {}
+        for trans in transactions:
+            self.add_transaction(trans)
+
+    def parents(self, account):
+        lineage = self.lineage.get(account)
+        if lineage is None:
+            parts = account.split(':')
+            lineage = self.lineage[account] = tuple(
+                ':'.join(parts[:i]) for i in range(len(parts), 0, -1)
+            )
+        return lineage
+
+    def add_transaction(self, trans):
+        for account, commodity, quantity in posting_amounts(trans):
+            self.own[account][commodity] += quantity
+            if self.totals is not None:
+                for name in self.parents(account):
+                    self.totals[name][commodity] += quantity
+
+    def rollup(self):
+        "account -> commodity -> balance including all sub-accounts"
+        if self.totals is None:
+            self.totals = defaultdict(lambda: defaultdict(Decimal))
+            for account, balance in self.own.items():
+                for name in self.parents(account):
+                    totals = self.totals[name]
+                    for commodity, quantity in balance.items():
+                        totals[commodity] += quantity
+        return self.totals
+
+    def balance(self, account, rollup=True):
+        "commodity -> nonzero balance of account"
+        balances = self.rollup() if rollup else self.own
+        balance = balances.get(account, {})
+        return dict((c, q) for c, q in balance.items() if q)
+
+    def accounts(self, prefixes=None):
+        "Sorted accounts and parent accounts starting with any of prefixes"
+        return sorted(
+            account for account in self.rollup()
+            if not prefixes or any(account.startswith(p) for p in prefixes)
+        )
+
+    def report(self, prefixes=None):
+        "Lines like ledger's flat balance report: amount then account"
+        lines = []
+        for account in self.accounts(prefixes):
+            balance = self.balance(account)
+            for commodity in sorted(balance):
+                lines.append('{:>20}  {}'.format(
+                    format_amount(balance[commodity], commodity), account
+                ))
+        return lines
+
+def main():
+    arg_parser = ArgumentParser(description='Show account balances of a ledger journal.')
+    arg_parser.add_argument('-j', '--journal', required=True)
+    arg_parser.add_argument('accounts', nargs='*', metavar='ACCOUNT',
+        help='only show accounts starting with these')
+    args = arg_parser.parse_args()
+
+    # import_model builds BalanceEngines itself
+    from import_model import Journal
+    journal = Journal.load(args.journal)
+    for line in journal.balances().report(args.accounts):
+        print(line)
+
+if __name__ == "__main__":
+    main()
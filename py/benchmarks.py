@@ -0,0 +1,818 @@
+from argparse import ArgumentParser
+from collections import defaultdict
+from contextlib import redirect_stdout
+from datetime import datetime, timedelta
+from decimal import Decimal
+import gc
+from io import StringIO
+import json
+import os
+import platform
+import random
+import re
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import dates
+import input_parsers
+from import_model import (Journal, Transaction, Posting, AccountRegEx, Price,
+    Commodity)
+from classifier import RegexClassifier
+from fuzzy_index import DescriptionIndex
+from lazy_journal import LazyJournal
+from ledger_import import LedgerImportCmd
+from balances import posting_amounts
+from cube import AggregateCube, month_number
+from prices import PriceIndex, month_ends, under
+from transaction_store import TransactionStore
+
+expense_accounts = [
+    'Expenses:Groceries',
+    'Expenses:Utilities',
+    'Expenses:Dining',
+    'Expenses:Auto:Gas',
+    'Expenses:Household',
+    'Expenses:Medical',
+]
+asset_accounts = [
+    'Assets:NECU:Checking',
+    'Assets:Ally Bank:Money Market',
+    'Liabilities:Credit Cards:U.S. Bank',
+]
+fund_account = 'Assets:Vanguard:CTC Roth IRA'
+fund_commodities = ['VFIAX', 'VBTLX', 'VTIAX', 'VTIVX']
+descriptions = [
+    'Bantam Market {} Bantam Rd B Bantam',
+    'FairPoint Communi Bill Pmt W/D',
+    'NFI*WWW.NETFLIX.COM/CC NETFLIX.COM CA',
+    'Shell Oil {}',
+    'Transfer to Savings',
+    'Check W/D',
+]
+transfer_amounts = ['-10.00', '-50.00', '-100.00']
+regex_prefixes = ['Bantam', 'FairPoint', 'NFI', 'Shell', 'Transfer', 'Check']
+
+def generate_journal(fn, postings, seed=0, price_weeks=1, rules=0):
+    """
+    Writes a deterministic journal with roughly the given number of
+    postings, price_weeks weekly prices per commodity and rules regexes on
+    top of one per description
+    """
+    rand = random.Random(seed)
+    date = datetime(2000, 1, 1)
+    with open(fn, 'w') as f:
+        for account in sorted(set(expense_accounts + asset_accounts + [fund_account])):
+            f.write('account {}\n'.format(account))
+        f.write('\n')
+        for commodity in fund_commodities:
+            f.write('commodity {}\n'.format(commodity))
+        f.write('\n')
+        for week in range(price_weeks):
+            for commodity in fund_commodities:
+                f.write('P {} 00:00:00 {} ${}\n'.format(
+                    (date + timedelta(weeks=week)).strftime('%Y/%m/%d'),
+                    commodity, rand.randint(10, 300)
+                ))
+        f.write('\n')
+        for prefix, account in zip(regex_prefixes, expense_accounts):
+            f.write('; /^{}/ {}\n'.format(prefix, account))
+        for rule in generate_rules(rules, seed):
+            f.write('{}\n'.format(rule))
+        f.write('\n')
+
+        written = 0
+        while written < postings:
+            if rand.random() < 0.02:
+                date += timedelta(days=1)
+            if rand.random() < 0.1:
+                commodity = rand.choice(fund_commodities)
+                f.write('{} Buy {} with cash from Contribution\n'.format(
+                    date.strftime('%Y/%m/%d'), commodity
+                ))
+                f.write('  {}    {} {} @ ${}\n'.format(
+                    fund_account,
+                    Decimal(rand.randint(1, 100000)) / 1000,
+                    commodity,
+                    Decimal(rand.randint(1000, 30000)) / 100
+                ))
+                f.write('  {}\n\n'.format(fund_account))
+            elif rand.random() < 0.1:
+                # the same few transfers between the same accounts, over and
+                # over, which is what makes mirror detection slow
+                f.write('{} Transfer to Savings\n'.format(date.strftime('%Y/%m/%d')))
+                f.write('  {}    ${}\n'.format(
+                    asset_accounts[0], rand.choice(transfer_amounts)
+                ))
+                f.write('  {}\n\n'.format(asset_accounts[1]))
+            else:
+                desc = rand.choice(descriptions).format(rand.randint(1, 999))
+                f.write('{} {}\n'.format(date.strftime('%Y/%m/%d'), desc))
+                f.write('  {}    ${}\n'.format(
+                    rand.choice(asset_accounts),
+                    Decimal(rand.randint(-50000, 50000)) / 100
+                ))
+                f.write('  {}\n\n'.format(rand.choice(expense_accounts)))
+            written += 2
+
+def legacy_parse_file(fn):
+    "The regex-per-line parser that Journal.parse_file replaced, for comparison"
+    transactions = []
+    by_quantity = defaultdict(list)
+    accounts = set()
+    description_map = defaultdict(list)
+    regexes = []
+    prices = []
+    commodities = []
+
+    trans = None
+
+    account_re = re.compile('^account')
+    date_desc_re = re.compile('^\d')
+    posting_re = re.compile('^\s+\S+')
+    price_re = re.compile('^P\s.+')
+    commodity_re = re.compile('^commodity\s.+')
+    regex_comment_re = re.compile('^\s*;.*/.+/')
+    comment_re = re.compile('^\s*;')
+
+    with open(fn) as f:
+        for line in f.readlines():
+            line = line.rstrip()
+            if re.match(account_re, line):
+                accounts.add(line.split(' ', 1)[1].strip())
+            elif re.match(date_desc_re, line):
+                trans = Transaction()
+                parts = line.split(' ', 1)
+                trans.date = datetime.strptime(parts[0], '%Y/%m/%d')
+                trans.desc = parts[1]
+            elif re.match(regex_comment_re, line):
+                regexes.append(AccountRegEx.parse(line))
+            elif re.match(price_re, line):
+                parts = line.split()
+                date = datetime.strptime(parts[1], '%Y/%m/%d')
+                commodity = parts[3]
+                value = Decimal(parts[4].lstrip('$'))
+                prices.append(Price(date, commodity, value))
+            elif re.match(commodity_re, line):
+                parts = line.split()
+                name = parts[1]
+                commodities.append(Commodity(name))
+            elif re.match(comment_re, line):
+                pass # ignore
+            elif re.match(posting_re, line):
+                posting = Posting()
+                parts = [p.strip(' $') for p in line.split()]
+
+                if '@' in line:
+                    posting.account = ' '.join(parts[:-4])
+                    posting.quantity = Decimal(parts[-4])
+                    posting.commodity = parts[-3]
+                    posting.unit_price = Decimal(parts[-1])
+                elif '$' in line:
+                    posting.account = ' '.join(parts[:-1])
+                    posting.quantity = Decimal(parts[-1])
+                elif '  ' in line.lstrip():
+                    posting.account = ' '.join(parts[:-2])
+                    posting.quantity = Decimal(parts[-2])
+                    posting.commodity = parts[-1]
+                else:
+                    posting.account = ' '.join(parts)
+
+                trans.postings.append(posting)
+            elif not line.strip():
+                if trans:
+                    transactions.append(trans)
+                    by_quantity[trans.total].append(trans)
+                trans = None
+            else:
+                raise Exception('unexpected line: %r' % line)
+
+    for trans in transactions:
+        if trans.desc not in Journal.ignore_descs:
+            description_map[trans.desc] += [p.account for p in trans.postings]
+
+    return Journal(transactions, by_quantity, accounts, description_map, regexes,
+        prices, commodities)
+
+def legacy_is_mirror_trans(journal, trans):
+    "The by_quantity scan that Journal.is_mirror_trans replaced"
+    matching_quantity = journal.by_quantity.get(-trans.total, [])
+
+    for mq in matching_quantity:
+        threshold = timedelta(days=14)
+        mq_accounts = [p.account for p in mq.postings]
+        trans_accounts = [p.account for p in trans.postings]
+
+        if len(set(mq_accounts)) > 1 and \
+            mq.date + threshold > trans.date and \
+            mq_accounts == trans_accounts[::-1]:
+            return True
+
+    return False
+
+def mirror_candidates(journal, count, seed=0):
+    "Incoming transfers as an import from the savings side would see them"
+    rand = random.Random(seed)
+    last = journal.transactions[-1].date
+    return [
+        Transaction(last - timedelta(days=rand.randint(0, 60)), 'Transfer from Checking', [
+            Posting(asset_accounts[1], -Decimal(rand.choice(transfer_amounts))),
+            Posting(asset_accounts[0]),
+        ])
+        for i in range(count)
+    ]
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    return result, time.perf_counter() - start
+
+def bench_parse_file(postings):
+    with tempfile.TemporaryDirectory() as tmp:
+        fn = os.path.join(tmp, 'accounts.dat')
+        generate_journal(fn, postings)
+
+        legacy, legacy_secs = timed(legacy_parse_file, fn)
+        journal, secs = timed(Journal.parse_file, fn)
+
+        if str(journal) != str(legacy) or \
+            journal.by_quantity.keys() != legacy.by_quantity.keys() or \
+            journal.description_map.entries.keys() != legacy.description_map.keys():
+            raise Exception('parsers disagree on {}'.format(fn))
+
+        print('parse_file, {} postings: legacy {:.2f}s, tokenizer {:.2f}s ({:.1f}x)'.format(
+            postings, legacy_secs, secs, legacy_secs / secs
+        ))
+
+def bench_load_cache(postings):
+    with tempfile.TemporaryDirectory() as tmp:
+        fn = os.path.join(tmp, 'accounts.dat')
+        generate_journal(fn, postings)
+
+        journal, parse_secs = timed(Journal.load, fn)
+        cached, cached_secs = timed(Journal.load, fn)
+
+        if str(journal) != str(cached):
+            raise Exception('cached journal differs from {}'.format(fn))
+
+        print('load, {} postings: parse {:.2f}s, cache {:.2f}s ({:.1f}x)'.format(
+            postings, parse_secs, cached_secs, parse_secs / cached_secs
+        ))
+
+def bench_write(postings):
+    with tempfile.TemporaryDirectory() as tmp:
+        fn = os.path.join(tmp, 'accounts.dat')
+        generate_journal(fn, postings)
+        journal = Journal.parse_file(fn)
+        # a typical import: a handful of new transactions on top of history
+        journal.transactions.extend(journal.transactions[-20:])
+
+        def join_write():
+            with open(fn, 'w') as f:
+                f.write('\n\n'.join([
+                    '\n'.join('account '+ a for a in sorted(journal.accounts)),
+                    '\n'.join(str(commodity) for commodity in journal.commodities),
+                    '\n'.join(str(price) for price in journal.prices),
+                    '\n'.join(str(regex) for regex in journal.regexes),
+                    '\n'.join(str(t) for t in sorted(journal.transactions, key=lambda t: t.date))
+                ]) + '\n')
+
+        def stream_write():
+            with open(fn, 'w') as f:
+                journal.write_to(f)
+
+        for name, write in [('join', join_write), ('write_to', stream_write)]:
+            tracemalloc.start()
+            _, secs = timed(write)
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            print('write, {} postings, {}: {:.2f}s, peak {:.1f} MB'.format(
+                postings, name, secs, peak / 2**20
+            ))
+
+def bench_memory(postings):
+    with tempfile.TemporaryDirectory() as tmp:
+        fn = os.path.join(tmp, 'accounts.dat')
+        generate_journal(fn, postings)
+
+        gc.collect()
+        tracemalloc.start()
+        journal = Journal.parse_file(fn)
+        objects_size, _ = tracemalloc.get_traced_memory()
+
+        store = TransactionStore.from_transactions(journal.transactions)
+        del journal
+        gc.collect()
+        store_size, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        print('memory, {} postings: Journal {:.1f} MB, TransactionStore {:.1f} MB ({:.0f}%)'.format(
+            postings, objects_size / 2**20, store_size / 2**20,
+            100.0 * store_size / objects_size
+        ))
+
+def bench_mirror(postings):
+    "Times is_mirror_trans at several journal sizes up to postings"
+    size = max(postings // 100, 1000)
+    while True:
+        with tempfile.TemporaryDirectory() as tmp:
+            fn = os.path.join(tmp, 'accounts.dat')
+            generate_journal(fn, size)
+            journal = Journal.parse_file(fn)
+        candidates = mirror_candidates(journal, 1000)
+
+        def legacy():
+            return [legacy_is_mirror_trans(journal, trans) for trans in candidates]
+
+        def indexed():
+            return [journal.is_mirror_trans(trans) for trans in candidates]
+
+        journal.build_indexes()
+        expected, legacy_secs = timed(legacy)
+        result, secs = timed(indexed)
+        if result != expected:
+            raise Exception('is_mirror_trans disagrees at {} postings'.format(size))
+
+        print('is_mirror_trans x{}, {} postings: scan {:.4f}s, index {:.4f}s ({:.0f}x)'.format(
+            len(candidates), size, legacy_secs, secs, legacy_secs / secs
+        ))
+        if size >= postings:
+            break
+        size = min(size * 10, postings)
+
+def generate_rules(count, seed=0):
+    rand = random.Random(seed)
+    return [
+        AccountRegEx(rand.choice(expense_accounts), '^{} {}'.format(
+            rand.choice(regex_prefixes), i
+        ))
+        for i in range(count)
+    ]
+
+def bench_classify(postings):
+    "Matches every description in the journal against a few hundred rules"
+    with tempfile.TemporaryDirectory() as tmp:
+        fn = os.path.join(tmp, 'accounts.dat')
+        generate_journal(fn, postings)
+        journal = Journal.parse_file(fn)
+    rules = generate_rules(500)
+    descs = [trans.desc for trans in journal.transactions[:10000]]
+
+    def legacy():
+        return [
+            ([r.account for r in rules if r.compiled.match(desc)] or [None])[-1]
+            for desc in descs
+        ]
+
+    expected, legacy_secs = timed(legacy)
+    classifier, compile_secs = timed(RegexClassifier, rules)
+    result, secs = timed(classifier.classify_many, descs)
+    if result != expected:
+        raise Exception('classifier disagrees with rule by rule matching')
+
+    print('classify {} descriptions, {} rules: per rule {:.2f}s, compiled {:.2f}s (+{:.2f}s to compile)'.format(
+        len(descs), len(rules), legacy_secs, secs, compile_secs
+    ))
+
+def generate_descriptions(count, seed=0, merchant_seed=0):
+    "Merchant-like descriptions with store numbers and reference codes"
+    rand = random.Random(merchant_seed)
+    letters = 'abcdefghijklmnopqrstuvwxyz'
+    words = [
+        ''.join(rand.choice(letters) for j in range(rand.randint(3, 9)))
+        for i in range(5000)
+    ]
+    merchants = [
+        ' '.join(rand.choice(words) for i in range(rand.randint(1, 3))).title()
+        for i in range(count // 10)
+    ]
+    rand = random.Random(seed)
+    return [
+        '{} {} {}'.format(rand.choice(merchants), rand.randint(1, 9999),
+            rand.choice(['CT', 'NY', 'MA', 'REF#{}'.format(rand.randint(1, 99999))]))
+        for i in range(count)
+    ]
+
+def bench_fuzzy(postings):
+    "Finds similar past descriptions in a history of postings / 2 transactions"
+    descs = generate_descriptions(postings // 2)
+    index, build_secs = timed(DescriptionIndex, descs)
+    # new transactions at the same merchants
+    queries = generate_descriptions(postings // 2, seed=1)[:1000]
+
+    def query():
+        return [index.similar(desc) for desc in queries]
+
+    _, secs = timed(query)
+    print('similar descriptions, {} past ({} distinct): build {:.2f}s, {:.3f}ms per query'.format(
+        len(descs), len(index.descs), build_secs, 1000 * secs / len(queries)
+    ))
+
+def money(rand, low, high):
+    return Decimal(rand.randint(low * 100, high * 100)) / 100
+
+def shares(rand):
+    return Decimal(rand.randint(1000, 99999)) / 1000
+
+def export_desc(rand):
+    return rand.choice(descriptions).format(rand.randint(1, 999))
+
+# parser class -> (header lines, function of (rand, date) returning one row)
+export_formats = {
+    input_parsers.NecuParser: (
+        ['Account Designator,Posted Date,Serial Number,Description,Amount,CR/DR'],
+        lambda rand, date: '0056531888 S02,{},0,"{}",{:012},{}'.format(
+            date.strftime('%m/%d/%y'), export_desc(rand), money(rand, 1, 900),
+            rand.choice(['DR', 'CR'])
+        ),
+    ),
+    input_parsers.UsBankParser: (
+        ['Date,Transaction,Name,Memo,Amount'],
+        lambda rand, date: '{},DEBIT,"{}",memo,{}00'.format(
+            date.strftime('%m/%d/%Y'), export_desc(rand), -money(rand, 1, 900)
+        ),
+    ),
+    input_parsers.AllyParser: (
+        ['Date,Time,Amount,Type,Description'],
+        lambda rand, date: '{},12:00:00,{},Withdrawal,{}'.format(
+            date.strftime('%Y-%m-%d'), -money(rand, 1, 900), export_desc(rand)
+        ),
+    ),
+    input_parsers.WellsFargoParser: (
+        ['Date,Fund,Type,Description,Shares,Price'],
+        lambda rand, date: '{},VANGUARD 500 INDEX ADMIRAL SER,{},x,{},${}'.format(
+            date.strftime('%Y%m%d'), rand.choice(['Contributions', 'Earnings']),
+            shares(rand), money(rand, 100, 300)
+        ),
+    ),
+    input_parsers.BpasParser: (
+        [],
+        lambda rand, date: '{}  VANGUARD 500 INDEX ADMIRAL SER  {}  N/A EMPLOYEE PRETAX {}    ${}   ${}'.format(
+            date.strftime('%m/%d/%Y'), rand.choice(['Contribution', 'Dividends']),
+            shares(rand), money(rand, 100, 300), money(rand, 100, 900)
+        ),
+    ),
+    input_parsers.TiaaCrefParser: (
+        ['Date,Account,Activity,Fund,Unit Price,Units,Amount,Type'],
+        lambda rand, date: '{},380737G1 GR1001 102136,Buy,CREF Equity Index R3,{},{},{},{}'.format(
+            date.strftime('%m/%d/%Y'), money(rand, 100, 300), shares(rand),
+            money(rand, 100, 900), rand.choice(['Contribution', 'Dividends'])
+        ),
+    ),
+    input_parsers.VanguardParser: (
+        ['Account Number,Trade Date,Settlement Date,Transaction Type,'
+            'Transaction Description,Investment Name,Symbol,Shares,Share Price,'
+            'Principal Amount,Commission Fees,Net Amount,Accrued Interest,Account Type,'],
+        lambda rand, date: '62341669,{0},{0},Buy,Buy,Vanguard 500 Index Admiral,VFIAX,'
+            '{1},{2},-100.0,0.0,-100.0,0.0,CASH,'.format(
+            date.strftime('%m/%d/%Y'), shares(rand), money(rand, 100, 400)
+        ),
+    ),
+    input_parsers.CtcIraVanguardParser: (
+        ['Account Number,Investment Name,Symbol,Shares,Share Price,Total Value,'] +
+            ['34549708,VANGUARD TARGET RETIREMENT 2045 INVESTOR CL,VTIVX,1.0,18.83,18.83,'] +
+            [''] * 5,
+        lambda rand, date: '34549708,{0},{0},Buy,Buy,VANGUARD TARGET RETIREMENT 2045 INVESTOR CL,'
+            'VTIVX,{1},18.83,-{2},0.0,-{2},0.0,Cash,'.format(
+            date.strftime('%m/%d/%Y'), shares(rand), money(rand, 100, 900)
+        ),
+    ),
+    input_parsers.FidelityParser: (
+        ['Date,Investment,Transaction Type,Amount,Shares/Unit'],
+        lambda rand, date: '{},VANG TARGET RET 2045,CONTRIBUTION,"{}","{}"'.format(
+            date.strftime('%m/%d/%Y'), money(rand, 100, 900), shares(rand)
+        ),
+    ),
+    input_parsers.KennebunkParser: (
+        ['Account,Type,Debit,Credit,Balance,Date,Description'],
+        lambda rand, date: '123,CHK,{},,0,{},"{}"'.format(
+            money(rand, 1, 900), date.strftime('%m/%d/%Y'), export_desc(rand)
+        ),
+    ),
+}
+
+def generate_export(fn, input_type, rows, seed=0):
+    """
+    Writes an export of rows transactions spread over ten years in the
+    format of parsers[input_type], in the order that bank writes them
+    """
+    parser = input_parsers.parsers[input_type]
+    header, make_row = next(export_formats[c] for c in parser.__mro__ if c in export_formats)
+    rand = random.Random(seed)
+    start = datetime(2010, 1, 1)
+    lines = [
+        make_row(rand, start + timedelta(days=i * 3650 // rows))
+        for i in range(rows)
+    ]
+    if parser.newest_first:
+        lines.reverse()
+    elif parser.sort_key is not None:
+        rand.shuffle(lines)
+    with open(fn, 'w') as f:
+        for line in header + lines:
+            f.write(line+'\n')
+
+def bench_dates(postings):
+    "Parses a Vanguard export of postings / 2 rows with and without parse_date"
+    with tempfile.TemporaryDirectory() as tmp:
+        fn = os.path.join(tmp, 'vanguard.csv')
+        generate_export(fn, 'vanguard-ctc', postings // 2)
+        parser = input_parsers.CtcVanguardParser
+
+        dates.parse_date.cache_clear()
+        transactions, secs = timed(parser.parse_file, fn)
+
+        input_parsers.parse_date = datetime.strptime
+        try:
+            legacy, legacy_secs = timed(parser.parse_file, fn)
+        finally:
+            input_parsers.parse_date = dates.parse_date
+
+        if [(t.date, t.desc) for t in transactions] != [(t.date, t.desc) for t in legacy]:
+            raise Exception('date parsers disagree on {}'.format(fn))
+
+        # the dates alone, every row's string parsed once
+        texts = [t.date.strftime('%m/%d/%Y') for t in transactions]
+        dates.parse_date.cache_clear()
+        _, strptime_secs = timed(lambda: [datetime.strptime(text, '%m/%d/%Y') for text in texts])
+        _, parse_date_secs = timed(lambda: [dates.parse_date(text, '%m/%d/%Y') for text in texts])
+
+        print('vanguard export, {} rows: strptime {:.2f}s, parse_date {:.2f}s ({:.1f}x); '
+            'dates alone {:.2f}s vs {:.2f}s ({:.1f}x)'.format(
+            len(transactions), legacy_secs, secs, legacy_secs / secs,
+            strptime_secs, parse_date_secs, strptime_secs / parse_date_secs
+        ))
+
+def legacy_price(prices, commodity, date):
+    "Latest price on or before date by scanning the flat Journal.prices list"
+    found = None
+    for price in prices:
+        if price.commodity == commodity and price.date <= date and \
+            (found is None or price.date >= found.date):
+            found = price
+    return found.value if found else None
+
+def bench_prices(postings):
+    "As-of price lookups and a monthly net worth series"
+    with tempfile.TemporaryDirectory() as tmp:
+        fn = os.path.join(tmp, 'accounts.dat')
+        generate_journal(fn, postings, price_weeks=max(1, postings // 700))
+        journal = Journal.parse_file(fn)
+
+    # lookups from the P directives alone, so both sides see the same prices
+    index = PriceIndex(journal.prices)
+    first = journal.transactions[0].date
+    last = journal.transactions[-1].date
+    dates = month_ends(first, last)
+    lookups = [(c, d) for d in dates for c in fund_commodities]
+
+    expected, legacy_secs = timed(lambda: [legacy_price(journal.prices, c, d) for c, d in lookups])
+    result, secs = timed(lambda: [index.price(c, d) for c, d in lookups])
+    if result != expected:
+        raise Exception('price index disagrees with scanning prices')
+
+    full_index, build_secs = timed(PriceIndex, journal.prices, journal.transactions)
+    _, series_secs = timed(full_index.net_worth, journal.transactions, dates)
+    print('{} price lookups over {} prices: scan {:.2f}s, index {:.4f}s; '
+        'net worth at {} month ends: build {:.2f}s, sweep {:.2f}s'.format(
+        len(lookups), len(journal.prices), legacy_secs, secs,
+        len(dates), build_secs, series_secs
+    ))
+
+def bench_cube(postings):
+    "Monthly totals by account prefix from raw postings and from the cube"
+    with tempfile.TemporaryDirectory() as tmp:
+        fn = os.path.join(tmp, 'accounts.dat')
+        generate_journal(fn, postings)
+        journal = Journal.parse_file(fn)
+    queries = [['Expenses'], ['Assets'], ['Expenses:Auto'], ['Assets', 'Liabilities']] * 5
+
+    def recompute(prefixes):
+        totals = defaultdict(Decimal)
+        for trans in journal.transactions:
+            for account, commodity, quantity in posting_amounts(trans):
+                if commodity == '$' and under(account, prefixes):
+                    totals[month_number(trans.date)] += quantity
+        return totals
+
+    expected, legacy_secs = timed(lambda: [recompute(q) for q in queries])
+    cube, build_secs = timed(AggregateCube, journal.transactions)
+    result, secs = timed(lambda: [cube.series(q) for q in queries])
+    for totals, series in zip(expected, result):
+        if any(abs(float(total) - series[month - cube.first_month]) > 0.01
+            for month, total in totals.items()):
+            raise Exception('cube disagrees with recomputing from postings')
+
+    print('{} monthly series, {} postings: recompute {:.2f}s, cube {:.4f}s (+{:.2f}s to build)'.format(
+        len(queries), postings, legacy_secs, secs, build_secs
+    ))
+
+def bench_lazy(postings):
+    """
+    Loading plus checking a month of recent transactions, then importing a
+    day of them again, parsed fully and lazily
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        fn = os.path.join(tmp, 'accounts.dat')
+        generate_journal(fn, postings)
+        journal = Journal.parse_file(fn)
+        last = max(t.date for t in journal.transactions)
+        recent = [t for t in journal.transactions if t.date > last - timedelta(days=31)]
+        # the recent descriptions the next day, as a statement would list
+        # them, leaving out any the import would have to ask about
+        rows = [
+            Transaction(last + timedelta(days=1), t.desc,
+                [Posting(t.postings[0].account, t.postings[0].quantity)])
+            for t in recent
+            if journal.description_map.candidates(t.desc, {t.postings[0].account})
+        ]
+        del journal
+
+        def check(load):
+            journal = load(fn)
+            return journal, [
+                (journal.already_imported(t), journal.is_mirror_trans(t)) for t in recent
+            ]
+
+        (journal, expected), full_secs = timed(check, Journal.parse_file)
+        (lazy, result), secs = timed(check, LazyJournal)
+        if result != expected:
+            raise Exception('lazy journal disagrees on {}'.format(fn))
+        decoded = sum(1 for trans in lazy.decoded if trans is not None)
+
+        def import_rows(load):
+            cmd = LedgerImportCmd()
+            cmd.journal = load(fn)
+            cmd.new_transactions = [Transaction(t.date, t.desc, list(t.postings)) for t in rows]
+            with redirect_stdout(StringIO()):
+                if not cmd.process_transactions(check_already_imported=True):
+                    raise Exception('import of {} stopped to ask for an account'.format(fn))
+            return cmd.journal, [str(t) for t in cmd.journal.unsaved_transactions()]
+
+        (journal, expected), full_import_secs = timed(import_rows, Journal.parse_file)
+        # the first lazy import writes the description map's sidecar
+        (lazy, result), import_secs = timed(import_rows, LazyJournal)
+        if result != expected:
+            raise Exception('lazy import disagrees on {}'.format(fn))
+        (lazy, result), cached_secs = timed(import_rows, LazyJournal)
+        import_decoded = sum(1 for trans in lazy.decoded if trans is not None)
+
+    print('load and check {} recent, {} postings: parse_file {:.2f}s, lazy {:.2f}s '
+        '({:.1f}x, {} of {} decoded)'.format(
+        len(recent), postings, full_secs, secs, full_secs / secs, decoded, len(lazy.decoded)
+    ))
+    print('load and import {} rows, {} postings: parse_file {:.2f}s, lazy {:.2f}s, '
+        'lazy with description sidecar {:.2f}s ({:.1f}x, {} of {} decoded)'.format(
+        len(rows), postings, full_import_secs, import_secs, cached_secs,
+        full_import_secs / cached_secs, import_decoded, len(lazy.decoded)
+    ))
+
+def bench_parallel(postings):
+    "parse_file in one process and in chunks across every CPU"
+    with tempfile.TemporaryDirectory() as tmp:
+        fn = os.path.join(tmp, 'accounts.dat')
+        generate_journal(fn, postings)
+
+        journal, serial_secs = timed(Journal.parse_file, fn)
+        parallel, secs = timed(Journal.parse_file, fn, None)
+
+        if str(parallel) != str(journal) or \
+            parallel.by_quantity.keys() != journal.by_quantity.keys() or \
+            any(parallel.description_map.candidates(desc) != journal.description_map.candidates(desc)
+                for desc in journal.description_map):
+            raise Exception('parallel parse disagrees on {}'.format(fn))
+
+    print('parse_file, {} postings: 1 process {:.2f}s, {} processes {:.2f}s ({:.1f}x)'.format(
+        postings, serial_secs, os.cpu_count(), secs, serial_secs / secs
+    ))
+
+benches = {
+    'parse_file': bench_parse_file,
+    'load_cache': bench_load_cache,
+    'write': bench_write,
+    'memory': bench_memory,
+    'mirror': bench_mirror,
+    'classify': bench_classify,
+    'fuzzy': bench_fuzzy,
+    'dates': bench_dates,
+    'prices': bench_prices,
+    'cube': bench_cube,
+    'lazy': bench_lazy,
+    'parallel': bench_parallel,
+}
+
+# transactions in the journals bench_suite builds by default; sizes up to
+# 5000000 work but take minutes and several GB of memory
+suite_sizes = [10000, 100000]
+# calls timed for each per-transaction operation
+suite_probes = 1000
+max_export_rows = 200000
+
+def bench_suite(sizes, probes=suite_probes):
+    """
+    Times each stage of an import against journals of each size in
+    transactions and exports in every registered format, returning
+    {'size/stage': seconds}
+    """
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        for size in sizes:
+            def record(stage, fn, *args):
+                result, secs = timed(fn, *args)
+                results['{}/{}'.format(size, stage)] = secs
+                return result
+
+            fn = os.path.join(tmp, 'accounts.dat')
+            generate_journal(fn, size * 2, price_weeks=max(1, size // 350), rules=200)
+            journal = record('parse_file', Journal.parse_file, fn)
+            record('build_indexes', journal.build_indexes)
+
+            step = max(1, len(journal.transactions) // probes)
+            existing = journal.transactions[::step][:probes]
+            record('already_imported', lambda: [journal.already_imported(t) for t in existing])
+
+            candidates = mirror_candidates(journal, probes)
+            record('is_mirror_trans', lambda: [journal.is_mirror_trans(t) for t in candidates])
+
+            rand = random.Random(size)
+            last = journal.transactions[-1].date
+            new = [
+                Transaction(last, export_desc(rand), [Posting(asset_accounts[0], money(rand, 1, 900))])
+                for i in range(probes)
+            ]
+            cmd = LedgerImportCmd()
+            cmd.journal = journal
+            # the first call also builds the classifier and description index
+            record('get_account', lambda: [cmd.get_account(t) for t in new])
+            record('str', str, journal)
+
+            rows = min(size, max_export_rows)
+            for input_type, parser in sorted(input_parsers.parsers.items()):
+                export_fn = os.path.join(tmp, input_type)
+                generate_export(export_fn, input_type, rows)
+                record('parser/'+input_type, parser.parse_file, export_fn)
+                os.unlink(export_fn)
+
+            for stage in sorted(results):
+                if stage.startswith('{}/'.format(size)):
+                    print('{:40} {:10.4f}s'.format(stage, results[stage]))
+    return results
+
+def compare(results, baseline, threshold, min_seconds):
+    """
+    Returns (stage, baseline seconds, seconds) for stages more than
+    threshold times slower than baseline, ignoring differences under
+    min_seconds as noise
+    """
+    return [
+        (stage, baseline[stage], secs)
+        for stage, secs in sorted(results.items())
+        if stage in baseline and
+            secs > baseline[stage] * threshold and
+            secs - baseline[stage] > min_seconds
+    ]
+
+def main():
+    arg_parser = ArgumentParser(description='Benchmark the ledger import pipeline.')
+    arg_parser.add_argument('-p', '--postings', type=int, default=1000000)
+    arg_parser.add_argument('-b', '--bench', choices=benches.keys(), action='append')
+
+    arg_parser.add_argument('--suite', action='store_true',
+        help='time every import stage and write a JSON report')
+    arg_parser.add_argument('-s', '--sizes', type=int, nargs='+', default=suite_sizes,
+        help='journal sizes in transactions for --suite')
+    arg_parser.add_argument('-r', '--report', help='write the --suite report to this file')
+    arg_parser.add_argument('--baseline', help='--suite report to compare against')
+    arg_parser.add_argument('--threshold', type=float, default=1.25,
+        help='slowdown ratio over the baseline that counts as a regression')
+    arg_parser.add_argument('--min-seconds', type=float, default=0.01,
+        help='slowdowns smaller than this are noise')
+
+    args = arg_parser.parse_args()
+
+    if not args.suite:
+        for name in args.bench or benches.keys():
+            benches[name](args.postings)
+        return
+
+    results = bench_suite(args.sizes)
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump({
+                'python': platform.python_version(),
+                'sizes': args.sizes,
+                'results': results,
+            }, f, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+        regressions = compare(results, baseline, args.threshold, args.min_seconds)
+        for stage, old, new in regressions:
+            print('REGRESSION {}: {:.4f}s -> {:.4f}s ({:.2f}x)'.format(stage, old, new, new / old))
+        if regressions:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+import re
+
+from instrumentation import stats
+
+# patterns that would change meaning inside a larger alternation
+backreference_re = re.compile(r'\\[1-9]|\(\?P=')
+default_flags = re.compile('').flags
+
+def combinable(rule):
+    return not rule.compiled.groupindex and \
+        rule.compiled.flags == default_flags and \
+        not backreference_re.search(rule.regex)
+
+class RegexClassifier(object):
+    """
+    Matches descriptions against AccountRegEx rules with the same results as
+    calling rule.compiled.match for every rule, where later rules take
+    priority.  Runs of rules are compiled into one alternation per chunk so a
+    description costs one match per chunk instead of one per rule.  Rules
+    added later are matched one by one until there are enough of them to
+    compile another chunk.
+    """
+    chunk_size = 100
+
+    def __init__(self, rules=()):
+        self.rules = []
+        # (start, end, compiled alternation or None) covering rules[start:end];
+        # None means a single rule matched on its own
+        self.segments = []
+        # rules[compiled_count:] are not in any segment yet
+        self.compiled_count = 0
+        self.extend(rules)
+
+    def add(self, rule):
+        self.rules.append(rule)
+        if len(self.rules) - self.compiled_count >= self.chunk_size:
+            self.compile_pending()
+
+    def extend(self, rules):
+        self.rules.extend(rules)
+        self.compile_pending()
+
+    def sync(self, rules):
+        "Catches up with a rule list that has only been appended to since"
+        if len(rules) < len(self.rules) or \
+            (self.rules and rules[len(self.rules)-1] is not self.rules[-1]):
+            self.__init__(rules)
+        else:
+            for rule in rules[len(self.rules):]:
+                self.add(rule)
+
+    def compile_pending(self):
+        start = self.compiled_count
+        end = len(self.rules)
+        while start < end:
+            if not combinable(self.rules[start]):
+                self.segments.append((start, start+1, None))
+                start += 1
+                continue
+
+            stop = start + 1
+            while stop < end and stop - start < self.chunk_size and \
+                combinable(self.rules[stop]):
+                stop += 1
+            # highest priority first, since the first alternative that
+            # matches is the one reported
+            try:
+                compiled = re.compile('|'.join(
+                    '(?P<r{}>{})'.format(i, self.rules[i].regex)
+                    for i in reversed(range(start, stop))
+                ))
+            except re.error:
+                self.segments.extend((i, i+1, None) for i in range(start, stop))
+            else:
+                self.segments.append((start, stop, compiled))
+            start = stop
+        self.compiled_count = end
+
+    def iter_matches(self, desc):
+        "Yields the account of every matching rule, highest priority first"
+        for i in reversed(range(self.compiled_count, len(self.rules))):
+            stats.count('regex_matches')
+            if self.rules[i].compiled.match(desc):
+                yield self.rules[i].account
+
+        for start, end, compiled in reversed(self.segments):
+            stats.count('regex_matches')
+            if compiled is None:
+                if self.rules[start].compiled.match(desc):
+                    yield self.rules[start].account
+                continue
+
+            m = compiled.match(desc)
+            if not m:
+                continue
+            matched = int(m.lastgroup[1:])
+            yield self.rules[matched].account
+            # lower priority rules in the same chunk can only be found one by one
+            for i in reversed(range(start, matched)):
+                stats.count('regex_matches')
+                if self.rules[i].compiled.match(desc):
+                    yield self.rules[i].account
+
+    def classify(self, desc):
+        "Account of the highest priority matching rule, or None"
+        return next(self.iter_matches(desc), None)
+
+    def classify_many(self, descs):
+        results = {}
+        for desc in descs:
+            if desc not in results:
+                results[desc] = self.classify(desc)
+        return [results[desc] for desc in descs]
@@ -0,0 +1,137 @@
+from balances import posting_amounts
+from prices import under
+from transaction_store import NameTable
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+def month_number(date):
+    return date.year * 12 + date.month - 1
+
+def month_label(number):
+    return '{}/{:02}'.format(number // 12, number % 12 + 1)
+
+class AggregateCube(object):
+    """
+    Sums of posting quantities by month x account x commodity in a NumPy
+    array, with elided amounts resolved like the balance engine does.
+    Sums are float64, so they suit charts rather than reconciliation.
+    Adding transactions with new months, accounts or commodities grows
+    the array in place, doubling its capacity as needed.
+    """
+
+    def __init__(self, transactions=()):
+        if numpy is None:
+            raise Exception('AggregateCube needs numpy')
+        self.accounts = NameTable()
+        self.commodities = NameTable()
+        # month number of data[0], and how many months are in use
+        self.first_month = None
+        self.month_count = 0
+        self.data = numpy.zeros((0, 0, 0))
+        # prefixes -> boolean mask over the account ids there were when it was made
+        self.masks = {}
+        self.add_transactions(transactions)
+
+    def add_transactions(self, transactions):
+        "Adds many transactions with one vectorized update"
+        months = []
+        accounts = []
+        commodities = []
+        quantities = []
+        for trans in transactions:
+            month = month_number(trans.date)
+            for account, commodity, quantity in posting_amounts(trans):
+                months.append(month)
+                accounts.append(self.accounts.id(account))
+                commodities.append(self.commodities.id(commodity))
+                quantities.append(float(quantity))
+        if not months:
+            return
+        self.reserve(min(months), max(months))
+        numpy.add.at(
+            self.data,
+            (numpy.array(months) - self.first_month, accounts, commodities),
+            quantities
+        )
+
+    def add_transaction(self, trans):
+        month = month_number(trans.date)
+        for account, commodity, quantity in posting_amounts(trans):
+            account_id = self.accounts.id(account)
+            commodity_id = self.commodities.id(commodity)
+            self.reserve(month, month)
+            self.data[month - self.first_month, account_id, commodity_id] += float(quantity)
+
+    def reserve(self, low, high):
+        "Grows data to cover months low through high and every known name"
+        if self.first_month is None:
+            self.first_month = low
+        start = min(low, self.first_month)
+        end = max(high, self.first_month + self.month_count - 1)
+        # months to insert ahead of the current first one
+        before = self.first_month - start
+        shape = (end - start + 1, len(self.accounts.names), len(self.commodities.names))
+        capacity = self.data.shape
+        if before or any(need > have for need, have in zip(shape, capacity)):
+            grown = numpy.zeros(tuple(
+                max(need, 2 * have) for need, have in zip(shape, capacity)
+            ))
+            grown[before:before+self.month_count, :capacity[1], :capacity[2]] = \
+                self.data[:self.month_count]
+            self.data = grown
+        self.first_month = start
+        self.month_count = shape[0]
+
+    def months(self):
+        "Labels of the months in use, like '2016/02'"
+        return [month_label(self.first_month + i) for i in range(self.month_count)]
+
+    def mask(self, prefixes):
+        "Which account ids are under any of prefixes"
+        key = tuple(prefixes)
+        mask = self.masks.get(key)
+        if mask is None or len(mask) != len(self.accounts.names):
+            mask = self.masks[key] = numpy.array(
+                [under(account, prefixes) for account in self.accounts.names], dtype=bool
+            )
+        return mask
+
+    def used(self):
+        "The part of data holding months, accounts and commodities in use"
+        return self.data[:self.month_count, :len(self.accounts.names), :len(self.commodities.names)]
+
+    def series(self, prefixes, commodity='$', cumulative=False):
+        """
+        Per-month totals of commodity over accounts under prefixes, or the
+        running balance at the end of each month when cumulative
+        """
+        if commodity not in self.commodities.ids:
+            return numpy.zeros(self.month_count)
+        used = self.used()[:, self.mask(prefixes), self.commodities.ids[commodity]]
+        totals = used.sum(axis=1)
+        return numpy.cumsum(totals) if cumulative else totals
+
+    def rollup(self, depth, commodity='$', prefixes=None):
+        "account truncated to depth levels -> per-month totals"
+        groups = {}
+        for account in self.accounts.names:
+            if prefixes and not under(account, prefixes):
+                continue
+            group = ':'.join(account.split(':')[:depth])
+            groups.setdefault(group, []).append(account)
+        return dict(
+            (group, self.series([group], commodity))
+            for group in groups
+        )
+
+    def value(self, month, account, commodity='$'):
+        "Total posted to exactly account in month ('2016/02')"
+        year, number = month.split('/')
+        i = int(year) * 12 + int(number) - 1 - (self.first_month or 0)
+        if not 0 <= i < self.month_count or account not in self.accounts.ids or \
+            commodity not in self.commodities.ids:
+            return 0.0
+        return float(self.data[i, self.accounts.ids[account], self.commodities.ids[commodity]])
@@ -0,0 +1,52 @@
+from datetime import datetime
+from functools import lru_cache
+import re
+
+# the same field patterns datetime.strptime uses, so both accept and
+# reject exactly the same strings
+fields = {
+    'Y': r'(?P<Y>\d\d\d\d)',
+    'y': r'(?P<y>\d\d)',
+    'm': r'(?P<m>1[0-2]|0[1-9]|[1-9])',
+    'd': r'(?P<d>3[01]|[12]\d|0[1-9]|[1-9]| [1-9])',
+}
+
+journal_format = '%Y/%m/%d'
+
+# formats read by the journal and the input parsers
+fast_formats = ['%Y/%m/%d', '%m/%d/%Y', '%m/%d/%y', '%Y-%m-%d', '%Y%m%d']
+
+# distinct date strings remembered; exports only span a few thousand days
+cache_size = 8192
+
+def compile_format(fmt):
+    pattern = re.sub(
+        '%(.)|([^%]+)',
+        lambda m: fields[m.group(1)] if m.group(1) else re.escape(m.group(2)),
+        fmt
+    )
+    return re.compile(pattern)
+
+patterns = dict((fmt, compile_format(fmt)) for fmt in fast_formats)
+
+@lru_cache(maxsize=cache_size)
+def parse_date(text, fmt=journal_format):
+    """
+    Same result as datetime.strptime(text, fmt), with a regex fast path for
+    fast_formats and a cache since exports repeat the same dates many times
+    """
+    pattern = patterns.get(fmt)
+    if pattern is None:
+        return datetime.strptime(text, fmt)
+
+    m = pattern.fullmatch(text)
+    if not m:
+        raise ValueError('time data {!r} does not match format {!r}'.format(text, fmt))
+    groups = m.groupdict()
+    if 'Y' in groups:
+        year = int(groups['Y'])
+    else:
+        # strptime's pivot for two digit years
+        year = int(groups['y'])
+        year += 2000 if year < 69 else 1900
+    return datetime(year, int(groups['m']), int(groups['d']))
@@ -0,0 +1,93 @@
+from argparse import ArgumentParser
+from collections import defaultdict
+from datetime import datetime
+from decimal import Decimal
+import json
+
+from balances import posting_amounts
+from import_model import Journal
+from transaction_store import NameTable
+
+BUNDLE_VERSION = 1
+epoch = datetime(1970, 1, 1).toordinal()
+
+def days(date):
+    "Days since 1970/01/01, which the browser turns into a Date directly"
+    return date.toordinal() - epoch
+
+def bundle(journal):
+    """
+    Flattens journal into columns of builtin types for the dashboard.
+    Strings are stored once in name lists and referred to by index,
+    amounts are decimal strings so no precision is lost, and dates are
+    days since 1970/01/01.  Postings of transaction i are
+    postings[start[i]:start[i+1]], as written in the journal, so an elided
+    amount is a null quantity that the dashboard balances the way it
+    balances ledger text.  monthly holds the total of every (month,
+    account, commodity) before any rollup, with elided amounts filled in
+    as posting_amounts does.
+    """
+    accounts = NameTable()
+    commodities = NameTable()
+    descs = NameTable()
+    months = NameTable()
+
+    transactions = {'date': [], 'desc': [], 'start': [0]}
+    postings = {'account': [], 'commodity': [], 'quantity': [], 'unit_price': []}
+    # (month id, account id, commodity id) -> total
+    monthly = defaultdict(Decimal)
+
+    for trans in journal.sorted_transactions():
+        transactions['date'].append(days(trans.date))
+        transactions['desc'].append(descs.id(trans.desc))
+        month = months.id(trans.date.strftime('%Y/%m'))
+        for p in trans.postings:
+            postings['account'].append(accounts.id(p.account))
+            postings['commodity'].append(commodities.id(p.commodity))
+            postings['quantity'].append(None if p.quantity is None else str(p.quantity))
+            postings['unit_price'].append(str(p.unit_price) if p.unit_price else None)
+        for account, commodity, quantity in posting_amounts(trans):
+            monthly[(month, accounts.id(account), commodities.id(commodity))] += quantity
+        transactions['start'].append(len(postings['account']))
+
+    prices = defaultdict(lambda: {'date': [], 'price': []})
+    index = journal.price_index()
+    for commodity in sorted(index.dates):
+        series = prices[commodity]
+        series['date'] = [days(date) for date in index.dates[commodity]]
+        series['price'] = [str(value) for value in index.values[commodity]]
+
+    cells = sorted(monthly.items())
+    return {
+        'version': BUNDLE_VERSION,
+        'accounts': accounts.names,
+        'commodities': commodities.names,
+        'descs': descs.names,
+        'months': months.names,
+        'transactions': transactions,
+        'postings': postings,
+        'prices': dict(prices),
+        'monthly': {
+            'month': [month for (month, account, commodity), total in cells],
+            'account': [account for (month, account, commodity), total in cells],
+            'commodity': [commodity for (month, account, commodity), total in cells],
+            'total': [str(total) for key, total in cells],
+        },
+    }
+
+def write_bundle(journal, fn):
+    with open(fn, 'w') as f:
+        json.dump(bundle(journal), f, separators=(',', ':'))
+
+def main():
+    arg_parser = ArgumentParser(
+        description='Export a ledger journal as a compact JSON bundle for the dashboard.'
+    )
+    arg_parser.add_argument('-j', '--journal', required=True)
+    arg_parser.add_argument('-o', '--output', required=True)
+    args = arg_parser.parse_args()
+
+    write_bundle(Journal.load(args.journal), args.output)
+
+if __name__ == "__main__":
+    main()
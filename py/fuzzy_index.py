@@ -0,0 +1,124 @@
+from collections import defaultdict
+from heapq import nlargest
+from math import ceil
+import re
+
+from instrumentation import stats
+
+word_re = re.compile('[a-z0-9]+')
+digit_re = re.compile('[0-9]')
+
+def normalize(desc):
+    """
+    Lowercase words of desc without punctuation or any word containing a
+    digit, since banks add store numbers and reference codes to otherwise
+    identical descriptions
+    """
+    return ' '.join(
+        word for word in word_re.findall(desc.lower())
+        if not digit_re.search(word)
+    )
+
+def trigrams(text):
+    padded = ' {} '.format(text)
+    return frozenset(padded[i:i+3] for i in range(len(padded) - 2))
+
+class DescriptionIndex(object):
+    """
+    Trigram inverted index over descriptions, for finding past descriptions
+    at least min_score similar to a new one.  Descriptions that normalize
+    to the same text share an entry.
+
+    Only a prefix of each description's trigrams is indexed, rarest first:
+    two trigram sets with Jaccard similarity of at least min_score must
+    share one of their first len - ceil(min_score * len) + 1 trigrams when
+    both are put in the same order.  Rarity is counted when the index is
+    built; trigrams first seen later count as rarest.
+    """
+    min_score = 0.5
+    # original spellings kept per normalized description
+    max_descs = 4
+
+    def __init__(self, descs=()):
+        # normalized description -> id
+        self.ids = {}
+        # by id: original descriptions, most recent last, and trigrams
+        self.descs = []
+        self.grams = []
+        # trigram -> ids of descriptions with it in their indexed prefix
+        self.postings = defaultdict(list)
+
+        descs = list(descs)
+        # trigram -> number of distinct descriptions containing it
+        self.frequency = defaultdict(int)
+        for key in set(normalize(desc) for desc in descs):
+            for gram in trigrams(key):
+                self.frequency[gram] += 1
+        self.frequency = dict(self.frequency)
+
+        for desc in descs:
+            self.add(desc)
+
+    def prefix(self, grams):
+        "The grams that have to be shared with anything min_score similar"
+        frequency = self.frequency
+        ordered = sorted(grams, key=lambda gram: (frequency.get(gram, 0), gram))
+        return ordered[:len(grams) - int(ceil(self.min_score * len(grams))) + 1]
+
+    def add(self, desc):
+        key = normalize(desc)
+        if not key:
+            return
+        i = self.ids.get(key)
+        if i is None:
+            i = self.ids[key] = len(self.descs)
+            self.descs.append([desc])
+            grams = trigrams(key)
+            self.grams.append(grams)
+            for gram in self.prefix(grams):
+                self.postings[gram].append(i)
+        elif self.descs[i][-1] != desc:
+            descs = self.descs[i]
+            if desc in descs:
+                descs.remove(desc)
+            descs.append(desc)
+            del descs[:-self.max_descs]
+
+    def similar(self, desc, k=5):
+        """
+        Returns up to k (score, descs) pairs for the indexed descriptions
+        most similar to desc, best first, where score is the Jaccard
+        similarity of the normalized trigrams and descs are the original
+        spellings, most recent first
+        """
+        key = normalize(desc)
+        if not key:
+            return []
+        i = self.ids.get(key)
+        if i is not None and k == 1:
+            return [(1.0, self.descs[i][::-1])]
+
+        grams = trigrams(key)
+        # a set this similar can only be so much smaller or larger
+        shortest = self.min_score * len(grams)
+        longest = len(grams) / self.min_score
+
+        candidates = set()
+        for gram in self.prefix(grams):
+            candidates.update(self.postings.get(gram, ()))
+        stats.count('similar_queries')
+        stats.count('similar_candidates', len(candidates))
+
+        scored = []
+        for i in candidates:
+            other = self.grams[i]
+            if not shortest <= len(other) <= longest:
+                continue
+            shared = len(grams & other)
+            score = shared / float(len(grams) + len(other) - shared)
+            if score >= self.min_score:
+                scored.append((score, i))
+        return [
+            (score, self.descs[i][::-1])
+            for score, i in nlargest(k, scored)
+        ]
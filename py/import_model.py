@@ -1,16 +1,65 @@
+from bisect import bisect_right, insort
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime, timedelta
 from decimal import Decimal
+import gc
 from hashlib import sha1
+from heapq import merge
+from io import BytesIO, StringIO, TextIOWrapper
+from itertools import islice
+import marshal
+import os
 import re
+from sys import intern
+
+from balances import BalanceEngine
+from classifier import RegexClassifier
+from dates import parse_date
+from fuzzy_index import DescriptionIndex
+from instrumentation import stats
+from prices import PriceIndex
+
+# line types, keyed by the first character of a journal line
+ACCOUNT = 'account'
+COMMENT = 'comment'
+COMMODITY = 'commodity'
+DATE_DESC = 'date_desc'
+INCLUDE = 'include'
+INDENTED = 'indented'
+PRICE = 'price'
+
+line_kinds = dict.fromkeys('0123456789', DATE_DESC)
+line_kinds.update({
+    'a': ACCOUNT,
+    'c': COMMODITY,
+    'i': INCLUDE,
+    'P': PRICE,
+    ';': COMMENT,
+    ' ': INDENTED,
+    '\t': INDENTED,
+})
+
+regex_comment_re = re.compile('^\s*;.*/.+/')
+# the end of a line and the blank line after it
+blank_line_re = re.compile(rb'\n[ \t\r]*\n')
+
+# bump when the layout of the marshalled snapshots (see Journal.snapshot and
+# DescriptionMap.snapshot) changes
+CACHE_VERSION = 4
+
+# journals smaller than this are parsed in one process; starting workers
+# costs more than it saves
+parallel_min_bytes = 1 << 22
+# chunks per worker, so a slow chunk does not leave the others idle
+chunks_per_worker = 4
 
 class AccountRegEx(object):
-    account = None
-    compiled = None
-    regex = None
+    __slots__ = ('account', 'compiled', 'regex')
 
     def __init__(self, account, regex):
-        self.account = account
+        self.account = intern(account)
         self.regex = regex
         self.compiled = re.compile(regex)
 
@@ -23,22 +72,20 @@ class AccountRegEx(object):
         return AccountRegEx(account, regex)
 
 class Commodity(object):
-    name = None
+    __slots__ = ('name',)
 
     def __init__(self, name):
-        self.name = name
+        self.name = intern(name)
 
     def __str__(self):
         return 'commodity '+self.name
 
 class Price(object):
-    date = None
-    commodity = None
-    value = None
+    __slots__ = ('date', 'commodity', 'value')
 
     def __init__(self, date, commodity, value):
         self.date = date
-        self.commodity = commodity
+        self.commodity = intern(commodity)
         self.value = value
 
     def __str__(self):
@@ -49,15 +96,14 @@ class Price(object):
         )
 
 class Posting(object):
-    account = None
-    quantity = None
-    commodity = None
-    unit_price = None
+    # account and commodity names are interned so that the many postings
+    # to the same account share one string
+    __slots__ = ('account', 'quantity', 'commodity', 'unit_price')
 
     def __init__(self, account=None, quantity=None, commodity='$', unit_price=None):
-        self.account = account
+        self.account = account if account is None else intern(account)
         self.quantity = quantity
-        self.commodity = commodity
+        self.commodity = commodity if commodity is None else intern(commodity)
         self.unit_price = unit_price
 
     def __str__(self):
@@ -79,19 +125,84 @@ class Posting(object):
             # account only
             return '  {}'.format(self.account)
 
+    @classmethod
+    def parse(cls, line, stripped):
+        "Parses an indented posting line; stripped is line without leading space"
+        parts = [p.strip(' $') for p in line.split()]
+
+        # ACCT  QUANTITY COMMODITY @ $UNIT_PRICE'
+        if '@' in line:
+            # account might have spaces in it
+            return Posting(' '.join(parts[:-4]), Decimal(parts[-4]), parts[-3],
+                Decimal(parts[-1]))
+
+        # ACCT $QUANTITY
+        elif '$' in line:
+            # account might have spaces in it
+            return Posting(' '.join(parts[:-1]), Decimal(parts[-1]))
+
+        # ACCT  QUANTITY COMMODITY
+        elif '  ' in stripped:
+            # account might have spaces in it
+            return Posting(' '.join(parts[:-2]), Decimal(parts[-2]), parts[-1])
+
+        #  ACCT
+        else:
+            # account might have spaces in it
+            return Posting(' '.join(parts))
+
+    @classmethod
+    def parse_account(cls, line, stripped):
+        "The account parse would read from line, without parsing the amounts"
+        parts = [p.strip(' $') for p in line.split()]
+        if '@' in line:
+            parts = parts[:-4]
+        elif '$' in line:
+            parts = parts[:-1]
+        elif '  ' in stripped:
+            parts = parts[:-2]
+        return intern(' '.join(parts))
+
 class Transaction(object):
-    date = None
-    desc = None
-    postings = None
+    __slots__ = ('date', 'desc', '_postings', '_total', '_total_units')
 
     def __init__(self, date=None, desc=None, postings=None):
         self.date = date
-        self.desc = desc
+        self.desc = desc if desc is None else intern(desc)
         self.postings = postings if postings is not None else []
 
+    @property
+    def postings(self):
+        return self._postings
+
+    @postings.setter
+    def postings(self, postings):
+        self._postings = postings
+        self.invalidate_total()
+
+    def add_posting(self, posting):
+        self._postings.append(posting)
+        self.invalidate_total()
+
+    def invalidate_total(self):
+        "Call after changing the quantity of one of the postings"
+        self._total = self._total_units = None
+
     @property
     def total(self):
-        return sum(p.quantity for p in self.postings if p.quantity)
+        # postings can also be appended to the list directly, so the cached
+        # total is tagged with the number of postings it was computed from
+        count = len(self._postings)
+        if self._total is None or self._total[0] != count:
+            self._total = (count, sum(p.quantity for p in self._postings if p.quantity))
+        return self._total[1]
+
+    def total_units(self, scale):
+        "The total as an integer count of 10**-scale, or None if it needs more places"
+        count = len(self._postings)
+        if self._total_units is None or self._total_units[:2] != (count, scale):
+            self._total_units = (count, scale, to_units(self.total, scale))
+        return self._total_units[2]
 
     def __str__(self):
         return '{} {}\n{}\n'.format(
@@ -100,154 +211,696 @@ class Transaction(object):
             '\n'.join(str(p) for p in self.postings)
         )
 
+class DescriptionMap(object):
+    """
+    For each description, the accounts used with it ranked by how many
+    times they were used, then how recently.  At most max_accounts are kept
+    per description; the lowest ranked is dropped to make room.
+    """
+    max_accounts = 8
+
+    def __init__(self):
+        # desc -> [[account, count, last seen date ordinal, sequence], ...]
+        # in rank order; sequence breaks ties in favor of the latest addition
+        self.entries = {}
+        self.sequence = 0
+
+    def add(self, desc, account, date=None):
+        self.sequence += 1
+        ordinal = date.toordinal() if date else 0
+        entries = self.entries.setdefault(desc, [])
+        for i, entry in enumerate(entries):
+            if entry[0] == account:
+                entry[1] += 1
+                entry[2] = max(entry[2], ordinal)
+                entry[3] = self.sequence
+                break
+        else:
+            i = len(entries)
+            entries.append([account, 1, ordinal, self.sequence])
+
+        # move the updated entry up to its place; the rest stay in order
+        entry = entries[i]
+        while i and entries[i-1][1:] < entry[1:]:
+            entries[i] = entries[i-1]
+            i -= 1
+        entries[i] = entry
+        if len(entries) > self.max_accounts:
+            # keep the account just used even if it ranks last
+            del entries[-2 if entries[-1] is entry else -1]
+
+    def candidates(self, desc, exclude=()):
+        "Accounts used with desc, best first, skipping those in exclude"
+        return [
+            entry[0] for entry in self.entries.get(desc, ())
+            if entry[0] not in exclude
+        ]
+
+    def merge(self, other):
+        "Adds the counts from other, as if its additions came after ours"
+        for desc, entries in other.entries.items():
+            mine = self.entries.setdefault(desc, [])
+            by_account = {entry[0]: entry for entry in mine}
+            for account, count, ordinal, sequence in entries:
+                entry = by_account.get(account)
+                if entry is None:
+                    entry = by_account[account] = [account, 0, 0, 0]
+                    mine.append(entry)
+                entry[1] += count
+                entry[2] = max(entry[2], ordinal)
+                entry[3] = self.sequence + sequence
+            mine.sort(key=lambda entry: entry[1:], reverse=True)
+            del mine[self.max_accounts:]
+        self.sequence += other.sequence
+
+    def recount(self, descs, additions):
+        "Rebuilds the entries of descs from (desc, account, date) additions in file order"
+        if not descs:
+            return
+        recounted = DescriptionMap()
+        for desc, account, date in additions:
+            if desc in descs:
+                recounted.add(desc, account, date)
+        # sequence numbers only rank entries of the same description, and
+        # the recounted ones stay below our sequence
+        for desc in descs:
+            self.entries[desc] = recounted.entries[desc]
+
+    def __contains__(self, desc):
+        return desc in self.entries
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def snapshot(self):
+        return (self.sequence, self.entries)
+
+    @classmethod
+    def from_snapshot(cls, snapshot):
+        description_map = cls()
+        description_map.sequence, description_map.entries = snapshot
+        return description_map
+
 class Journal(object):
     transactions = None
     accounts = None
     regexes = None
     prices = None
-    # description -> account name
+    # what was last read from or written to disk; see mark_saved
+    saved_accounts = None
+    saved_regex_count = 0
+    saved_transaction_count = 0
+    # description -> accounts used with it
     description_map = None
     # most recent transactions with particular total
     by_quantity = None
+    # see build_indexes
+    amount_scale = 2
+    _balances = None
+    _cube = None
+    _price_index = None
+    _classifier = None
+    _description_index = None
+    # (date, desc, total units) of every transaction in by_quantity
+    _imported_keys = None
+    # (total units, posting accounts) -> sorted dates, for transactions
+    # involving more than one account
+    _mirror_dates = None
     commodities = None
+    # paths of included files, as written in include lines
+    includes = None
 
     ignore_descs = { 'Check W/D' }
 
     def __init__(self, transactions=None, by_quantity=None, accounts=None, description_map=None,
-        regexes=None, prices=None, commodities=None):
+        regexes=None, prices=None, commodities=None, includes=None):
         self.transactions = transactions or []
         self.by_quantity = by_quantity or defaultdict(list)
         self.accounts = accounts or set()
-        self.description_map = description_map or defaultdict(list)
+        self.description_map = description_map or DescriptionMap()
         self.regexes = regexes or []
         self.prices = prices or []
         self.commodities = commodities or []
+        self.includes = includes or []
+        self.mark_saved()
 
     def __str__(self):
-        return '\n\n'.join([
-            '\n'.join('account '+ a for a in sorted(self.accounts)),
-            '\n'.join(str(commodity) for commodity in self.commodities),
-            '\n'.join(str(price) for price in self.prices),
-            '\n'.join(str(regex) for regex in self.regexes),
-            '\n'.join(str(t) for t in sorted(self.transactions, key=lambda t: t.date))
-        ]) + '\n'
-
-    def add_desc_to_map(self, desc, acct):
+        out = StringIO()
+        self.write_to(out)
+        return out.getvalue()
+
+    def sorted_transactions(self):
+        "Transactions by date, in the same order as a stable sort"
+        saved = self.transactions[:self.saved_transaction_count]
+        unsaved = sorted(self.unsaved_transactions(), key=lambda t: t.date)
+        if any(a.date > b.date for a, b in zip(saved, islice(saved, 1, None))):
+            return sorted(self.transactions, key=lambda t: t.date)
+        # what was read from disk is normally already in order, so only the
+        # new transactions need sorting
+        return merge(saved, unsaved, key=lambda t: t.date)
+
+    def write_to(self, f, chunk_size=1000):
+        "Writes the same text as str(self) to f, chunk_size lines at a time"
+        sections = [
+            ('account '+a for a in sorted(self.accounts)),
+            (str(commodity) for commodity in self.commodities),
+            (str(price) for price in self.prices),
+            (str(regex) for regex in self.regexes),
+            (str(t) for t in self.sorted_transactions()),
+        ]
+        if self.includes:
+            sections.append('include '+include for include in self.includes)
+        chunk = []
+        for i, section in enumerate(sections):
+            if i:
+                chunk.append('\n\n')
+            for j, line in enumerate(section):
+                if j:
+                    chunk.append('\n')
+                chunk.append(line)
+                if len(chunk) >= chunk_size:
+                    f.write(''.join(chunk))
+                    chunk = []
+        chunk.append('\n')
+        f.write(''.join(chunk))
+
+    def mark_saved(self):
+        "Records the current contents as what is on disk"
+        self.saved_accounts = set(self.accounts)
+        self.saved_regex_count = len(self.regexes)
+        self.saved_transaction_count = len(self.transactions)
+
+    def unsaved_accounts(self):
+        return sorted(self.accounts - self.saved_accounts)
+
+    def unsaved_regexes(self):
+        return self.regexes[self.saved_regex_count:]
+
+    def unsaved_transactions(self):
+        return self.transactions[self.saved_transaction_count:]
+
+    def has_changes(self):
+        return bool(self.unsaved_accounts() or self.unsaved_regexes() or
+            self.unsaved_transactions())
+
+    def classifier(self):
+        "RegexClassifier over self.regexes, including rules appended since last call"
+        if self._classifier is None:
+            self._classifier = RegexClassifier(self.regexes)
+        else:
+            self._classifier.sync(self.regexes)
+        return self._classifier
+
+    def regex_accounts(self, desc):
+        "Accounts of the regexes matching desc, last regex first"
+        stats.count('regex_classifications')
+        return self.classifier().iter_matches(desc)
+
+    def description_index(self):
+        "DescriptionIndex over description_map, built on first use"
+        if self._description_index is None:
+            self._description_index = DescriptionIndex(self.description_map)
+        return self._description_index
+
+    def similar_accounts(self, desc, k=5):
+        "Accounts used with the past descriptions most similar to desc, best first"
+        if self._description_index is None:
+            with stats.stage('build_description_index'):
+                self.description_index()
+        for score, descs in self.description_index().similar(desc, k):
+            for past in descs:
+                for account in self.description_map.candidates(past):
+                    yield account
+
+    def balances(self):
+        "BalanceEngine over the transactions, kept current by add_transaction"
+        if self._balances is None:
+            with stats.stage('balances'):
+                self._balances = BalanceEngine(self.transactions)
+        return self._balances
+
+    def cube(self):
+        "AggregateCube over the transactions, kept current by add_transaction"
+        if self._cube is None:
+            # imported here so numpy is only loaded when a cube is wanted
+            from cube import AggregateCube
+            with stats.stage('cube'):
+                self._cube = AggregateCube(self.transactions)
+        return self._cube
+
+    def price_index(self):
+        "PriceIndex over prices and posting unit prices, kept current by add_transaction"
+        if self._price_index is None:
+            with stats.stage('price_index'):
+                self._price_index = PriceIndex(self.prices, self.transactions)
+        return self._price_index
+
+    def add_desc_to_map(self, desc, acct, date=None):
         if desc not in self.ignore_descs:
-            self.description_map[desc].append(acct)
+            self.description_map.add(desc, acct, date)
+            if self._description_index is not None:
+                self._description_index.add(desc)
+
+    def add_transaction(self, trans):
+        "Adds trans to the journal and to every index built over it"
+        self.transactions.append(trans)
+        self.by_quantity[trans.total].append(trans)
+        self.update_indexes(trans)
+
+    def include_transaction(self, trans):
+        """
+        Adds an already saved trans to by_quantity and the lookup indexes,
+        for journals that read their transactions a part at a time
+        """
+        self.by_quantity[trans.total].append(trans)
+        if self._imported_keys is not None:
+            if trans.total_units(self.amount_scale) is None:
+                self.reindex()
+            else:
+                self.index_transaction(trans)
+
+    def update_indexes(self, trans):
+        "Adds a newly added trans to whichever indexes have been built"
+        if self._balances is not None:
+            self._balances.add_transaction(trans)
+        if self._price_index is not None:
+            self._price_index.add_transaction(trans)
+        if self._cube is not None:
+            self._cube.add_transaction(trans)
+        if self._imported_keys is not None:
+            if trans.total_units(self.amount_scale) is None:
+                # needs a larger scale; rebuild on next use
+                self.reindex()
+            else:
+                self.index_transaction(trans)
+
+    def reindex(self):
+        "Drops the lookup indexes; call after changing by_quantity directly"
+        self._imported_keys = None
+        self._mirror_dates = None
+
+    def build_indexes(self):
+        """
+        Indexes by_quantity by integer totals at amount_scale, the most
+        decimal places of any total, so that lookups hash and compare ints
+        instead of Decimals
+        """
+        stats.count('index_builds')
+        self.amount_scale = max(
+            [places(total) for total in self.by_quantity] + [self.amount_scale]
+        )
+        self._imported_keys = set()
+        self._mirror_dates = defaultdict(list)
+        for matching in self.by_quantity.values():
+            for trans in matching:
+                self.index_transaction(trans)
+
+    def index_transaction(self, trans):
+        units = trans.total_units(self.amount_scale)
+        self._imported_keys.add((trans.date, trans.desc, units))
+        accounts = tuple(p.account for p in trans.postings)
+        if len(set(accounts)) > 1:
+            insort(self._mirror_dates[(units, accounts)], trans.date)
 
     def already_imported(self, trans):
-        matching_quantity = self.by_quantity.get(trans.total, [])
-        return len([
-            mq for mq in matching_quantity
-            if mq.date == trans.date and mq.desc == trans.desc
-        ]) > 0
+        if self._imported_keys is None:
+            self.build_indexes()
+        units = trans.total_units(self.amount_scale)
+        if units is None:
+            # more decimal places than anything in the journal
+            return False
+        stats.count('imported_key_probes')
+        return (trans.date, trans.desc, units) in self._imported_keys
 
     def is_mirror_trans(self, trans):
-        matching_quantity = self.by_quantity.get(-trans.total, [])
+        """
+        Mirror transactions occur when an earlier transaction:
+        - has more than one account involved
+        - is within the date threshold
+        - has the same account postings in reverse order
+        """
+        if self._mirror_dates is None:
+            self.build_indexes()
+        units = trans.total_units(self.amount_scale)
+        if units is None:
+            return False
+
+        threshold = timedelta(days=14)
+        accounts = tuple(p.account for p in reversed(trans.postings))
+        stats.count('mirror_index_probes')
+        dates = self._mirror_dates.get((-units, accounts))
+        if not dates:
+            return False
+        # any date after the start of the window, including later ones
+        return bisect_right(dates, trans.date - threshold) < len(dates)
+
+    def extend(self, other):
+        "Adds the contents of other as if it had been parsed from text after ours"
+        self.transactions.extend(other.transactions)
+        for total, matching in other.by_quantity.items():
+            self.by_quantity[total].extend(matching)
+        self.accounts.update(other.accounts)
+        self.regexes.extend(other.regexes)
+        self.prices.extend(other.prices)
+        self.commodities.extend(other.commodities)
+        self.includes.extend(other.includes)
+        self.description_map.merge(other.description_map)
+        self.reindex()
+        self.mark_saved()
 
-        for mq in matching_quantity:
-            threshold = timedelta(days=14)
-            mq_accounts = [p.account for p in mq.postings]
-            trans_accounts = [p.account for p in trans.postings]
+    @classmethod
+    def join(cls, parts):
+        """
+        A new journal with the contents of parts in order, as if their text
+        had been parsed in one go; parts can be an iterator that is still
+        producing them
+        """
+        journal = Journal()
+        # desc -> accounts used with it in any part
+        desc_accounts = defaultdict(set)
+        for part in parts:
+            for desc, entries in part.description_map.entries.items():
+                desc_accounts[desc].update(entry[0] for entry in entries)
+            journal.extend(part)
+
+        # merged counts are exact unless an account was dropped to make
+        # room, which needs at least max_accounts of them
+        journal.description_map.recount(set(
+            desc for desc, accounts in desc_accounts.items()
+            if len(accounts) >= DescriptionMap.max_accounts
+        ), ((t.desc, p.account, t.date) for t in journal.transactions for p in t.postings))
+        return journal
+
+    def snapshot(self):
+        "Flattens the journal into builtin types that marshal can store"
+        def text(value):
+            return None if value is None else str(value)
+
+        index = {id(trans): i for i, trans in enumerate(self.transactions)}
+        return (
+            sorted(self.accounts),
+            [commodity.name for commodity in self.commodities],
+            [(p.date.toordinal(), p.commodity, str(p.value)) for p in self.prices],
+            [(regex.account, regex.regex) for regex in self.regexes],
+            [
+                (
+                    trans.date.toordinal(),
+                    trans.desc,
+                    [
+                        (p.account, text(p.quantity), p.commodity, text(p.unit_price))
+                        for p in trans.postings
+                    ]
+                )
+                for trans in self.transactions
+            ],
+            [
+                (str(total), [index[id(trans)] for trans in matching])
+                for total, matching in self.by_quantity.items()
+            ],
+            self.description_map.snapshot(),
+            list(self.includes),
+        )
+
+    @classmethod
+    def from_snapshot(cls, snapshot):
+        accounts, commodities, prices, regexes, transactions, by_quantity, \
+            description_map, includes = snapshot
+
+        def decimal(value):
+            return None if value is None else Decimal(value)
+
+        fromordinal = datetime.fromordinal
+        transactions = [
+            Transaction(
+                fromordinal(date),
+                desc,
+                [
+                    Posting(account, decimal(quantity), commodity, decimal(unit_price))
+                    for account, quantity, commodity, unit_price in postings
+                ]
+            )
+            for date, desc, postings in transactions
+        ]
+
+        return Journal(
+            transactions,
+            defaultdict(list, (
+                (Decimal(total), [transactions[i] for i in matching])
+                for total, matching in by_quantity
+            )),
+            set(accounts),
+            DescriptionMap.from_snapshot(description_map),
+            [AccountRegEx(account, regex) for account, regex in regexes],
+            [
+                Price(fromordinal(date), commodity, Decimal(value))
+                for date, commodity, value in prices
+            ],
+            [Commodity(name) for name in commodities],
+            includes,
+        )
+
+    @classmethod
+    def load(cls, fn, use_cache=True, workers=1, includes=True, including=()):
+        """
+        Parses fn, reusing the sidecar cache when it still matches the file;
+        see parse_bytes for workers.  Files that fn includes are loaded the
+        same way and joined in, unless includes is False; including is the
+        chain of files that led to fn, to catch include cycles.
+        """
+        journal = cls.load_file(fn, use_cache, workers)
+        if includes and journal.includes:
+            directory = os.path.dirname(fn)
+            including = including + (os.path.realpath(fn),)
+            parts = [journal]
+            for include in journal.includes:
+                path = os.path.join(directory, include)
+                real_path = os.path.realpath(path)
+                if real_path in including:
+                    raise Exception('include cycle: {}'.format(
+                        ' -> '.join(including[including.index(real_path):] + (real_path,))))
+                parts.append(cls.load(path, use_cache, workers, including=including))
+            journal = cls.join(parts)
+            # the joined journal stands for all of the files as one
+            journal.includes = []
+        return journal
+
+    @classmethod
+    def load_file(cls, fn, use_cache=True, workers=1):
+        "Loads fn alone, ignoring any include lines"
+        if not use_cache:
+            return cls.parse_file(fn, workers)
+
+        with open(fn, 'rb') as f:
+            stat = os.fstat(f.fileno())
+            data = f.read()
+        key = cache_key(data, stat.st_mtime_ns)
+
+        with stats.stage('read_cache'):
+            journal = read_cache(cache_path(fn), key)
+        if journal is None:
+            stats.count('cache_misses')
+            with stats.stage('parse_journal'):
+                journal = cls.parse_bytes(data, workers)
+            with stats.stage('write_cache'):
+                write_cache(cache_path(fn), key, journal)
+        return journal
 
-            # mirror transactions occur when:
-            # - there is more than one account involved
-            # - it is within the date threshold
-            # - it has the same account postings in reverse order
-            if len(set(mq_accounts)) > 1 and \
-                mq.date + threshold > trans.date and \
-                mq_accounts == trans_accounts[::-1]:
-                return True
+    @classmethod
+    def parse_file(cls, fn, workers=1):
+        if workers == 1:
+            with open(fn) as f, stats.stage('parse_journal'):
+                return cls.parse_lines(f)
+        with open(fn, 'rb') as f:
+            data = f.read()
+        with stats.stage('parse_journal'):
+            return cls.parse_bytes(data, workers)
 
-        return False
+    @classmethod
+    def parse_bytes(cls, data, workers=1):
+        """
+        Parses the contents of a journal file, split across workers
+        processes (None for one per CPU) if it is large enough to be worth it
+        """
+        workers = workers or os.cpu_count()
+        if workers == 1 or len(data) < parallel_min_bytes:
+            return cls.parse_lines(TextIOWrapper(BytesIO(data)))
+        return cls.parse_parallel(data, workers)
+
+    @classmethod
+    def parse_parallel(cls, data, workers=None):
+        """
+        Parses data in chunks that end on blank lines, one process per
+        chunk, then joins them in file order.  Transactions never span a
+        blank line, so each chunk parses exactly as it would in place.
+        """
+        workers = workers or os.cpu_count()
+        ranges = chunk_ranges(data, workers * chunks_per_worker)
+        stats.count('parse_chunks', len(ranges))
+        with ProcessPoolExecutor(workers) as executor, paused_gc():
+            # results arrive in order, so earlier chunks are joined while
+            # later ones are still being parsed
+            snapshots = executor.map(parse_chunk, [data[start:end] for start, end in ranges])
+            return cls.join(cls.from_snapshot(marshal.loads(snapshot)) for snapshot in snapshots)
 
     @classmethod
-    def parse_file(cls, fn):
+    def parse_lines(cls, lines):
         transactions = []
         by_quantity = defaultdict(list)
         accounts = set()
-        description_map = defaultdict(list)
+        description_map = DescriptionMap()
         regexes = []
         prices = []
         commodities = []
+        includes = []
 
         trans = None
 
-        account_re = re.compile('^account')
-        date_desc_re = re.compile('^\d')
-        posting_re = re.compile('^\s+\S+')
-        price_re = re.compile('^P\s.+')
-        commodity_re = re.compile('^commodity\s.+')
-        regex_comment_re = re.compile('^\s*;.*/.+/')
-        comment_re = re.compile('^\s*;')
-
-        with open(fn) as f:
-            for line in f.readlines():
-                line = line.rstrip()
-                if re.match(account_re, line):
-                    accounts.add(line.split(' ', 1)[1].strip())
-                elif re.match(date_desc_re, line):
-                    trans = Transaction()
-                    parts = line.split(' ', 1)
-                    trans.date = datetime.strptime(parts[0], '%Y/%m/%d')
-                    trans.desc = parts[1]
-                elif re.match(regex_comment_re, line):
-                    regexes.append(AccountRegEx.parse(line))
-                elif re.match(price_re, line):
-                    parts = line.split()
-                    date = datetime.strptime(parts[1], '%Y/%m/%d')
-                    commodity = parts[3]
-                    value = Decimal(parts[4].lstrip('$'))
-                    prices.append(Price(date, commodity, value))
-                elif re.match(commodity_re, line):
-                    parts = line.split()
-                    name = parts[1]
-                    commodities.append(Commodity(name))
-                elif re.match(comment_re, line):
-                    pass # ignore
-                elif re.match(posting_re, line):
-                    posting = Posting()
-                    parts = [p.strip(' $') for p in line.split()]
-
-                    # ACCT  QUANTITY COMMODITY @ $UNIT_PRICE'
-                    if '@' in line:
-                        # account might have spaces in it
-                        posting.account = ' '.join(parts[:-4])
-                        posting.quantity = Decimal(parts[-4])
-                        posting.commodity = parts[-3]
-                        posting.unit_price = Decimal(parts[-1])
-
-                    # ACCT $QUANTITY
-                    elif '$' in line:
-                        # account might have spaces in it
-                        posting.account = ' '.join(parts[:-1])
-                        posting.quantity = Decimal(parts[-1])
-
-                    # ACCT  QUANTITY COMMODITY
-                    elif '  ' in line.lstrip():
-                        # account might have spaces in it
-                        posting.account = ' '.join(parts[:-2])
-                        posting.quantity = Decimal(parts[-2])
-                        posting.commodity = parts[-1]
-
-                    #  ACCT
-                    else:
-                        # account might have spaces in it
-                        posting.account = ' '.join(parts)
-
-                    trans.postings.append(posting)
-                elif not line.strip():
-                    if trans:
-                        transactions.append(trans)
-                        by_quantity[trans.total].append(trans)
-                    trans = None
+        for line in lines:
+            line = line.rstrip()
+            if not line:
+                if trans:
+                    transactions.append(trans)
+                    by_quantity[trans.total].append(trans)
+                trans = None
+                continue
+
+            # the first character decides the line type; only comments
+            # need a second look to tell regex rules from plain comments
+            kind = line_kinds.get(line[0])
+            if kind is None and line[0].isspace():
+                kind = INDENTED
+
+            if kind is INDENTED:
+                stripped = line.lstrip()
+                if stripped[0] == ';':
+                    if trans is not None:
+                        # a comment on the transaction, never a regex rule
+                        continue
+                    kind = COMMENT
                 else:
-                    raise Exception('unexpected line: %r' % line)
+                    trans.postings.append(Posting.parse(line, stripped))
+                    continue
+
+            if kind is COMMENT:
+                if regex_comment_re.match(line):
+                    regexes.append(AccountRegEx.parse(line))
+            elif kind is DATE_DESC:
+                parts = line.split(' ', 1)
+                trans = Transaction(parse_date(parts[0]), parts[1])
+            elif kind is ACCOUNT and line.startswith('account'):
+                accounts.add(line.split(' ', 1)[1].strip())
+            elif kind is PRICE and len(line) > 2 and line[1].isspace():
+                parts = line.split()
+                date = parse_date(parts[1])
+                commodity = parts[3]
+                value = Decimal(parts[4].lstrip('$'))
+                prices.append(Price(date, commodity, value))
+            elif kind is COMMODITY and len(line) > 10 and \
+                line.startswith('commodity') and line[9].isspace():
+                parts = line.split()
+                name = parts[1]
+                commodities.append(Commodity(name))
+            elif kind is INCLUDE and line.startswith('include') and line[7:8].isspace():
+                includes.append(line[7:].strip())
+            else:
+                raise Exception('unexpected line: %r' % line)
 
         for trans in transactions:
             if trans.desc not in Journal.ignore_descs:
-                description_map[trans.desc] += [p.account for p in trans.postings]
+                for p in trans.postings:
+                    description_map.add(trans.desc, p.account, trans.date)
 
         return Journal(transactions, by_quantity, accounts, description_map, regexes,
-            prices, commodities)
+            prices, commodities, includes)
+
+@contextmanager
+def paused_gc():
+    """
+    Turns off the cyclic garbage collector while building many objects
+    that have no cycles, so it does not walk them over and over
+    """
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+def chunk_ranges(data, count):
+    "Splits data into at most count (start, end) ranges that end after blank lines"
+    ranges = []
+    start = 0
+    for i in range(1, count):
+        match = blank_line_re.search(data, max(start, len(data) * i // count))
+        if match is None:
+            break
+        ranges.append((start, match.end()))
+        start = match.end()
+    ranges.append((start, len(data)))
+    return ranges
+
+def parse_chunk(data):
+    "Runs in a worker process; returns the marshalled snapshot of a journal chunk"
+    with paused_gc():
+        return marshal.dumps(Journal.parse_lines(TextIOWrapper(BytesIO(data))).snapshot())
+
+def places(value):
+    "Number of decimal places in value"
+    if isinstance(value, int):
+        return 0
+    return max(0, -value.as_tuple().exponent)
+
+def to_units(value, scale):
+    "value as an integer count of 10**-scale, or None if it has more places"
+    if isinstance(value, int):
+        return value * 10**scale
+    units = value.scaleb(scale)
+    if units != units.to_integral_value():
+        return None
+    return int(units)
+
+def cache_path(fn):
+    return fn + '.cache'
+
+def cache_key(data, mtime_ns):
+    "Identifies the contents of a file for its sidecar caches"
+    return (CACHE_VERSION, len(data), mtime_ns, sha1(data).hexdigest())
+
+def read_cache(fn, key):
+    "Returns the cached Journal if its key matches, otherwise None"
+    return read_snapshot(fn, key, Journal.from_snapshot)
+
+def write_cache(fn, key, journal):
+    write_snapshot(fn, key, journal.snapshot())
+
+def read_snapshot(fn, key, load):
+    "Returns load(snapshot) for the snapshot in fn if its key matches, otherwise None"
+    try:
+        with open(fn, 'rb') as f:
+            data = f.read()
+        # 4 byte length of the marshalled key, the key, then the snapshot
+        key_end = 4 + int.from_bytes(data[:4], 'little')
+        if marshal.loads(data[4:key_end]) != key:
+            return None
+        return load(marshal.loads(memoryview(data)[key_end:]))
+    except Exception:
+        # missing, truncated or written by an incompatible version
+        return None
+
+def write_snapshot(fn, key, snapshot):
+    tmp_fn = fn + '.tmp'
+    try:
+        with open(tmp_fn, 'wb') as f:
+            key_data = marshal.dumps(key)
+            f.write(len(key_data).to_bytes(4, 'little'))
+            f.write(key_data)
+            marshal.dump(snapshot, f)
+            stats.count('cache_bytes_written', f.tell())
+        os.replace(tmp_fn, fn)
+    except OSError:
+        # the cache is only an optimization
+        pass
@@ -1,45 +1,133 @@
 import csv
-from datetime import datetime
 from decimal import Decimal
+from heapq import merge
+from itertools import islice
+import locale
+import os
+import pickle
 import re
+import tempfile
 
+from dates import parse_date
 from import_model import Posting, Transaction
 
+def read_lines_backwards(fn, start=0, block_size=1 << 16):
+    """
+    Yields the lines of fn after byte offset start, last line first, reading
+    block_size bytes at a time from the end of the file
+    """
+    encoding = locale.getpreferredencoding(False)
+    with open(fn, 'rb') as f:
+        position = f.seek(0, os.SEEK_END)
+        # the start of the earliest line read so far, which may be partial
+        partial = b''
+        while position > start:
+            size = min(block_size, position - start)
+            position -= size
+            f.seek(position)
+            lines = (f.read(size) + partial).split(b'\n')
+            partial = lines.pop(0)
+            for line in reversed(lines):
+                yield line.rstrip(b'\r').decode(encoding)
+        if partial:
+            yield partial.rstrip(b'\r').decode(encoding)
+
+def spill(items):
+    "Writes items to a temporary file and returns a generator reading them back"
+    f = tempfile.TemporaryFile()
+    for item in items:
+        pickle.dump(item, f, pickle.HIGHEST_PROTOCOL)
+    f.seek(0)
+
+    def read():
+        with f:
+            while True:
+                try:
+                    yield pickle.load(f)
+                except EOFError:
+                    return
+    return read()
+
+def external_sort(items, key, chunk_size):
+    """
+    Yields items in the same order as sorted(items, key=key) while holding at
+    most chunk_size of them in memory; longer inputs are sorted in runs that
+    are spilled to temporary files and merged
+    """
+    items = iter(items)
+    runs = []
+    while True:
+        chunk = sorted(islice(items, chunk_size), key=key)
+        if not chunk:
+            break
+        if len(chunk) < chunk_size and not runs:
+            # everything fit in memory
+            yield from chunk
+            return
+        runs.append(spill(chunk))
+    # merge takes from earlier runs first on ties, keeping the sort stable
+    yield from merge(*runs, key=key)
+
 class Parser(object):
     first_header_fields = {}
     field_counts = None
     header_offset = 0
     delimiter = ','
+    # exports that list the newest transaction first are read from the end
+    newest_first = False
+    # when set, rows are sorted by sort_key(parts) before making transactions
+    sort_key = None
+    # rows held in memory at once when sorting
+    sort_chunk_size = 100000
+    block_size = 1 << 16
+
+    @classmethod
+    def iter_lines(cls, fn):
+        "Yields the lines after header_offset, oldest first"
+        if cls.newest_first:
+            with open(fn, 'rb') as f:
+                for _ in range(cls.header_offset):
+                    f.readline()
+                start = f.tell()
+            for line in read_lines_backwards(fn, start, cls.block_size):
+                # the last line of a quoted field with embedded newlines has an
+                # odd number of quotes and is read before the rest of the field
+                if line.count('"') % 2:
+                    raise Exception('Quoted field spans lines in {}, which cannot be read backwards'.format(fn))
+                yield line
+        else:
+            with open(fn) as f:
+                yield from islice(f, cls.header_offset, None)
+
+    @classmethod
+    def iter_rows(cls, fn):
+        rows = csv.reader(cls.iter_lines(fn), delimiter=cls.delimiter)
+        if cls.sort_key is not None:
+            rows = external_sort(rows, cls.sort_key, cls.sort_chunk_size)
+        return rows
 
     @classmethod
-    def reorder(cls, items):
-        # noop
-        return items
+    def iter_transactions(cls, fn):
+        "Yields the transactions in fn one at a time, oldest first"
+        for parts in cls.iter_rows(fn):
+            if parts and\
+               parts[0] not in cls.first_header_fields and\
+               (cls.field_counts is None or len(parts) in cls.field_counts):
+                yield from cls.make_transactions(parts)
 
     @classmethod
     def parse_file(cls, fn):
-        with open(fn) as f:
-            reader = csv.reader(f, delimiter=cls.delimiter)
-            transactions = []
-            for parts in cls.reorder(list(reader)[cls.header_offset:]):
-                if parts and\
-                   parts[0] not in cls.first_header_fields and\
-                   (cls.field_counts is None or len(parts) in cls.field_counts):
-                    transactions.extend(cls.make_transactions(parts))
-            return transactions
+        return list(cls.iter_transactions(fn))
 
 class NecuParser(Parser):
     first_header_fields = {'Account Designator'}
     account = 'Assets:NECU:Checking'
-
-    @classmethod
-    def reorder(cls, items):
-        return reversed(items)
+    newest_first = True
 
     @classmethod
     def make_transactions(cls, parts):
         desc = parts[3].strip('"')
-        date = datetime.strptime(parts[1], '%m/%d/%y')
+        date = parse_date(parts[1], '%m/%d/%y')
         quantity = Decimal(parts[4])
         if parts[5] == 'DR':
             quantity *= -1
@@ -61,22 +149,19 @@ class UsBankParser(Parser):
     @classmethod
     def make_transactions(cls, parts):
         desc = parts[2].strip('"')
-        date = datetime.strptime(parts[0], '%m/%d/%Y')
+        date = parse_date(parts[0], '%m/%d/%Y')
         quantity = Decimal(cls.trunc(parts[4]))
         posting = Posting(account='Liabilities:Credit Cards:U.S. Bank', quantity=quantity)
         return [Transaction(date=date, desc=desc, postings=[posting])]
 
 class AllyParser(Parser):
     first_header_fields = {'Date'}
-
-    @classmethod
-    def reorder(cls, items):
-        return reversed(items)
+    newest_first = True
 
     @classmethod
     def make_transactions(cls, parts):
         desc = parts[4].strip('"')
-        date = datetime.strptime(parts[0], '%Y-%m-%d')
+        date = parse_date(parts[0], '%Y-%m-%d')
         quantity = Decimal(parts[2])
         posting = Posting(account=cls.account, quantity=quantity)
         return [Transaction(date=date, desc=desc, postings=[posting])]
@@ -135,15 +220,19 @@ class WellsFargoParser(Parser):
     }
 
     previous_transfer = None
+    newest_first = True
 
     @classmethod
-    def reorder(cls, items):
-        return reversed(items)
+    def iter_transactions(cls, fn):
+        # transfer pairs never span files, and a worker process may parse
+        # several files
+        cls.previous_transfer = None
+        return super(WellsFargoParser, cls).iter_transactions(fn)
 
     @classmethod
     def make_transactions(cls, parts):
         trans_type = parts[2]
-        date = datetime.strptime(parts[0], '%Y%m%d')
+        date = parse_date(parts[0], '%Y%m%d')
         quantity = Decimal(parts[4])
         unit_price = Decimal(parts[5].lstrip('$'))
         total = quantity * unit_price
@@ -221,19 +310,16 @@ class BpasParser(Parser):
         'Termination': 'Assets:Vanguard:CTC IRA',
     }
 
-    @classmethod
-    def reorder(cls, items):
-        return sorted(
-            items,
-            key=lambda x: datetime.strptime(x[0], '%m/%d/%Y')
-        )
+    @staticmethod
+    def sort_key(parts):
+        return parse_date(parts[0], '%m/%d/%Y')
 
     @classmethod
     def make_transactions(cls, parts):
         # 04/14/2016  VANGUARD 500 INDEX ADMIRAL SER  Contribution  N/A EMPLOYEE PRETAX 1.5475    $192.28   $297.56
         parts = [part for part in parts if part]
         trans_type = parts[-7]
-        date = datetime.strptime(parts[0], '%m/%d/%Y')
+        date = parse_date(parts[0], '%m/%d/%Y')
         unit_price = Decimal(parts[-2].lstrip('$'))
         total = Decimal(parts[-1].replace('$', '').replace(',', ''))
         if parts[-3] == 'NaN':
@@ -295,15 +381,13 @@ class TiaaCrefParser(Parser):
         'Plan Servicing Credit': 'Expenses:Retirement Account Fees',
     }
 
-    @classmethod
-    def reorder(cls, items):
-        return reversed(items)
+    newest_first = True
 
     @classmethod
     def make_transactions(cls, parts):
         # 4/8/2016,380737G1 GR1001 102136,Buy,CREF Equity Index R3,162.4489,2.4237,393.73,Contribution
         trans_type = parts[7]
-        date = datetime.strptime(parts[0], '%m/%d/%Y')
+        date = parse_date(parts[0], '%m/%d/%Y')
         quantity = Decimal(parts[5])
         unit_price = Decimal(parts[4])
         total = quantity * unit_price
@@ -385,7 +469,7 @@ class VanguardParser(Parser):
         if trans_type == 'Dividend' or trans_type.startswith('Capital gain'):
             return []
 
-        date = datetime.strptime(parts[2], '%m/%d/%Y')
+        date = parse_date(parts[2], '%m/%d/%Y')
         quantity = Decimal(parts[7])
         unit_price = Decimal(parts[8])
         total = quantity * unit_price
@@ -438,16 +522,13 @@ class CtcVanguardParser(VanguardParser):
 class CtcIraVanguardParser(Parser):
     account = 'Assets:Vanguard:CTC IRA'
     header_offset = 7
-
-    @classmethod
-    def reorder(cls, items):
-        return reversed(items)
+    newest_first = True
 
     @classmethod
     def make_transactions(cls, parts):
         # 34549708,10/11/2016,10/12/2016,Buy,Buy,VANGUARD TARGET RETIREMENT 2045 INVESTOR CL,VTIVX,1244.048,18.83,-23425.43,0.0,-23425.43,0.0,Cash,
         trans_type = parts[3]
-        date = datetime.strptime(parts[2], '%m/%d/%Y')
+        date = parse_date(parts[2], '%m/%d/%Y')
         quantity = Decimal(parts[7]) if parts[7] else 0
         #unit_price = Decimal(parts[8])
         total = Decimal(parts[9])
@@ -507,14 +588,12 @@ class FidelityParser(Parser):
         'Withdrawals': 'Income:Retirement Withdrawals',
     }
 
-    @classmethod
-    def reorder(cls, items):
-        return reversed(items)
+    newest_first = True
 
     @classmethod
     def make_transactions(cls, parts):
         # 11/02/2016,VANG TARGET RET 2045,CONTRIBUTION,"980.00","52.887"
-        date = datetime.strptime(parts[0], '%m/%d/%Y')
+        date = parse_date(parts[0], '%m/%d/%Y')
         trans_type = parts[2]
 
         if trans_type == 'REALIZED G/L':
@@ -564,18 +643,36 @@ class FidelityParser(Parser):
 class KennebunkParser(Parser):
     first_header_fields = {'Account'}
     account = 'Assets:Kennebunk:Checking'
-
-    @classmethod
-    def reorder(cls, items):
-        return reversed(items)
+    newest_first = True
 
     @classmethod
     def make_transactions(cls, parts):
         desc = parts[6].strip('"')
-        date = datetime.strptime(parts[5], '%m/%d/%Y')
+        date = parse_date(parts[5], '%m/%d/%Y')
         if parts[2]:
             quantity = -1 * Decimal(parts[2])
         else:
             quantity = Decimal(parts[3])
         posting = Posting(account=cls.account, quantity=quantity)
         return [Transaction(date=date, desc=desc, postings=[posting])]
+
+parsers = {
+    'allymoneymarket': AllyMoneyMarketParser,
+    'allysavings': AllyOnlineSavingsParser,
+    'allycd1': AllyCD1Parser,
+    'allycd2': AllyCD2Parser,
+    'allycd3': AllyCD3Parser,
+    'allycd4': AllyCD4Parser,
+    'allycd5': AllyCD5Parser,
+    'bpas': BpasParser,
+    'necu': NecuParser,
+    'necusilver': NecuSilverLiningParser,
+    'tiaa': TiaaCrefParser,
+    'usbank': UsBankParser,
+    'vanguard-amm': AmmVanguardParser,
+    'vanguard-ctc': CtcVanguardParser,
+    'vanguard-ctc-ira': CtcIraVanguardParser,
+    'wellsfargo': WellsFargoParser,
+    'fidelity': FidelityParser,
+    'kennebunk': KennebunkParser,
+}
@@ -0,0 +1,88 @@
+from collections import defaultdict
+import os
+from time import perf_counter
+
+def cpu_time():
+    "CPU seconds used by this process and by the child processes it has waited for"
+    times = os.times()
+    return times.user + times.system + times.children_user + times.children_system
+
+def size_summary(sizes):
+    sizes = list(sizes)
+    return {
+        'count': len(sizes),
+        'total': sum(sizes),
+        'max': max(sizes) if sizes else 0,
+        'mean': sum(sizes) / float(len(sizes)) if sizes else 0,
+    }
+
+class Stage(object):
+    "Context manager that adds its wall and CPU time to a stage of Stats"
+    __slots__ = ('stats', 'name', 'wall', 'cpu')
+
+    def __init__(self, stats, name):
+        self.stats = stats
+        self.name = name
+        self.wall = None
+
+    def __enter__(self):
+        if self.stats.enabled:
+            self.wall = perf_counter()
+            self.cpu = cpu_time()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.wall is not None:
+            self.stats.add_time(self.name, perf_counter() - self.wall, cpu_time() - self.cpu)
+            self.wall = None
+
+class Stats(object):
+    """
+    Wall and CPU time per named stage plus event counters, for finding
+    where an import spends its time.  Nothing is recorded unless enabled.
+    Stages may nest, so their times overlap rather than add up.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.reset()
+
+    def reset(self):
+        # name -> [calls, wall seconds, cpu seconds]
+        self.stages = {}
+        self.counters = defaultdict(int)
+        # name -> summary recorded once, like index sizes
+        self.values = {}
+
+    def stage(self, name):
+        return Stage(self, name)
+
+    def add_time(self, name, wall, cpu):
+        totals = self.stages.get(name)
+        if totals is None:
+            totals = self.stages[name] = [0, 0.0, 0.0]
+        totals[0] += 1
+        totals[1] += wall
+        totals[2] += cpu
+
+    def count(self, name, n=1):
+        if self.enabled:
+            self.counters[name] += n
+
+    def set(self, name, value):
+        if self.enabled:
+            self.values[name] = value
+
+    def report(self):
+        "Everything recorded, as JSON-serializable builtin types"
+        return {
+            'stages': dict(
+                (name, {'calls': calls, 'wall': wall, 'cpu': cpu})
+                for name, (calls, wall, cpu) in self.stages.items()
+            ),
+            'counters': dict(self.counters),
+            'values': dict(self.values),
+        }
+
+# shared by every module so one report covers the whole run
+stats = Stats()
@@ -0,0 +1,195 @@
+from bisect import bisect_right
+from collections import defaultdict
+from contextlib import contextmanager
+import os
+import re
+import shutil
+import tempfile
+
+from io import StringIO
+
+from dates import parse_date
+from import_model import Journal, cache_key, cache_path, write_cache
+from instrumentation import stats
+
+# regex rule lines as AccountRegEx writes them; unlike the parser this
+# skips indented comments, which may be inside transactions
+rule_line_re = re.compile('^;.*/.+/')
+
+@contextmanager
+def atomic_write(fn):
+    "Yields a file that replaces fn only once it has been completely written"
+    fd, tmp_fn = tempfile.mkstemp(
+        dir=os.path.dirname(os.path.abspath(fn)),
+        prefix='.'+os.path.basename(fn),
+        suffix='.tmp'
+    )
+    try:
+        with os.fdopen(fd, 'w', newline='') as f:
+            yield f
+            f.flush()
+            os.fsync(f.fileno())
+        if os.path.exists(fn):
+            shutil.copymode(fn, tmp_fn)
+        os.replace(tmp_fn, fn)
+    except BaseException:
+        os.unlink(tmp_fn)
+        raise
+
+def splice(lines, journal):
+    """
+    Returns lines with the journal's unsaved accounts, regexes and
+    transactions inserted where a full rewrite would put them, or None
+    when lines lack a section to insert into.
+    """
+    newline = '\r\n' if lines and lines[0].endswith('\r\n') else '\n'
+    # line index -> text to insert before that line
+    inserts = defaultdict(list)
+
+    accounts = journal.unsaved_accounts()
+    if accounts:
+        account_lines = [i for i, line in enumerate(lines) if line.startswith('account')]
+        if not account_lines:
+            return None
+        # existing accounts are written in sorted order
+        names = [lines[i].split(' ', 1)[1].strip() for i in account_lines]
+        for account in accounts:
+            n = bisect_right(names, account)
+            at = account_lines[n] if n < len(names) else account_lines[-1] + 1
+            inserts[at].append('account {}\n'.format(account))
+
+    regexes = journal.unsaved_regexes()
+    if regexes:
+        regex_lines = [i for i, line in enumerate(lines) if rule_line_re.match(line)]
+        if not regex_lines:
+            return None
+        # later regexes take priority, so new ones go last
+        inserts[regex_lines[-1] + 1].extend(str(regex)+'\n' for regex in regexes)
+
+    transactions = sorted(journal.unsaved_transactions(), key=lambda t: t.date)
+    if transactions:
+        # appended transactions need a blank line before them
+        tail = []
+        if lines and not lines[-1].endswith('\n'):
+            tail.append('\n')
+        if lines and lines[-1].strip():
+            tail.append('\n')
+
+        # dates and first lines of the paragraphs (including any leading
+        # comments) that hold each existing transaction
+        dates = []
+        starts = []
+        start = 0
+        for i, line in enumerate(lines):
+            if not line.strip():
+                start = i + 1
+            elif line[0] in '0123456789':
+                dates.append(parse_date(line.split(' ', 1)[0]))
+                starts.append(start)
+
+        for trans in transactions:
+            # after existing transactions on the same date, like a stable sort
+            n = bisect_right(dates, trans.date)
+            if n < len(starts):
+                inserts[starts[n]].append(str(trans)+'\n')
+            else:
+                inserts[len(lines)].extend(tail)
+                inserts[len(lines)].append(str(trans)+'\n')
+                tail = []
+
+    spliced = []
+    for i, line in enumerate(lines + ['']):
+        for text in inserts.get(i, []):
+            spliced.append(text.replace('\n', newline))
+        spliced.append(line)
+    return spliced
+
+def spliced_journal(journal, lines):
+    """
+    The Journal that parsing splice(lines, journal) would give, without
+    parsing lines again: the additions are parsed from their text and put
+    where splice puts them.  None if lines hold transactions that journal
+    does not (one missing the blank line that ends it, say).
+    """
+    saved = journal.transactions[:journal.saved_transaction_count]
+    if sum(1 for line in lines if line[:1].isdigit()) != len(saved):
+        return None
+    added = Journal.parse_lines(StringIO(''.join(
+        ['account {}\n'.format(account) for account in journal.unsaved_accounts()] +
+        [str(regex)+'\n' for regex in journal.unsaved_regexes()] +
+        ['\n'] +
+        [str(trans)+'\n' for trans in sorted(journal.unsaved_transactions(), key=lambda t: t.date)]
+    )))
+
+    # before the first existing transaction dated later, as splice does
+    dates = [trans.date for trans in saved]
+    inserts = defaultdict(list)
+    for trans in added.transactions:
+        inserts[bisect_right(dates, trans.date)].append(trans)
+    transactions = []
+    for i, trans in enumerate(saved):
+        transactions.extend(inserts.get(i, ()))
+        transactions.append(trans)
+    transactions.extend(inserts.get(len(saved), ()))
+
+    # indexed as parse_lines indexes them
+    spliced = Journal(
+        accounts=journal.saved_accounts | added.accounts,
+        regexes=journal.regexes[:journal.saved_regex_count] + added.regexes,
+        prices=list(journal.prices),
+        commodities=list(journal.commodities),
+        includes=list(journal.includes),
+    )
+    for trans in transactions:
+        spliced.transactions.append(trans)
+        spliced.by_quantity[trans.total].append(trans)
+        if trans.desc not in Journal.ignore_descs:
+            for p in trans.postings:
+                spliced.description_map.add(trans.desc, p.account, trans.date)
+    return spliced
+
+def refresh_cache(fn, journal):
+    "Caches journal as what fn, which was just written, parses to"
+    with open(fn, 'rb') as f, stats.stage('write_cache'):
+        key = cache_key(f.read(), os.fstat(f.fileno()).st_mtime_ns)
+        write_cache(cache_path(fn), key, journal)
+
+def write_journal(journal, source_fn, output_fn=None, cache=False):
+    """
+    Writes journal to output_fn (default source_fn), keeping the bytes of
+    source_fn for everything that has not changed since it was read.  With
+    cache, a spliced journal's sidecar cache is rewritten to match, so the
+    next load need not parse it.  Returns False when there was nothing to
+    write.
+    """
+    output_fn = output_fn or source_fn
+    if output_fn == source_fn and not journal.has_changes():
+        return False
+
+    try:
+        with open(source_fn, newline='') as f:
+            lines = f.readlines()
+    except FileNotFoundError:
+        lines = None
+    with stats.stage('splice'):
+        spliced = splice(lines, journal) if lines is not None else None
+    reread = None
+    if cache and spliced is not None and output_fn == source_fn:
+        with stats.stage('spliced_journal'):
+            reread = spliced_journal(journal, lines)
+
+    with stats.stage('write'):
+        with atomic_write(output_fn) as f:
+            if spliced is None:
+                stats.count('full_rewrites')
+                journal.write_to(f)
+            else:
+                f.writelines(spliced)
+    stats.count('bytes_written', os.path.getsize(output_fn))
+
+    if reread is not None:
+        refresh_cache(output_fn, reread)
+
+    if output_fn == source_fn:
+        journal.mark_saved()
+    return True
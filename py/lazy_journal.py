@@ -0,0 +1,224 @@
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import defaultdict
+from datetime import timedelta
+from heapq import merge
+from io import StringIO
+import mmap
+import os
+import re
+
+from dates import parse_date
+from import_model import (DescriptionMap, Journal, Posting, blank_line_re, cache_key,
+    read_snapshot, write_snapshot)
+from instrumentation import stats
+
+# first lines of transactions, and the date that starts them
+date_line_re = re.compile(rb'^(\d\S*) ', re.M)
+# account, commodity, price and comment lines
+directive_re = re.compile(rb'^[^\d \t\r\n][^\n]*', re.M)
+
+def transaction_blocks(data):
+    "(start, end, date) of each transaction in the bytes of a journal file"
+    for match in date_line_re.finditer(data):
+        blank = blank_line_re.search(data, match.end())
+        if blank is None:
+            # like parse_lines, a transaction needs a blank line after it
+            break
+        yield match.start(), blank.start() + 1, parse_date(match.group(1).decode('utf-8'))
+
+def scan_descriptions(data, additions=None):
+    """
+    The DescriptionMap parse_lines would build from data, read from just
+    the descriptions and posting accounts of its transactions.  Each
+    addition to it is also appended to additions, if given, as desc,
+    account and date ordinal.
+    """
+    description_map = DescriptionMap()
+    for start, end, date in transaction_blocks(data):
+        lines = data[start:end].decode('utf-8').split('\n')
+        desc = lines[0].rstrip().split(' ', 1)[1]
+        if desc in Journal.ignore_descs:
+            continue
+        for line in lines[1:]:
+            line = line.rstrip()
+            if not line or not line[0].isspace():
+                continue
+            stripped = line.lstrip()
+            if stripped[0] != ';':
+                account = Posting.parse_account(line, stripped)
+                description_map.add(desc, account, date)
+                if additions is not None:
+                    additions.extend((desc, account, date.toordinal()))
+    return description_map
+
+def description_cache_path(fn):
+    return fn + '.descs'
+
+def load_description_map(fn, data=None, mtime_ns=None):
+    """
+    The description map of fn's transactions, from the sidecar when it
+    still matches the file, otherwise scanned from data (fn's contents,
+    read if None) and saved to the sidecar
+    """
+    if data is None:
+        with open(fn, 'rb') as f:
+            mtime_ns = os.fstat(f.fileno()).st_mtime_ns
+            data = f.read()
+    key = cache_key(data, mtime_ns)
+    with stats.stage('read_description_cache'):
+        description_map = read_snapshot(
+            description_cache_path(fn), key, DescriptionMap.from_snapshot)
+    if description_map is None:
+        stats.count('description_cache_misses')
+        with stats.stage('scan_descriptions'):
+            description_map = scan_descriptions(data)
+        write_snapshot(description_cache_path(fn), key, description_map.snapshot())
+    return description_map
+
+class LazyJournal(Journal):
+    """
+    A Journal over a memory-mapped ledger file that only builds the
+    transactions it is asked about.  Opening it parses the account,
+    commodity, price and regex lines in full, but for transactions only
+    records where each one starts and ends and its date.  already_imported
+    and is_mirror_trans decode just the dates they look at, so an import of
+    recent statements leaves older years as bytes.  The description map
+    comes from a sidecar, or failing that from reading just descriptions
+    and accounts (see load_description_map).  Asking for all transactions
+    or an index over everything (the balance engine, say) decodes the
+    whole file.
+
+    Writing goes through journal_writer.write_journal as usual; the splice
+    only needs the unsaved additions.
+    """
+
+    def __init__(self, fn):
+        self.fn = fn
+        with open(fn, 'rb') as f:
+            stat = os.fstat(f.fileno())
+            size = stat.st_size
+            self.mtime_ns = stat.st_mtime_ns
+            # an empty file cannot be mapped
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if size else b''
+
+        with stats.stage('scan_journal'):
+            self.scan()
+            header = Journal.parse_lines(
+                line.decode('utf-8') for line in directive_re.findall(self.data)
+            )
+        if header.includes:
+            raise Exception('{} includes other files; load it without --lazy'.format(fn))
+        self.accounts = header.accounts
+        self.commodities = header.commodities
+        self.prices = header.prices
+        self.regexes = header.regexes
+
+        # block index -> Transaction, once decoded
+        self.decoded = [None] * len(self.starts)
+        # blocks at sorted positions from here on are all decoded
+        self.decoded_from = len(self.order)
+        # decoded and added transactions by total, as in Journal
+        self.by_quantity = defaultdict(list)
+        # added by add_transaction, so not among the blocks
+        self.added = []
+        self._description_map = None
+        self.mark_saved()
+
+    def scan(self):
+        "Records the byte range and date of every transaction block"
+        self.starts = array('q')
+        self.ends = array('q')
+        self.ordinals = array('l')
+        for start, end, date in transaction_blocks(self.data):
+            self.starts.append(start)
+            self.ends.append(end)
+            self.ordinals.append(date.toordinal())
+        # block indexes by date, in file order for the same date
+        self.order = sorted(range(len(self.starts)), key=self.ordinals.__getitem__)
+        self.sorted_ordinals = [self.ordinals[i] for i in self.order]
+
+    def positions(self, first=None, last=None):
+        "The range of sorted positions dated first through last; None is unbounded"
+        low = 0 if first is None else bisect_left(self.sorted_ordinals, first.toordinal())
+        high = len(self.order) if last is None else \
+            bisect_right(self.sorted_ordinals, last.toordinal())
+        return low, high
+
+    def decode(self, first=None, last=None):
+        "Builds the transactions dated first through last that are not built yet"
+        low, high = self.positions(first, last)
+        if low >= self.decoded_from:
+            return
+        blocks = sorted(i for i in self.order[low:high] if self.decoded[i] is None)
+        if blocks:
+            self.decode_blocks(blocks)
+        if high >= self.decoded_from:
+            self.decoded_from = low
+
+    def decode_blocks(self, blocks):
+        "Parses the blocks with these indexes, which are in file order"
+        with stats.stage('decode_transactions'):
+            data = self.data
+            text = b'\n'.join(data[self.starts[i]:self.ends[i]] for i in blocks) + b'\n'
+            transactions = Journal.parse_lines(StringIO(text.decode('utf-8'))).transactions
+        if len(transactions) != len(blocks):
+            raise Exception('{}: expected {} transactions, decoded {}'.format(
+                self.fn, len(blocks), len(transactions)))
+        stats.count('transactions_decoded', len(blocks))
+
+        for i, trans in zip(blocks, transactions):
+            self.decoded[i] = trans
+            self.include_transaction(trans)
+
+    def between(self, first=None, last=None):
+        "Transactions dated first through last by date, decoding them as needed"
+        self.decode(first, last)
+        low, high = self.positions(first, last)
+        found = [self.decoded[i] for i in self.order[low:high]]
+        added = sorted(
+            (trans for trans in self.added
+                if (first is None or trans.date >= first) and (last is None or trans.date <= last)),
+            key=lambda t: t.date
+        )
+        return list(merge(found, added, key=lambda t: t.date))
+
+    @property
+    def transactions(self):
+        "Every transaction in file order, then the added ones; decodes them all"
+        self.decode()
+        return self.decoded + self.added
+
+    def sorted_transactions(self):
+        return self.between()
+
+    @property
+    def description_map(self):
+        "As parse_lines would build it, loaded on first use without decoding anything"
+        if self._description_map is None:
+            self._description_map = load_description_map(self.fn, self.data, self.mtime_ns)
+        return self._description_map
+
+    def mark_saved(self):
+        self.saved_accounts = set(self.accounts)
+        self.saved_regex_count = len(self.regexes)
+        # added since the last save
+        self.pending = []
+
+    def unsaved_transactions(self):
+        return list(self.pending)
+
+    def add_transaction(self, trans):
+        self.added.append(trans)
+        self.pending.append(trans)
+        self.by_quantity[trans.total].append(trans)
+        self.update_indexes(trans)
+
+    def already_imported(self, trans):
+        self.decode(trans.date, trans.date)
+        return Journal.already_imported(self, trans)
+
+    def is_mirror_trans(self, trans):
+        # mirrors can be dated any time after the start of the window
+        self.decode(trans.date - timedelta(days=14))
+        return Journal.is_mirror_trans(self, trans)
@@ -1,13 +1,18 @@
 from argparse import ArgumentParser
 from cmd import Cmd
+from concurrent.futures import ProcessPoolExecutor
+import cProfile
+from itertools import chain
+import json
 import re
 
 from import_model import Journal, Transaction, Posting, AccountRegEx
-from input_parsers import (NecuParser, NecuSilverLiningParser, UsBankParser,
-    AllyMoneyMarketParser, AllyOnlineSavingsParser, AllyCD1Parser, AllyCD2Parser,
-    AllyCD3Parser, AllyCD4Parser, AllyCD5Parser, WellsFargoParser, BpasParser,
-    TiaaCrefParser, AmmVanguardParser, CtcVanguardParser, FidelityParser,
-    CtcIraVanguardParser, KennebunkParser)
+from instrumentation import stats, size_summary
+from journal_writer import write_journal
+from lazy_journal import LazyJournal
+from input_parsers import parsers
+from shards import ShardedJournal
+from sqlite_store import SqliteJournal
 
 # For tab completion in MacOS X, from:
 # https://pewpewthespells.com/blog/osx_readline.html
@@ -17,39 +22,60 @@ readline.parse_and_bind("bind ^I rl_complete")
 class LedgerImportCmd(Cmd):
     journal = None
     new_transactions = None
+    # an account to confirm, from a description that is only similar
     suggestion = None
     prompt = 'account [/regex/]: '
+    suggestion_prompt = 'account [/regex/] (enter for {}): '
 
     def get_account(self, trans):
+        with stats.stage('get_account'):
+            return self.suggest_account(trans)
+
+    def suggest_account(self, trans):
+        """
+        Returns an account to record trans with, or '' to ask the user;
+        when asking, suggestion may hold a likely account to offer
+        """
+        self.suggestion = None
         # force user to choose account
         if trans.desc in {'CHECK'}:
             return ''
 
-        possibilities = self.journal.description_map.get(trans.desc, [])
-        possibilities.extend(
-            regex.account for regex in self.journal.regexes
-            if regex.compiled.match(trans.desc)
-        )
-        already_there = [posting.account for posting in trans.postings]
-        for p in reversed(possibilities):
+        already_there = {posting.account for posting in trans.postings}
+        # regex matches take priority over accounts used with this description
+        for p in self.journal.regex_accounts(trans.desc):
             if p not in already_there:
                 return p
+        stats.count('description_map_probes')
+        for p in self.journal.description_map.candidates(trans.desc, already_there):
+            return p
+        # finally, descriptions that differ only by store numbers and the
+        # like; these are guesses, so the user confirms them
+        for p in self.journal.similar_accounts(trans.desc):
+            if p not in already_there:
+                self.suggestion = p
+                break
         return ''
 
     def record_transaction(self, trans, acct):
         if acct:
-            trans.postings.append(Posting(account=acct))
+            trans.add_posting(Posting(account=acct))
             self.journal.accounts.add(acct)
-            self.journal.add_desc_to_map(trans.desc, acct)
+            self.journal.add_desc_to_map(trans.desc, acct, trans.date)
 
         # skip if mirror transaction
-        if self.journal.is_mirror_trans(trans):
+        with stats.stage('is_mirror_trans'):
+            mirror = self.journal.is_mirror_trans(trans)
+        if mirror:
+            stats.count('mirror_transactions')
             print('###################')
             print('MIRROR TRANSACTION: \n{}'.format(trans))
             print('###################')
             return
 
-        self.journal.transactions.append(trans)
+        with stats.stage('add_transaction'):
+            self.journal.add_transaction(trans)
+        stats.count('transactions_recorded')
 
     def process_transactions(self, check_already_imported=False):
         "Returns True when there are no transactions left to process"
@@ -58,8 +84,8 @@ class LedgerImportCmd(Cmd):
             account = self.get_account(trans)
 
             # already imported?
-            if check_already_imported and self.journal.already_imported(trans):
-                pass
+            if check_already_imported and self.already_imported(trans):
+                stats.count('already_imported')
                 #print('###################')
                 #print('ALREADY ENTERED: \n{}'.format(trans))
                 #print('###################')
@@ -77,11 +103,17 @@ class LedgerImportCmd(Cmd):
             # need user input: break
             else:
                 print(trans)
+                self.prompt = self.suggestion_prompt.format(self.suggestion) \
+                    if self.suggestion else LedgerImportCmd.prompt
                 self.new_transactions.insert(0, trans)
                 return False
 
         return True
 
+    def already_imported(self, trans):
+        with stats.stage('already_imported'):
+            return self.journal.already_imported(trans)
+
     # CMD methods
     def default(self, line):
         trans = self.new_transactions.pop(0)
@@ -99,6 +131,8 @@ class LedgerImportCmd(Cmd):
         return self.process_transactions()
 
     def emptyline(self):
+        if self.suggestion:
+            return self.default(self.suggestion)
         print('Please enter an account')
 
     def completenames(self, text, line, begidx, endidx):
@@ -109,57 +143,141 @@ class LedgerImportCmd(Cmd):
         return True
 
 
+def parse_input(input_type, fn):
+    return parsers[input_type].parse_file(fn)
+
+def parse_inputs(inputs, workers=None):
+    """
+    Parses (file name, input type) pairs, several at a time in worker
+    processes, and returns all of their transactions sorted by date.
+    Parsers do not all return their rows in date order, so the sort is
+    over everything; transactions on the same date keep the order of
+    inputs and, within an input, the order the parser returned them in.
+    """
+    fns = [fn for fn, input_type in inputs]
+    input_types = [input_type for fn, input_type in inputs]
+    if len(inputs) == 1:
+        results = [parse_input(input_types[0], fns[0])]
+    else:
+        with ProcessPoolExecutor(workers) as executor:
+            results = list(executor.map(parse_input, input_types, fns))
+    return sorted(chain.from_iterable(results), key=lambda t: t.date)
+
 # FIXME: consider split transactions (use case: mortgage, auto loan payments), do this by putting quantity after account
 
 def main():
     """
     * read/parse existing journal file
-    * read/parse input file, building list of new transactions
+    * read/parse input files, building one list of new transactions
     * pass new transactions to cmd instance and enter loop
-    * when loop exists, write new journal file, to output file
+    * when loop exits, splice the changes into the journal and write it to
+      the output file
     """
-    input_parsers = {
-        'allymoneymarket': AllyMoneyMarketParser,
-        'allysavings': AllyOnlineSavingsParser,
-        'allycd1': AllyCD1Parser,
-        'allycd2': AllyCD2Parser,
-        'allycd3': AllyCD3Parser,
-        'allycd4': AllyCD4Parser,
-        'allycd5': AllyCD5Parser,
-        'bpas': BpasParser,
-        'necu': NecuParser,
-        'necusilver': NecuSilverLiningParser,
-        'tiaa': TiaaCrefParser,
-        'usbank': UsBankParser,
-        'vanguard-amm': AmmVanguardParser,
-        'vanguard-ctc': CtcVanguardParser,
-        'vanguard-ctc-ira': CtcIraVanguardParser,
-        'wellsfargo': WellsFargoParser,
-        'fidelity': FidelityParser,
-        'kennebunk': KennebunkParser,
-    }
     arg_parser = ArgumentParser(
         description='Parse financial data and add to a ledger journal.'
     )
     arg_parser.add_argument('-j', '--journal', required=True)
-    arg_parser.add_argument('-i', '--input', required=True)
+    arg_parser.add_argument('-i', '--input')
     arg_parser.add_argument('-o', '--output')
-    arg_parser.add_argument('-t', '--input-type', choices=input_parsers.keys(), required=True)
+    arg_parser.add_argument('-t', '--input-type', choices=parsers.keys())
+    arg_parser.add_argument('-b', '--batch', nargs=2, action='append', default=[],
+        metavar=('INPUT', 'INPUT_TYPE'),
+        help='another input file and its type; may be repeated')
+    arg_parser.add_argument('-w', '--workers', type=int,
+        help='processes for parsing batch inputs and, when it is not cached, a large '
+            'journal (default: one per CPU)')
+    arg_parser.add_argument('--no-cache', action='store_true',
+        help='ignore and do not write the parsed journal cache')
+    arg_parser.add_argument('--db', metavar='FILE',
+        help='keep the journal in this SQLite database, created from -j the first time; '
+            '-o then exports it as ledger text')
+    arg_parser.add_argument('--lazy', action='store_true',
+        help='map the journal into memory and only parse the transactions the import needs')
+    arg_parser.add_argument('--balances', nargs='*', metavar='ACCOUNT',
+        help='after importing, show balances of accounts starting with these (default: all)')
+    arg_parser.add_argument('--profile', metavar='REPORT',
+        help='write per-stage wall/CPU times and counters to this JSON file')
+    arg_parser.add_argument('--cprofile', metavar='FILE',
+        help='write cProfile stats for the run to this file (read with pstats)')
 
     args = arg_parser.parse_args()
 
-    cmd = LedgerImportCmd()
-    cmd.journal = Journal.parse_file(args.journal)
-    cmd.new_transactions = input_parsers[args.input_type].parse_file(args.input)
+    inputs = []
+    if args.input or args.input_type:
+        if not (args.input and args.input_type):
+            arg_parser.error('-i/--input and -t/--input-type go together')
+        inputs.append((args.input, args.input_type))
+    for fn, input_type in args.batch:
+        if input_type not in parsers:
+            arg_parser.error('unknown input type: {}'.format(input_type))
+        inputs.append((fn, input_type))
+    if not inputs:
+        arg_parser.error('nothing to import; use -i/-t or -b')
+    if args.lazy and args.db:
+        arg_parser.error('--lazy and --db do not go together')
 
-    if not cmd.process_transactions(check_already_imported=True):
-        # if process_transactions needs user input, enter command loop
-        cmd.cmdloop()
+    stats.enabled = bool(args.profile)
+    if args.cprofile:
+        profiler = cProfile.Profile()
+        profiler.runcall(run, args, inputs)
+        profiler.dump_stats(args.cprofile)
+    else:
+        run(args, inputs)
+
+    if args.profile:
+        with open(args.profile, 'w') as f:
+            json.dump(stats.report(), f, indent=2, sort_keys=True)
+
+def run(args, inputs):
+    with stats.stage('total'):
+        cmd = LedgerImportCmd()
+        with stats.stage('load_journal'):
+            if args.db:
+                cmd.journal = SqliteJournal.open(args.db, args.journal,
+                    use_cache=not args.no_cache)
+            elif args.lazy:
+                cmd.journal = LazyJournal(args.journal)
+            else:
+                cmd.journal = Journal.load(args.journal, use_cache=not args.no_cache,
+                    workers=args.workers, includes=False)
+                if cmd.journal.includes:
+                    # a root with one file per year; only the years needed are read
+                    cmd.journal = ShardedJournal(args.journal, cmd.journal,
+                        use_cache=not args.no_cache)
+        if type(cmd.journal) is Journal:
+            # the other journals only read transactions when needed
+            stats.set('journal_transactions', len(cmd.journal.transactions))
+            stats.set('by_quantity_buckets',
+                size_summary(len(matching) for matching in cmd.journal.by_quantity.values()))
+        if args.balances is not None:
+            # built before importing so each recorded transaction updates it
+            cmd.journal.balances()
+
+        # CPU time includes batch worker processes once they have exited
+        with stats.stage('parse_inputs'):
+            cmd.new_transactions = parse_inputs(inputs, args.workers)
+        stats.count('transactions_parsed', len(cmd.new_transactions))
+
+        # includes any time spent waiting for the user to choose accounts
+        with stats.stage('process_transactions'):
+            if not cmd.process_transactions(check_already_imported=True):
+                # if process_transactions needs user input, enter command loop
+                cmd.cmdloop()
+
+        with stats.stage('write_journal'):
+            if isinstance(cmd.journal, (SqliteJournal, ShardedJournal)):
+                written = cmd.journal.save()
+                if args.output:
+                    cmd.journal.export(args.output)
+            else:
+                written = write_journal(cmd.journal, args.journal, args.output,
+                    cache=type(cmd.journal) is Journal and not args.no_cache)
+        if not written:
+            print('No changes to write')
 
-    if not args.output:
-        args.output = args.journal
-    with open(args.output, 'w') as f:
-        f.write(str(cmd.journal))
+        if args.balances is not None:
+            for line in cmd.journal.balances().report(args.balances):
+                print(line)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,138 @@
+from argparse import ArgumentParser
+from bisect import bisect_right
+from collections import defaultdict
+from datetime import datetime
+from decimal import Decimal
+
+from balances import posting_amounts
+
+net_worth_prefixes = ('Assets', 'Liabilities')
+
+def month_ends(first, last):
+    "The last day of every month from first's through last's"
+    ends = []
+    year, month = first.year, first.month
+    while (year, month) <= (last.year, last.month):
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+        ends.append(datetime.fromordinal(datetime(year, month, 1).toordinal() - 1))
+    return ends
+
+def under(account, prefixes):
+    "Whether account is one of prefixes or below one of them"
+    return any(account == p or account.startswith(p + ':') for p in prefixes)
+
+class PriceIndex(object):
+    """
+    Dollar prices per commodity with their dates in sorted order, from P
+    directives and from the unit prices of postings.  Prices on the same
+    date keep the order they were added in, and the last one wins.
+    """
+
+    def __init__(self, prices=(), transactions=()):
+        # commodity -> sorted dates, and the price on each of them
+        self.dates = defaultdict(list)
+        self.values = defaultdict(list)
+
+        found = defaultdict(list)
+        for price in prices:
+            found[price.commodity].append((price.date, price.value))
+        for trans in transactions:
+            for p in trans.postings:
+                if p.unit_price:
+                    found[p.commodity].append((trans.date, p.unit_price))
+        for commodity, entries in found.items():
+            # stable, so same-day prices stay in the order they were found
+            entries.sort(key=lambda entry: entry[0])
+            self.dates[commodity] = [date for date, value in entries]
+            self.values[commodity] = [value for date, value in entries]
+
+    def add(self, date, commodity, value):
+        dates = self.dates[commodity]
+        i = bisect_right(dates, date)
+        dates.insert(i, date)
+        self.values[commodity].insert(i, value)
+
+    def add_transaction(self, trans):
+        for p in trans.postings:
+            if p.unit_price:
+                self.add(trans.date, p.commodity, p.unit_price)
+
+    def price(self, commodity, date):
+        "Dollar price of commodity as of date, or None before its first price"
+        if commodity == '$':
+            return Decimal(1)
+        i = bisect_right(self.dates.get(commodity, ()), date)
+        return self.values[commodity][i-1] if i else None
+
+    def value(self, balance, date):
+        "Dollar value of a commodity -> quantity dict as of date, skipping unpriced commodities"
+        total = Decimal(0)
+        for commodity, quantity in balance.items():
+            price = self.price(commodity, date)
+            if price is not None:
+                total += quantity * price
+        return total
+
+    def net_worth(self, transactions, dates, prefixes=net_worth_prefixes):
+        """
+        Returns [(date, dollar value)] of the holdings in accounts under
+        prefixes as of each of dates, in one sweep over the transactions
+        and prices in date order.  Commodities not yet priced count as 0.
+        """
+        dates = sorted(dates)
+        transactions = sorted(transactions, key=lambda t: t.date)
+        holdings = defaultdict(Decimal)
+        included = {}
+        # commodity -> number of its prices dated on or before the current date
+        seen = defaultdict(int)
+
+        series = []
+        t = 0
+        for date in dates:
+            while t < len(transactions) and transactions[t].date <= date:
+                for account, commodity, quantity in posting_amounts(transactions[t]):
+                    if account not in included:
+                        included[account] = under(account, prefixes)
+                    if included[account]:
+                        holdings[commodity] += quantity
+                t += 1
+
+            total = Decimal(0)
+            for commodity, quantity in holdings.items():
+                if commodity == '$':
+                    total += quantity
+                    continue
+                price_dates = self.dates.get(commodity, ())
+                i = seen[commodity]
+                while i < len(price_dates) and price_dates[i] <= date:
+                    i += 1
+                seen[commodity] = i
+                if i and quantity:
+                    total += quantity * self.values[commodity][i-1]
+            series.append((date, total))
+        return series
+
+def main():
+    arg_parser = ArgumentParser(
+        description='Show net worth at the end of every month of a ledger journal.'
+    )
+    arg_parser.add_argument('-j', '--journal', required=True)
+    arg_parser.add_argument('accounts', nargs='*', metavar='ACCOUNT',
+        help='accounts to include (default: {})'.format(' '.join(net_worth_prefixes)))
+    args = arg_parser.parse_args()
+
+    # import_model builds PriceIndexes itself
+    from import_model import Journal
+    journal = Journal.load(args.journal)
+    if not journal.transactions:
+        return
+    dates = [t.date for t in journal.transactions]
+    series = journal.price_index().net_worth(
+        journal.transactions, month_ends(min(dates), max(dates)),
+        args.accounts or net_worth_prefixes
+    )
+    for date, value in series:
+        print('{} {:>16}'.format(date.strftime('%Y/%m/%d'), '${:.2f}'.format(value)))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,339 @@
+from argparse import ArgumentParser
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import sha1
+import json
+import os
+from urllib.parse import parse_qs, urlsplit
+
+from dates import parse_date
+from export import bundle
+from import_model import Journal
+from prices import under
+
+reasons = {
+    200: 'OK',
+    304: 'Not Modified',
+    400: 'Bad Request',
+    404: 'Not Found',
+    405: 'Method Not Allowed',
+    500: 'Internal Server Error',
+    501: 'Not Implemented',
+}
+
+class QueryError(Exception):
+    "A problem with the request, reported to the client as a 400"
+
+class Unavailable(Exception):
+    "A query this installation cannot answer, reported to the client as a 501"
+
+def file_version(fn):
+    stat = os.stat(fn)
+    return '{}-{}'.format(stat.st_mtime_ns, stat.st_size)
+
+def journal_files(fn):
+    "fn and every file it includes, directly or not, as Journal.load reads them"
+    files = [fn]
+    seen = {os.path.realpath(fn)}
+    # files grows as includes are found
+    for path in files:
+        with open(path) as f:
+            for line in f:
+                if line.startswith('include') and line[7:8].isspace():
+                    include = os.path.join(os.path.dirname(path), line[7:].strip())
+                    if os.path.realpath(include) not in seen:
+                        seen.add(os.path.realpath(include))
+                        files.append(include)
+    return files
+
+def journal_version(files):
+    "One version for a journal and the files it includes; any change makes a new one"
+    versions = []
+    for fn in files:
+        try:
+            versions.append(file_version(fn))
+        except FileNotFoundError:
+            versions.append('missing')
+    if len(versions) == 1:
+        return versions[0]
+    return sha1(' '.join(versions).encode('utf-8')).hexdigest()[:16]
+
+def one(query, name, default=None):
+    values = query.get(name)
+    return values[-1] if values else default
+
+def query_date(query, name):
+    value = one(query, name)
+    if value is None:
+        return None
+    try:
+        return parse_date(value)
+    except ValueError:
+        raise QueryError('{} should look like 2016/02/26'.format(name))
+
+class JournalServer(object):
+    """
+    Answers JSON queries over a journal that is loaded once and reloaded
+    when its file, or any file it includes, changes.  Responses depend only
+    on the version of those files and the request target, so the ETag is
+    derived from those two and a matching If-None-Match is answered with
+    304 before any work is done.
+
+    Everything else runs on one query thread, so a slow query does not
+    hold up the event loop, and queries (which build the journal's indexes
+    on first use) never run at the same time as each other or as the swap
+    to a reloaded journal.
+    """
+    # seconds between checks of the journal file
+    poll_interval = 1.0
+    # rendered responses kept for the current version
+    max_cached = 256
+    # longest request body skipped to keep a connection open; nothing reads bodies
+    max_body = 1 << 16
+
+    def __init__(self, fn, use_cache=True):
+        self.fn = fn
+        self.use_cache = use_cache
+        # the journal's files as of the last load; only the root can add to them
+        self.files = journal_files(fn)
+        self.version = journal_version(self.files)
+        self.journal = Journal.load(fn, use_cache)
+        # request target -> rendered body, for the current version
+        self.responses = {}
+        self.queries = ThreadPoolExecutor(1)
+        self.handlers = {
+            '/balances': self.balances,
+            '/register': self.register,
+            '/prices': self.prices,
+            '/aggregate': self.aggregate,
+            '/bundle': self.bundle,
+        }
+
+    async def reload(self):
+        "Reloads the journal if any of its files changed, returning whether it did"
+        if journal_version(self.files) == self.version:
+            return False
+        # parse in a thread so the old journal keeps answering meanwhile
+        loop = asyncio.get_running_loop()
+        files = await loop.run_in_executor(None, journal_files, self.fn)
+        version = journal_version(files)
+        journal = await loop.run_in_executor(None, Journal.load, self.fn, self.use_cache)
+        await loop.run_in_executor(self.queries, self.swap, journal, files, version)
+        return True
+
+    def swap(self, journal, files, version):
+        "Runs on the query thread, between queries"
+        self.responses = {}
+        self.journal = journal
+        self.files = files
+        self.version = version
+
+    async def watch(self):
+        "Polls the journal's files for changes until cancelled"
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            try:
+                await self.reload()
+            except Exception as e:
+                # probably caught mid-write; try again on the next poll
+                print('reload failed: {}'.format(e))
+
+    def etag(self, target):
+        return '"{}-{}"'.format(self.version, sha1(target.encode('utf-8')).hexdigest()[:16])
+
+    def not_modified(self, method, target, headers):
+        "The 304 response when the client has the current version, else None"
+        if method not in ('GET', 'HEAD') or urlsplit(target).path not in self.handlers:
+            return None
+        etag = self.etag(target)
+        if etag in [tag.strip() for tag in headers.get('if-none-match', '').split(',')]:
+            return 304, {'ETag': etag, 'Content-Type': 'application/json'}, b''
+        return None
+
+    def respond(self, method, target, headers):
+        "Returns (status, headers, body) for one request"
+        if method not in ('GET', 'HEAD'):
+            return 405, {}, b''
+        parts = urlsplit(target)
+        handler = self.handlers.get(parts.path)
+        if handler is None:
+            return 404, {}, json.dumps({'error': 'unknown path'}).encode('utf-8')
+
+        response = self.not_modified(method, target, headers)
+        if response is not None:
+            return response
+        response_headers = {'ETag': self.etag(target), 'Content-Type': 'application/json'}
+
+        body = self.responses.get(target)
+        if body is None:
+            try:
+                result = handler(parse_qs(parts.query))
+            except QueryError as e:
+                return 400, {}, json.dumps({'error': str(e)}).encode('utf-8')
+            except Unavailable as e:
+                return 501, {}, json.dumps({'error': str(e)}).encode('utf-8')
+            body = json.dumps(result, separators=(',', ':')).encode('utf-8')
+            if len(self.responses) >= self.max_cached:
+                self.responses.clear()
+            self.responses[target] = body
+        return 200, response_headers, body
+
+    # queries
+    def balances(self, query):
+        "account -> commodity -> balance, for accounts starting with ?account="
+        engine = self.journal.balances()
+        return dict(
+            (account, dict((c, str(q)) for c, q in engine.balance(account).items()))
+            for account in engine.accounts(query.get('account'))
+        )
+
+    def register(self, query):
+        "Transactions posting under any ?account=, from ?start= to ?end="
+        prefixes = query.get('account')
+        start = query_date(query, 'start')
+        end = query_date(query, 'end')
+        rows = []
+        for trans in self.journal.sorted_transactions():
+            if (start and trans.date < start) or (end and trans.date > end):
+                continue
+            if prefixes and not any(under(p.account, prefixes) for p in trans.postings):
+                continue
+            rows.append({
+                'date': trans.date.strftime('%Y/%m/%d'),
+                'desc': trans.desc,
+                'postings': [
+                    [p.account, p.commodity, None if p.quantity is None else str(p.quantity)]
+                    for p in trans.postings
+                ],
+            })
+        return rows
+
+    def prices(self, query):
+        "Price series per commodity, or each ?commodity= price as of ?date="
+        index = self.journal.price_index()
+        commodities = query.get('commodity') or sorted(index.dates)
+        date = query_date(query, 'date')
+        if date is not None:
+            return dict(
+                (c, None if index.price(c, date) is None else str(index.price(c, date)))
+                for c in commodities
+            )
+        return dict(
+            (c, {
+                'date': [d.strftime('%Y/%m/%d') for d in index.dates.get(c, ())],
+                'price': [str(v) for v in index.values.get(c, ())],
+            })
+            for c in commodities
+        )
+
+    def aggregate(self, query):
+        "Monthly totals over accounts under ?account=, optionally ?cumulative=1"
+        prefixes = query.get('account')
+        if not prefixes:
+            raise QueryError('aggregate needs at least one account')
+        # imported here, like in Journal.cube, so numpy only loads for this query
+        from cube import numpy
+        if numpy is None:
+            raise Unavailable('aggregate needs numpy, which is not installed')
+        cube = self.journal.cube()
+        series = cube.series(prefixes, one(query, 'commodity', '$'),
+            one(query, 'cumulative') == '1')
+        return {'months': cube.months(), 'values': [round(v, 2) for v in series.tolist()]}
+
+    def bundle(self, query):
+        "The same bundle py/export.py writes"
+        return bundle(self.journal)
+
+    # HTTP
+    async def handle(self, reader, writer):
+        "Serves requests on one connection until the client closes it"
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+                try:
+                    method, target, version = request_line.decode('latin-1').split()
+                except ValueError:
+                    await self.send(writer, 'HEAD', 400, {}, b'', False)
+                    break
+
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if not line.strip():
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                keep_alive = version == 'HTTP/1.1' and \
+                    headers.get('connection', '').lower() != 'close'
+
+                # skip any body so the next request is read from where it
+                # starts; one of unknown or excessive length ends the connection
+                length = headers.get('content-length', '0')
+                if 'transfer-encoding' in headers or not length.isdigit() or \
+                    int(length) > self.max_body:
+                    keep_alive = False
+                elif int(length):
+                    await reader.readexactly(int(length))
+
+                try:
+                    # answered on the loop when it needs no work at all
+                    response = self.not_modified(method, target, headers) or \
+                        await asyncio.get_running_loop().run_in_executor(
+                            self.queries, self.respond, method, target, headers
+                        )
+                    status, response_headers, body = response
+                except Exception as e:
+                    status, response_headers = 500, {}
+                    body = json.dumps({'error': str(e)}).encode('utf-8')
+                await self.send(writer, method, status, response_headers, body, keep_alive)
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def send(self, writer, method, status, headers, body, keep_alive):
+        lines = ['HTTP/1.1 {} {}'.format(status, reasons[status])]
+        headers = dict(headers)
+        headers['Content-Length'] = str(len(body))
+        headers['Connection'] = 'keep-alive' if keep_alive else 'close'
+        # the dashboard is served from another origin
+        headers['Access-Control-Allow-Origin'] = '*'
+        headers['Access-Control-Expose-Headers'] = 'ETag'
+        lines.extend('{}: {}'.format(name, value) for name, value in headers.items())
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+        if method != 'HEAD':
+            writer.write(body)
+        await writer.drain()
+
+    async def serve(self, host, port):
+        server = await asyncio.start_server(self.handle, host, port)
+        watcher = asyncio.ensure_future(self.watch())
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            watcher.cancel()
+            self.queries.shutdown(wait=False)
+
+def main():
+    arg_parser = ArgumentParser(description='Serve JSON queries over a ledger journal.')
+    arg_parser.add_argument('-j', '--journal', required=True)
+    arg_parser.add_argument('--host', default='127.0.0.1')
+    arg_parser.add_argument('-p', '--port', type=int, default=8765)
+    arg_parser.add_argument('--no-cache', action='store_true',
+        help='ignore and do not write the parsed journal cache')
+    args = arg_parser.parse_args()
+
+    server = JournalServer(args.journal, use_cache=not args.no_cache)
+    print('Serving {} on http://{}:{}/'.format(args.journal, args.host, args.port))
+    try:
+        asyncio.run(server.serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,284 @@
+from argparse import ArgumentParser
+from collections import defaultdict
+from datetime import datetime, timedelta
+from heapq import merge
+from itertools import chain, groupby
+import os
+import re
+import shutil
+
+from import_model import DescriptionMap, Journal, cache_key, read_snapshot, write_snapshot
+from instrumentation import stats
+from journal_writer import atomic_write, refresh_cache, splice, spliced_journal, write_journal
+from lazy_journal import scan_descriptions
+
+# the names of the per-year files a root journal includes
+shard_re = re.compile(r'^(\d{4})\.dat$')
+
+def shard_name(year):
+    return '{}.dat'.format(year)
+
+def history_path(fn):
+    return fn + '.history'
+
+def load_history(fn):
+    """
+    The description map of the shard fn and the additions that built it,
+    flattened as desc, account and date ordinal in file order; read from
+    the sidecar when it still matches the shard, otherwise scanned from
+    just its descriptions and accounts and saved there
+    """
+    with open(fn, 'rb') as f:
+        mtime_ns = os.fstat(f.fileno()).st_mtime_ns
+        data = f.read()
+    key = cache_key(data, mtime_ns)
+    with stats.stage('read_history'):
+        history = read_snapshot(history_path(fn), key, lambda snapshot: (
+            DescriptionMap.from_snapshot(snapshot[0]), snapshot[1]
+        ))
+    if history is None:
+        stats.count('description_cache_misses')
+        additions = []
+        with stats.stage('scan_descriptions'):
+            description_map = scan_descriptions(data, additions)
+        history = description_map, additions
+        write_snapshot(history_path(fn), key, (description_map.snapshot(), additions))
+    return history
+
+def write_shard(fn, transactions):
+    "Writes a file of just transactions, laid out like the end of a full journal"
+    with atomic_write(fn) as f:
+        f.write('\n'.join(str(t) for t in transactions) + '\n')
+
+class ShardedJournal(Journal):
+    """
+    A journal kept as a root file, with the accounts, commodities, prices
+    and regex rules, that includes one file of transactions per year:
+
+        include 2015.dat
+        include 2016.dat
+
+    Shards are loaded, through their own caches, only when a lookup needs
+    their dates: already_imported looks at one year and is_mirror_trans at
+    the years from two weeks back on.  The description map is merged from
+    each shard's own, kept in a sidecar beside it (see load_history), so it
+    needs no shard loaded.  Anything that needs every transaction loads
+    every shard.  save only rewrites the
+    shards that gained transactions, and the root when it gained accounts,
+    rules or shards.
+    """
+
+    def __init__(self, fn, root=None, use_cache=True):
+        self.fn = fn
+        self.use_cache = use_cache
+        self.root = root or Journal.load(fn, use_cache, includes=False)
+        directory = os.path.dirname(fn)
+        # year -> path of its shard
+        self.shard_paths = {}
+        for include in self.root.includes:
+            match = shard_re.match(os.path.basename(include))
+            if not match:
+                raise Exception('{}: {} is not a year shard like 2016.dat'.format(fn, include))
+            self.shard_paths[int(match.group(1))] = os.path.join(directory, include)
+
+        # the root's own, so changes to them are the root's changes
+        self.accounts = self.root.accounts
+        self.commodities = self.root.commodities
+        self.prices = self.root.prices
+        self.regexes = self.root.regexes
+
+        # year -> Journal of that year's transactions, once loaded
+        self.shards = {}
+        # loaded and added transactions by total, as in Journal
+        self.by_quantity = defaultdict(list)
+        self._description_map = None
+        self.mark_saved()
+
+    def load_years(self, first=None, last=None):
+        "Loads the shards for years first through last; None is unbounded"
+        for year in sorted(self.shard_paths):
+            if year in self.shards or (first is not None and year < first) or \
+                (last is not None and year > last):
+                continue
+            with stats.stage('load_shard'):
+                shard = self.shards[year] = Journal.load(self.shard_paths[year], self.use_cache)
+            stats.count('shards_loaded')
+            for trans in shard.transactions:
+                self.include_transaction(trans)
+
+    def shard(self, year):
+        "The journal for year, loading it or starting a new shard for it"
+        self.load_years(year, year)
+        if year not in self.shards:
+            self.shards[year] = Journal()
+            self.shard_paths[year] = os.path.join(os.path.dirname(self.fn), shard_name(year))
+            self.root.includes.append(shard_name(year))
+        return self.shards[year]
+
+    @property
+    def transactions(self):
+        "Every transaction, a year at a time; loads every shard"
+        self.load_years()
+        return list(chain.from_iterable(
+            self.shards[year].transactions for year in sorted(self.shards)
+        ))
+
+    def sorted_transactions(self):
+        self.load_years()
+        return merge(
+            *[self.shards[year].sorted_transactions() for year in sorted(self.shards)],
+            key=lambda t: t.date
+        )
+
+    @property
+    def description_map(self):
+        "Merged from every shard's on first use, as Journal.join would"
+        if self._description_map is None:
+            # (description map, additions) of each shard on disk, by year;
+            # shards started by this import have nothing there yet
+            histories = [
+                load_history(path) for year, path in sorted(self.shard_paths.items())
+                if year not in self.shards or os.path.exists(path)
+            ]
+
+            description_map = DescriptionMap()
+            # desc -> accounts used with it in any shard
+            desc_accounts = defaultdict(set)
+            for shard_map, additions in histories:
+                for desc, entries in shard_map.entries.items():
+                    desc_accounts[desc].update(entry[0] for entry in entries)
+                description_map.merge(shard_map)
+
+            # like Journal.join, recount the descriptions that may have had
+            # an account dropped to make room
+            fromordinal = datetime.fromordinal
+            description_map.recount(set(
+                desc for desc, accounts in desc_accounts.items()
+                if len(accounts) >= DescriptionMap.max_accounts
+            ), (
+                (desc, account, fromordinal(ordinal))
+                for shard_map, additions in histories
+                for desc, account, ordinal in zip(additions[::3], additions[1::3], additions[2::3])
+            ))
+            self._description_map = description_map
+        return self._description_map
+
+    def mark_saved(self):
+        self.root.mark_saved()
+        self.saved_include_count = len(self.root.includes)
+        for shard in self.shards.values():
+            shard.mark_saved()
+
+    def unsaved_accounts(self):
+        return self.root.unsaved_accounts()
+
+    def unsaved_regexes(self):
+        return self.root.unsaved_regexes()
+
+    def unsaved_transactions(self):
+        return list(chain.from_iterable(
+            self.shards[year].unsaved_transactions() for year in sorted(self.shards)
+        ))
+
+    def add_transaction(self, trans):
+        self.shard(trans.date.year).add_transaction(trans)
+        self.by_quantity[trans.total].append(trans)
+        self.update_indexes(trans)
+
+    def already_imported(self, trans):
+        self.load_years(trans.date.year, trans.date.year)
+        return Journal.already_imported(self, trans)
+
+    def is_mirror_trans(self, trans):
+        # mirrors can be dated any time after the start of the window
+        self.load_years((trans.date - timedelta(days=14)).year)
+        return Journal.is_mirror_trans(self, trans)
+
+    def save(self):
+        """
+        Writes the shards that gained transactions, then the root if it
+        gained accounts, rules or shards; returns False when nothing changed
+        """
+        written = False
+        # shards first, so the root never includes a file that is not there
+        for year, shard in sorted(self.shards.items()):
+            if not shard.unsaved_transactions():
+                continue
+            if os.path.exists(self.shard_paths[year]):
+                write_journal(shard, self.shard_paths[year], cache=self.use_cache)
+            else:
+                write_shard(self.shard_paths[year], shard.sorted_transactions())
+                # readable by whoever can read the root
+                shutil.copymode(self.fn, self.shard_paths[year])
+                if self.use_cache:
+                    # laid out as if spliced into an empty file
+                    refresh_cache(self.shard_paths[year], spliced_journal(shard, []))
+            written = True
+        if self.root.has_changes() or len(self.root.includes) > self.saved_include_count:
+            self.write_root()
+            written = True
+        self.mark_saved()
+        return written
+
+    def write_root(self):
+        with open(self.fn, newline='') as f:
+            lines = f.readlines()
+        spliced = splice(lines, self.root)
+        # the new include lines go after the existing ones, in the same
+        # order as in root.includes
+        reread = spliced_journal(self.root, lines) if spliced is not None and \
+            self.use_cache else None
+        with stats.stage('write'), atomic_write(self.fn) as f:
+            if spliced is None:
+                stats.count('full_rewrites')
+                self.root.write_to(f)
+                return
+            # new shards are included after the existing ones
+            newline = '\r\n' if lines and lines[0].endswith('\r\n') else '\n'
+            include_lines = [i for i, line in enumerate(spliced) if line.startswith('include')]
+            at = include_lines[-1] + 1 if include_lines else len(spliced)
+            if at and spliced[at-1] and not spliced[at-1].endswith('\n'):
+                spliced[at-1] += newline
+            spliced[at:at] = [
+                'include {}{}'.format(include, newline)
+                for include in self.root.includes[self.saved_include_count:]
+            ]
+            f.writelines(spliced)
+        if reread is not None:
+            refresh_cache(self.fn, reread)
+
+    def export(self, fn):
+        "Writes the journal as one ledger file, with the shards' transactions inline"
+        with stats.stage('write'), atomic_write(fn) as f:
+            self.write_to(f)
+
+def split_journal(journal, root_fn):
+    "Writes journal as a root file at root_fn with one shard per year beside it"
+    directory = os.path.dirname(root_fn)
+    includes = []
+    for year, transactions in groupby(journal.sorted_transactions(), key=lambda t: t.date.year):
+        write_shard(os.path.join(directory, shard_name(year)), transactions)
+        includes.append(shard_name(year))
+    root = Journal(
+        accounts=set(journal.accounts),
+        regexes=list(journal.regexes),
+        prices=list(journal.prices),
+        commodities=list(journal.commodities),
+        includes=includes,
+    )
+    with atomic_write(root_fn) as f:
+        root.write_to(f)
+
+def main():
+    arg_parser = ArgumentParser(
+        description='Split a ledger journal into a root file and one file of transactions per year.'
+    )
+    arg_parser.add_argument('-j', '--journal', required=True)
+    arg_parser.add_argument('-o', '--output', required=True,
+        help='root file to write; the year files are written beside it')
+    args = arg_parser.parse_args()
+
+    split_journal(Journal.load(args.journal), args.output)
+
+if __name__ == "__main__":
+    main()
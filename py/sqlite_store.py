@@ -0,0 +1,327 @@
+from argparse import ArgumentParser
+from collections import defaultdict
+from datetime import datetime, timedelta
+from decimal import Decimal
+from itertools import groupby
+from operator import itemgetter
+import os
+import sqlite3
+
+from import_model import (AccountRegEx, Commodity, DescriptionMap, Journal, Posting, Price,
+    Transaction)
+from instrumentation import stats
+from journal_writer import atomic_write
+
+# stored in PRAGMA user_version; bump when the tables change
+SCHEMA_VERSION = 1
+
+schema = '''
+CREATE TABLE accounts (name TEXT PRIMARY KEY);
+CREATE TABLE commodities (id INTEGER PRIMARY KEY, name TEXT);
+CREATE TABLE prices (id INTEGER PRIMARY KEY, date INTEGER, commodity TEXT, value TEXT);
+CREATE TABLE regexes (id INTEGER PRIMARY KEY, account TEXT, regex TEXT);
+CREATE TABLE transactions (
+    id INTEGER PRIMARY KEY,
+    date INTEGER,
+    desc TEXT,
+    -- see amount_key
+    total TEXT,
+    -- the posting accounts in order, when there is more than one of them
+    accounts TEXT
+);
+CREATE TABLE postings (
+    transaction_id INTEGER,
+    position INTEGER,
+    account TEXT,
+    quantity TEXT,
+    commodity TEXT,
+    unit_price TEXT,
+    PRIMARY KEY (transaction_id, position)
+) WITHOUT ROWID;
+CREATE TABLE descriptions (
+    desc TEXT,
+    account TEXT,
+    count INTEGER,
+    last_seen INTEGER,
+    sequence INTEGER,
+    PRIMARY KEY (desc, account)
+);
+CREATE INDEX transactions_date ON transactions (date);
+CREATE INDEX transactions_total ON transactions (total, date);
+CREATE INDEX transactions_desc ON transactions (desc);
+CREATE INDEX postings_account ON postings (account);
+'''
+
+def amount_key(total):
+    "The same text for equal amounts, however many places they were written with"
+    if not total:
+        return '0'
+    return str(Decimal(total).normalize())
+
+def text(value):
+    return None if value is None else str(value)
+
+def decimal(value):
+    return None if value is None else Decimal(value)
+
+def mirror_accounts(accounts):
+    return '\n'.join(accounts) if len(set(accounts)) > 1 else None
+
+def insert_transaction(db, trans):
+    accounts = [p.account for p in trans.postings]
+    cursor = db.execute(
+        'INSERT INTO transactions (date, desc, total, accounts) VALUES (?, ?, ?, ?)',
+        (trans.date.toordinal(), trans.desc, amount_key(trans.total), mirror_accounts(accounts))
+    )
+    db.executemany('INSERT INTO postings VALUES (?, ?, ?, ?, ?, ?)', [
+        (cursor.lastrowid, i, p.account, text(p.quantity), p.commodity, text(p.unit_price))
+        for i, p in enumerate(trans.postings)
+    ])
+
+def under_clause(prefixes):
+    """
+    SQL matching postings.account under any of prefixes, and its
+    parameters; the ranges let SQLite use the account index
+    """
+    clauses = []
+    params = []
+    for prefix in prefixes:
+        clauses.append('(account = ? OR (account >= ? AND account < ?))')
+        # ';' sorts right after ':'
+        params.extend([prefix, prefix + ':', prefix + ';'])
+    return ' OR '.join(clauses), params
+
+class SqliteJournal(Journal):
+    """
+    A Journal kept in a SQLite database instead of being parsed from text
+    on every run.  Accounts, regexes, prices and the description map are
+    read when the database is opened, but transactions stay in the
+    database: checking for already imported and mirror transactions is an
+    indexed query, and the full list is only read if something like the
+    balance engine needs it.
+
+    Added transactions are inserted straight away, inside a database
+    transaction that save commits together with any new accounts, regexes
+    and descriptions, so an import is stored completely or not at all.
+    """
+
+    def __init__(self, db):
+        self.db = db
+        self.accounts = set(name for name, in db.execute('SELECT name FROM accounts'))
+        self.commodities = [
+            Commodity(name) for name, in db.execute('SELECT name FROM commodities ORDER BY id')
+        ]
+        self.prices = [
+            Price(datetime.fromordinal(date), commodity, Decimal(value))
+            for date, commodity, value in
+            db.execute('SELECT date, commodity, value FROM prices ORDER BY id')
+        ]
+        self.regexes = [
+            AccountRegEx(account, regex)
+            for account, regex in db.execute('SELECT account, regex FROM regexes ORDER BY id')
+        ]
+
+        # rows come out in each description's rank order
+        self.description_map = DescriptionMap()
+        entries = self.description_map.entries
+        for desc, account, count, last_seen, sequence in db.execute('''
+            SELECT desc, account, count, last_seen, sequence FROM descriptions
+            ORDER BY desc, count DESC, last_seen DESC, sequence DESC
+        '''):
+            entries.setdefault(desc, []).append([account, count, last_seen, sequence])
+            self.description_map.sequence = max(self.description_map.sequence, sequence)
+
+        # read on first use; see transactions
+        self._transactions = None
+        self._by_quantity = None
+        self.mark_saved()
+
+    def read_transactions(self):
+        if self._transactions is None:
+            with stats.stage('read_transactions'):
+                self._transactions = list(self.select_transactions())
+                self._by_quantity = defaultdict(list)
+                for trans in self._transactions:
+                    self._by_quantity[trans.total].append(trans)
+
+    @property
+    def transactions(self):
+        "Every transaction, read from the database on first use"
+        self.read_transactions()
+        return self._transactions
+
+    @property
+    def by_quantity(self):
+        self.read_transactions()
+        return self._by_quantity
+
+    def select_transactions(self, where='', params=(), order='t.id'):
+        "Yields Transactions for the rows of transactions t matching where"
+        rows = self.db.execute('''
+            SELECT t.id, t.date, t.desc, p.account, p.quantity, p.commodity, p.unit_price
+            FROM transactions t LEFT JOIN postings p ON p.transaction_id = t.id
+            {} ORDER BY {}, p.position
+        '''.format(where, order), params)
+        fromordinal = datetime.fromordinal
+        for transaction_id, group in groupby(rows, itemgetter(0)):
+            first = next(group)
+            trans = Transaction(fromordinal(first[1]), first[2])
+            for row in [first] + list(group):
+                if row[3] is not None:
+                    trans.postings.append(
+                        Posting(row[3], decimal(row[4]), row[5], decimal(row[6]))
+                    )
+            yield trans
+
+    def sorted_transactions(self):
+        return self.select_transactions(order='t.date, t.id')
+
+    def register(self, prefixes=(), start=None, end=None):
+        "Transactions by date posting under any of prefixes, from start to end"
+        clauses = []
+        params = []
+        if prefixes:
+            accounts, params = under_clause(prefixes)
+            clauses.append(
+                't.id IN (SELECT transaction_id FROM postings WHERE {})'.format(accounts)
+            )
+        if start:
+            clauses.append('t.date >= ?')
+            params.append(start.toordinal())
+        if end:
+            clauses.append('t.date <= ?')
+            params.append(end.toordinal())
+        where = 'WHERE ' + ' AND '.join(clauses) if clauses else ''
+        return self.select_transactions(where, params, 't.date, t.id')
+
+    def mark_saved(self):
+        self.saved_accounts = set(self.accounts)
+        self.saved_regex_count = len(self.regexes)
+        self.saved_sequence = self.description_map.sequence
+        # added since the last save, in the order added
+        self.pending = []
+
+    def unsaved_transactions(self):
+        return list(self.pending)
+
+    def unsaved_descriptions(self):
+        "Descriptions whose ranked accounts changed since the last save"
+        # every change to a description's list comes from an add, which
+        # leaves the entry it touched with a new sequence number
+        return [
+            desc for desc, entries in self.description_map.entries.items()
+            if any(entry[3] > self.saved_sequence for entry in entries)
+        ]
+
+    def has_changes(self):
+        return Journal.has_changes(self) or bool(self.unsaved_descriptions())
+
+    def add_transaction(self, trans):
+        insert_transaction(self.db, trans)
+        self.pending.append(trans)
+        if self._transactions is not None:
+            self._transactions.append(trans)
+            self._by_quantity[trans.total].append(trans)
+        self.update_indexes(trans)
+
+    def already_imported(self, trans):
+        stats.count('imported_key_probes')
+        return self.db.execute(
+            'SELECT 1 FROM transactions WHERE total = ? AND date = ? AND desc = ? LIMIT 1',
+            (amount_key(trans.total), trans.date.toordinal(), trans.desc)
+        ).fetchone() is not None
+
+    def is_mirror_trans(self, trans):
+        accounts = [p.account for p in reversed(trans.postings)]
+        if len(set(accounts)) < 2:
+            return False
+        stats.count('mirror_index_probes')
+        # any date after the start of the window, including later ones
+        start = trans.date - timedelta(days=14)
+        return self.db.execute(
+            'SELECT 1 FROM transactions WHERE total = ? AND accounts = ? AND date > ? LIMIT 1',
+            (amount_key(-trans.total), mirror_accounts(accounts), start.toordinal())
+        ).fetchone() is not None
+
+    def save(self):
+        """
+        Commits what was added since the last save as one database
+        transaction; returns False when there was nothing to commit
+        """
+        if not self.has_changes():
+            return False
+        with self.db:
+            self.db.executemany('INSERT INTO accounts VALUES (?)',
+                [(account,) for account in self.unsaved_accounts()])
+            self.db.executemany('INSERT INTO regexes (account, regex) VALUES (?, ?)',
+                [(regex.account, regex.regex) for regex in self.unsaved_regexes()])
+            for desc in self.unsaved_descriptions():
+                self.db.execute('DELETE FROM descriptions WHERE desc = ?', (desc,))
+                self.db.executemany('INSERT INTO descriptions VALUES (?, ?, ?, ?, ?)', [
+                    (desc, account, count, last_seen, sequence)
+                    for account, count, last_seen, sequence in self.description_map.entries[desc]
+                ])
+        self.mark_saved()
+        return True
+
+    def export(self, fn):
+        "Writes the journal as ledger text to fn"
+        with stats.stage('write'), atomic_write(fn) as f:
+            self.write_to(f)
+
+    @classmethod
+    def create(cls, fn, journal):
+        "Creates the database fn holding everything in journal"
+        db = sqlite3.connect(fn)
+        with db:
+            db.executescript(schema)
+            db.execute('PRAGMA user_version = {}'.format(SCHEMA_VERSION))
+            db.executemany('INSERT INTO accounts VALUES (?)',
+                [(account,) for account in sorted(journal.accounts)])
+            db.executemany('INSERT INTO commodities (name) VALUES (?)',
+                [(commodity.name,) for commodity in journal.commodities])
+            db.executemany('INSERT INTO prices (date, commodity, value) VALUES (?, ?, ?)', [
+                (price.date.toordinal(), price.commodity, str(price.value))
+                for price in journal.prices
+            ])
+            db.executemany('INSERT INTO regexes (account, regex) VALUES (?, ?)',
+                [(regex.account, regex.regex) for regex in journal.regexes])
+            db.executemany('INSERT INTO descriptions VALUES (?, ?, ?, ?, ?)', [
+                (desc, account, count, last_seen, sequence)
+                for desc, entries in journal.description_map.entries.items()
+                for account, count, last_seen, sequence in entries
+            ])
+            for trans in journal.transactions:
+                insert_transaction(db, trans)
+        return cls(db)
+
+    @classmethod
+    def open(cls, fn, journal_fn=None, use_cache=True):
+        "Opens the database fn, first creating it from the ledger file journal_fn if needed"
+        if not os.path.exists(fn):
+            if journal_fn is None:
+                raise Exception('{} does not exist'.format(fn))
+            return cls.create(fn, Journal.load(journal_fn, use_cache))
+        db = sqlite3.connect(fn)
+        version, = db.execute('PRAGMA user_version').fetchone()
+        if version != SCHEMA_VERSION:
+            raise Exception('{} has schema version {}, expected {}'.format(
+                fn, version, SCHEMA_VERSION))
+        return cls(db)
+
+def main():
+    arg_parser = ArgumentParser(
+        description='Create a SQLite journal from ledger text, or export one back to it.'
+    )
+    arg_parser.add_argument('--db', required=True)
+    arg_parser.add_argument('-j', '--journal',
+        help='ledger file to create the database from if it does not exist')
+    arg_parser.add_argument('-o', '--output', help='write the journal as ledger text here')
+    args = arg_parser.parse_args()
+
+    journal = SqliteJournal.open(args.db, args.journal)
+    if args.output:
+        journal.export(args.output)
+
+if __name__ == "__main__":
+    main()
@@ -1,15 +1,37 @@
+import asyncio
 import builtins
 from collections import defaultdict
 from csv import reader as csv_reader
 from datetime import datetime
 from decimal import Decimal
+from io import StringIO
+import json
+import os
 from sys import version_info
-from unittest import TestCase, main as unittest_main
+import threading
+from tempfile import TemporaryDirectory
+from unittest import TestCase, main as unittest_main, skipUnless
 from unittest.mock import patch, mock_open
 
-from ledger_import import LedgerImportCmd, Journal, Posting, Transaction
-from input_parsers import (NecuParser, UsBankParser, AllyParser, WellsFargoParser,
-    BpasParser, TiaaCrefParser, AmmVanguardParser)
+from ledger_import import LedgerImportCmd, Journal, Posting, Transaction, parse_inputs
+from import_model import AccountRegEx, DescriptionMap, Price, chunk_ranges
+from balances import BalanceEngine, posting_amounts
+from classifier import RegexClassifier
+from cube import AggregateCube, numpy
+from export import bundle
+from prices import PriceIndex, month_ends
+from server import JournalServer
+from sqlite_store import SqliteJournal
+from lazy_journal import LazyJournal, scan_descriptions
+from shards import ShardedJournal, split_journal
+from dates import parse_date, fast_formats
+from fuzzy_index import DescriptionIndex, normalize
+from journal_writer import write_journal
+from instrumentation import Stats
+from transaction_store import TransactionStore
+from benchmarks import generate_export, compare
+from input_parsers import (parsers, NecuParser, UsBankParser, AllyParser, WellsFargoParser,
+    BpasParser, TiaaCrefParser, AmmVanguardParser, read_lines_backwards, external_sort)
 
 class TestNecuParser(TestCase):
     def test_make_transactions(self):
@@ -30,6 +52,49 @@ class TestNecuParser(TestCase):
         self.assertEqual(trans.postings[0].account, 'Assets:NECU:Checking')
         self.assertEqual(trans.postings[0].quantity, Decimal('-68.47'))
 
+    def test_iter_transactions(self):
+        "Reads newest-first exports backwards, oldest first"
+        descs = ['Payment {}'.format(i) for i in range(50)]
+        with TemporaryDirectory() as tmp:
+            fn = os.path.join(tmp, 'necu.csv')
+            with open(fn, 'w') as f:
+                f.write('Account Designator,Posted Date,Serial Number,Description,Amount,CR/DR\n')
+                for desc in reversed(descs):
+                    f.write('0056531888 S02,02/26/16,0,"{}",000000068.47,DR\n'.format(desc))
+            with patch.object(NecuParser, 'block_size', 7):
+                transactions = NecuParser.iter_transactions(fn)
+                self.assertEqual(next(transactions).desc, descs[0])
+                self.assertEqual([t.desc for t in transactions], descs[1:])
+            self.assertEqual([t.desc for t in NecuParser.parse_file(fn)], descs)
+
+    def test_iter_transactions_multiline(self):
+        "Rejects quoted fields with embedded newlines rather than splitting them"
+        with TemporaryDirectory() as tmp:
+            fn = os.path.join(tmp, 'necu.csv')
+            with open(fn, 'w') as f:
+                f.write('Account Designator,Posted Date,Serial Number,Description,Amount,CR/DR\n')
+                f.write('0056531888 S02,02/27/16,0,"Payment\n2",000000068.47,DR\n')
+                f.write('0056531888 S02,02/26/16,0,"Payment 1",000000068.47,DR\n')
+            transactions = NecuParser.iter_transactions(fn)
+            self.assertEqual(next(transactions).desc, 'Payment 1')
+            with self.assertRaisesRegex(Exception, 'cannot be read backwards'):
+                next(transactions)
+
+    def test_read_lines_backwards(self):
+        with TemporaryDirectory() as tmp:
+            fn = os.path.join(tmp, 'lines.txt')
+            with open(fn, 'wb') as f:
+                f.write(b'header\r\nfirst\r\n\r\nsecond,\xc3\xa9\r\nthird')
+            for block_size in [1, 2, 5, 1 << 16]:
+                self.assertEqual(
+                    list(read_lines_backwards(fn, block_size=block_size)),
+                    ['third', 'second,\xe9', '', 'first', 'header']
+                )
+                self.assertEqual(
+                    list(read_lines_backwards(fn, 8, block_size)),
+                    ['third', 'second,\xe9', '', 'first']
+                )
+
 class TestUsBankParser(TestCase):
     def test_make_transactions(self):
         "Creates transaction from U.S. Bank CSV line"
@@ -195,13 +260,40 @@ class TestBpasParser(TestCase):
         self.assertEqual(trans2.postings[0].unit_price, Decimal('192.28'))
         self.assertEqual(trans2.postings[1].account, 'Assets:BPAS:401(k)')
 
+    def test_parse_file_sorted(self):
+        "Sorts rows by date in bounded runs"
+        line = '{}  VANGUARD 500 INDEX ADMIRAL SER  {}  N/A EMPLOYEE PRETAX 1.5475    $192.28   $297.56\n'
+        rows = [('04/14/2016', 'Contribution'), ('03/01/2016', 'Dividends'),
+            ('04/14/2016', 'Fees'), ('01/05/2016', 'Contribution'), ('03/01/2016', 'Fees')]
+        with TemporaryDirectory() as tmp:
+            fn = os.path.join(tmp, 'bpas.txt')
+            with open(fn, 'w') as f:
+                f.writelines(line.format(*row) for row in rows)
+            with patch.object(BpasParser, 'sort_chunk_size', 2):
+                transactions = BpasParser.parse_file(fn)
+        self.assertEqual(
+            [(t.date, t.desc) for t in transactions[::2]],
+            [(datetime(2016, 1, 5), 'Cash from Contribution'),
+             (datetime(2016, 3, 1), 'Cash from Dividends'),
+             (datetime(2016, 3, 1), 'Pay fees'),
+             (datetime(2016, 4, 14), 'Cash from Contribution'),
+             (datetime(2016, 4, 14), 'Pay fees')]
+        )
+
+    def test_external_sort(self):
+        items = [(i * 7 % 10, i) for i in range(25)]
+        for chunk_size in [1, 3, 25, 100]:
+            self.assertEqual(
+                list(external_sort(items, lambda x: x[0], chunk_size)),
+                sorted(items, key=lambda x: x[0])
+            )
+
 class TestLedgerImportCmd(TestCase):
     def setUp(self):
         self.DESC = 'Description!'
 
         self.cmd = LedgerImportCmd()
         self.cmd.journal = Journal()
-        self.cmd.journal.description_map = {}
 
         self.trans = Transaction()
         self.trans.desc = self.DESC
@@ -215,22 +307,325 @@ class TestLedgerImportCmd(TestCase):
     def test_get_account_all_found(self):
         "All possibilities already in transaction"
 
-        self.cmd.journal.description_map = {self.DESC: ['Foo', 'Bar']}
+        self.cmd.journal.add_desc_to_map(self.DESC, 'Foo')
+        self.cmd.journal.add_desc_to_map(self.DESC, 'Bar')
         sugg = self.cmd.get_account(self.trans)
         self.assertEqual(sugg, '')
 
     def test_get_account_second_works(self):
         "First possibility already in transaction, but second works"
-        self.cmd.journal.description_map[self.DESC] = ['Foo', 'Quux']
+        self.cmd.journal.add_desc_to_map(self.DESC, 'Foo')
+        self.cmd.journal.add_desc_to_map(self.DESC, 'Quux')
         sugg = self.cmd.get_account(self.trans)
         self.assertEqual(sugg, 'Quux')
 
     def test_get_account_second_match_returned(self):
         "two matches, second one is returned"
-        self.cmd.journal.description_map[self.DESC] = ['Quux', 'Bork']
+        self.cmd.journal.add_desc_to_map(self.DESC, 'Quux')
+        self.cmd.journal.add_desc_to_map(self.DESC, 'Bork')
         sugg = self.cmd.get_account(self.trans)
         self.assertEqual(sugg, 'Bork')
 
+    def test_get_account_regex_first(self):
+        "Regex matches win over description history, last regex first"
+        self.cmd.journal.add_desc_to_map(self.DESC, 'Quux')
+        self.cmd.journal.regexes = [
+            AccountRegEx('Bork', '^Desc'),
+            AccountRegEx('Foo', '^Desc'),
+        ]
+        self.assertEqual(self.cmd.get_account(self.trans), 'Bork')
+        self.assertEqual(self.cmd.journal.description_map.candidates(self.DESC), ['Quux'])
+
+    def test_get_account_most_used(self):
+        "The account used most often with a description is suggested"
+        for account in ['Quux', 'Quux', 'Bork']:
+            self.cmd.journal.add_desc_to_map(self.DESC, account)
+        self.assertEqual(self.cmd.get_account(self.trans), 'Quux')
+
+    def test_get_account_similar(self):
+        "Descriptions that differ only by numbers are suggested, not used"
+        self.cmd.journal.add_desc_to_map('Description 123!', 'Quux')
+        self.assertEqual(self.cmd.get_account(self.trans), '')
+        self.assertEqual(self.cmd.suggestion, 'Quux')
+        self.cmd.journal.add_desc_to_map('Description 456!', 'Bork')
+        self.assertEqual(self.cmd.get_account(self.trans), '')
+        self.assertEqual(self.cmd.suggestion, 'Bork')
+        self.cmd.journal.add_desc_to_map(self.DESC, 'Quux')
+        self.assertEqual(self.cmd.get_account(self.trans), 'Quux')
+        self.assertIsNone(self.cmd.suggestion)
+
+    def test_confirm_similar(self):
+        "A similar description's account is offered at the prompt"
+        self.cmd.journal.add_desc_to_map('Bantam Market 12', 'Expenses:Groceries')
+        self.cmd.new_transactions = [
+            Transaction(datetime(2016, 3, 20), 'Bantam Market 34', [
+                Posting(account='Assets:NECU:Checking', quantity=Decimal('-12.00'))
+            ]),
+            Transaction(datetime(2016, 3, 21), 'Bantam Market 56', [
+                Posting(account='Assets:NECU:Checking', quantity=Decimal('-3.00'))
+            ]),
+        ]
+        with patch('builtins.print'):
+            self.assertFalse(self.cmd.process_transactions())
+            self.assertEqual(self.cmd.journal.transactions, [])
+            self.assertIn('Expenses:Groceries', self.cmd.prompt)
+
+            # enter accepts the suggestion, and typing an account overrides it
+            self.assertFalse(self.cmd.onecmd(''))
+            self.assertEqual(len(self.cmd.new_transactions), 1)
+            self.assertTrue(self.cmd.onecmd('Expenses:Household'))
+        self.assertEqual(
+            [t.postings[-1].account for t in self.cmd.journal.transactions],
+            ['Expenses:Groceries', 'Expenses:Household']
+        )
+
+    def test_record_transaction_indexed(self):
+        "Recorded transactions are seen by later duplicate checks"
+        self.cmd.journal = Journal()
+
+        def trans(quantity):
+            return Transaction(datetime(2016, 3, 20), self.DESC, [
+                Posting(account='Assets:NECU:Checking', quantity=Decimal(quantity))
+            ])
+
+        self.assertFalse(self.cmd.journal.already_imported(trans('-1.25')))
+        self.cmd.record_transaction(trans('-1.25'), 'Expenses')
+        self.assertTrue(self.cmd.journal.already_imported(trans('-1.25')))
+        self.assertIn(Decimal('-1.25'), self.cmd.journal.by_quantity)
+
+        # more places than the index was built with
+        self.cmd.record_transaction(trans('-1.255'), 'Expenses')
+        self.assertTrue(self.cmd.journal.already_imported(trans('-1.255')))
+        self.assertTrue(self.cmd.journal.already_imported(trans('-1.25')))
+        self.assertFalse(self.cmd.journal.already_imported(trans('-1.26')))
+
+class TestParseInputs(TestCase):
+    def setUp(self):
+        self.tmp = TemporaryDirectory()
+        self.necu = os.path.join(self.tmp.name, 'necu.csv')
+        with open(self.necu, 'w') as f:
+            f.write('Account Designator,Posted Date,Serial Number,Description,Amount,CR/DR\n')
+            f.write('0056531888 S02,02/28/16,0,Transfer to Ally,000000100.00,DR\n')
+            f.write('0056531888 S02,02/26/16,0,FairPoint Communi Bill Pmt W/D,000000068.47,DR\n')
+        self.ally = os.path.join(self.tmp.name, 'ally.csv')
+        with open(self.ally, 'w') as f:
+            f.write('Date,Time,Amount,Type,Description\n')
+            f.write('2016-02-28,12:00:00,100,Deposit,Transfer from NECU\n')
+            f.write('2016-02-27,12:00:00,-82,Withdrawal,Bantam Market 793\n')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_merged_by_date(self):
+        inputs = [(self.necu, 'necu'), (self.ally, 'allymoneymarket')]
+        for workers in [1, 2]:
+            transactions = parse_inputs(inputs, workers)
+            self.assertEqual([t.desc for t in transactions], [
+                'FairPoint Communi Bill Pmt W/D',
+                'Bantam Market 793',
+                'Transfer to Ally',
+                'Transfer from NECU',
+            ])
+
+    def test_single_input(self):
+        transactions = parse_inputs([(self.ally, 'allymoneymarket')])
+        self.assertEqual([t.desc for t in transactions],
+            ['Bantam Market 793', 'Transfer from NECU'])
+
+    def test_unsorted_input(self):
+        "Inputs whose rows are not in date order are still sorted"
+        with open(self.necu, 'a') as f:
+            f.write('0056531888 S02,02/29/16,0,Bantam Market 794,000000012.00,DR\n')
+            f.write('0056531888 S02,02/25/16,0,Bantam Market 795,000000013.00,DR\n')
+        transactions = parse_inputs([(self.necu, 'necu'), (self.ally, 'allymoneymarket')], 1)
+        self.assertEqual([t.desc for t in transactions], [
+            'Bantam Market 795',
+            'FairPoint Communi Bill Pmt W/D',
+            'Bantam Market 793',
+            'Transfer to Ally',
+            'Transfer from NECU',
+            'Bantam Market 794',
+        ])
+
+class TestParseDate(TestCase):
+    texts = [
+        '2016/02/26', '2016/2/6', '02/26/2016', '2/6/2016', '02/26/16', '2/6/68',
+        '2/6/69', '2016-02-26', '20160226', '2016226', '02/30/2016', '13/01/2016',
+        '2016/02/26 ', ' 2016/02/26', '2/ 6/2016', '', 'garbage',
+    ]
+
+    def test_matches_strptime(self):
+        for fmt in fast_formats + ['%d.%m.%Y']:
+            for text in self.texts + ['26.02.2016']:
+                try:
+                    expected = datetime.strptime(text, fmt)
+                except ValueError:
+                    with self.assertRaises(ValueError):
+                        parse_date(text, fmt)
+                else:
+                    self.assertEqual(parse_date(text, fmt), expected, (text, fmt))
+
+    def test_default_format(self):
+        self.assertEqual(parse_date('2016/02/26'), datetime(2016, 2, 26))
+
+class TestBenchmarks(TestCase):
+    def test_generate_export(self):
+        "Synthetic exports parse, oldest first, for every input type"
+        with TemporaryDirectory() as tmp:
+            for input_type, parser in parsers.items():
+                fn = os.path.join(tmp, input_type)
+                generate_export(fn, input_type, 20)
+                dates = [t.date for t in parser.parse_file(fn)]
+                self.assertGreaterEqual(len(dates), 20, input_type)
+                self.assertEqual(dates, sorted(dates), input_type)
+
+    def test_compare(self):
+        baseline = {'a': 1.0, 'b': 1.0, 'c': 0.001}
+        results = {'a': 1.1, 'b': 2.0, 'c': 0.005, 'd': 5.0}
+        self.assertEqual(compare(results, baseline, 1.25, 0.01), [('b', 1.0, 2.0)])
+
+class TestStats(TestCase):
+    def test_disabled(self):
+        stats = Stats()
+        with stats.stage('parse'):
+            stats.count('rows')
+        stats.set('size', 1)
+        self.assertEqual(stats.report(), {'stages': {}, 'counters': {}, 'values': {}})
+
+    def test_report(self):
+        stats = Stats()
+        stats.enabled = True
+        for i in range(3):
+            with stats.stage('parse'):
+                stats.count('rows', 2)
+        stats.set('size', {'max': 4})
+        report = stats.report()
+        self.assertEqual(report['stages']['parse']['calls'], 3)
+        self.assertGreaterEqual(report['stages']['parse']['wall'], 0)
+        self.assertEqual(report['counters'], {'rows': 6})
+        self.assertEqual(report['values'], {'size': {'max': 4}})
+
+class TestRegexClassifier(TestCase):
+    rules = [
+        AccountRegEx('Expenses:Groceries', '^Bantam'),
+        AccountRegEx('Expenses:Utilities', 'FairPoint'),
+        AccountRegEx('Expenses:Dining', '(?i)^bantam market'),
+        AccountRegEx('Expenses:Groceries', '^(Bantam|Stop) Market'),
+        AccountRegEx('Expenses:Auto', '^(?P<station>Shell)'),
+        AccountRegEx('Expenses:Household', '^(\\w)\\1'),
+        AccountRegEx('Expenses:Medical', '^Bantam Market 7'),
+        AccountRegEx('Income:Salary', '^Payroll'),
+    ]
+    descs = [
+        'Bantam Market 793 Bantam Rd B Bantam',
+        'bantam market',
+        'Stop Market',
+        'Shell Oil 123',
+        'aa battery',
+        'FairPoint Communi Bill Pmt W/D',
+        'Payroll',
+        'nothing matches this',
+    ]
+
+    def expected(self, rules, desc):
+        return [r.account for r in reversed(rules) if r.compiled.match(desc)]
+
+    def test_iter_matches(self):
+        for chunk_size in [1, 2, 3, 100]:
+            classifier = RegexClassifier()
+            classifier.chunk_size = chunk_size
+            classifier.extend(self.rules)
+            for desc in self.descs:
+                self.assertEqual(list(classifier.iter_matches(desc)),
+                    self.expected(self.rules, desc))
+
+    def test_add(self):
+        classifier = RegexClassifier()
+        classifier.chunk_size = 3
+        for i, rule in enumerate(self.rules):
+            classifier.add(rule)
+            for desc in self.descs:
+                self.assertEqual(list(classifier.iter_matches(desc)),
+                    self.expected(self.rules[:i+1], desc))
+        self.assertLess(classifier.compiled_count, len(self.rules))
+
+    def test_sync(self):
+        rules = list(self.rules[:3])
+        classifier = RegexClassifier(rules)
+        rules.extend(self.rules[3:])
+        classifier.sync(rules)
+        self.assertEqual(classifier.classify('Bantam Market 793'), 'Expenses:Medical')
+        classifier.sync(rules[:1])
+        self.assertEqual(classifier.classify('Bantam Market 793'), 'Expenses:Groceries')
+
+    def test_classify_many(self):
+        classifier = RegexClassifier(self.rules)
+        self.assertEqual(
+            classifier.classify_many(self.descs),
+            [next(iter(self.expected(self.rules, d)), None) for d in self.descs]
+        )
+
+class TestDescriptionMap(TestCase):
+    def test_ranking(self):
+        description_map = DescriptionMap()
+        description_map.add('desc', 'a', datetime(2016, 1, 1))
+        description_map.add('desc', 'b', datetime(2016, 1, 2))
+        description_map.add('desc', 'c', datetime(2016, 1, 3))
+        self.assertEqual(description_map.candidates('desc'), ['c', 'b', 'a'])
+
+        description_map.add('desc', 'a', datetime(2016, 1, 4))
+        self.assertEqual(description_map.candidates('desc'), ['a', 'c', 'b'])
+        self.assertEqual(description_map.candidates('desc', {'a', 'b'}), ['c'])
+        self.assertEqual(description_map.candidates('other'), [])
+        self.assertNotIn('other', description_map)
+
+    def test_bounded(self):
+        description_map = DescriptionMap()
+        description_map.max_accounts = 2
+        for account in ['a', 'a', 'b', 'b', 'c']:
+            description_map.add('desc', account)
+        self.assertEqual(description_map.candidates('desc'), ['b', 'c'])
+
+    def test_merge(self):
+        first = DescriptionMap()
+        first.add('desc', 'a')
+        first.add('desc', 'b')
+        second = DescriptionMap()
+        second.add('desc', 'a')
+        second.add('desc', 'c')
+        second.add('other', 'd')
+        first.merge(second)
+        self.assertEqual(first.candidates('desc'), ['a', 'c', 'b'])
+        self.assertEqual(first.candidates('other'), ['d'])
+
+class TestDescriptionIndex(TestCase):
+    def test_normalize(self):
+        self.assertEqual(normalize('Bantam Market 793 Bantam Rd B Bantam'),
+            'bantam market bantam rd b bantam')
+        self.assertEqual(normalize('NFI*WWW.NETFLIX.COM/CC NETFLIX.COM CA'),
+            'nfi www netflix com cc netflix com ca')
+        self.assertEqual(normalize('#12345'), '')
+
+    def test_similar(self):
+        index = DescriptionIndex([
+            'Bantam Market 793 Bantam Rd B Bantam',
+            'Bantam Market 801 Bantam Rd B Bantam',
+            'FairPoint Communi Bill Pmt W/D',
+            'Shell Oil 12345',
+        ])
+        results = index.similar('Bantam Market 802 Bantam Rd B Bantam')
+        self.assertEqual(results, [(1.0, [
+            'Bantam Market 801 Bantam Rd B Bantam',
+            'Bantam Market 793 Bantam Rd B Bantam',
+        ])])
+
+        score, descs = index.similar('FairPoint Communi Bill Pmt')[0]
+        self.assertGreater(score, 0.5)
+        self.assertEqual(descs, ['FairPoint Communi Bill Pmt W/D'])
+
+        self.assertEqual(index.similar('Netflix'), [])
+        self.assertEqual(index.similar('12345'), [])
+
 class TestJournal(TestCase):
     def test_parse_file(self):
         test_data = """;this is a comment
@@ -289,12 +684,77 @@ account Income
         )
         self.assertEqual(len(journal.by_quantity), 2)
 
-        expected_desc_map = defaultdict(list)
-        expected_desc_map['FairPoint Communi Bill Pmt W/D'].append('Assets:NECU:Checking')
-        expected_desc_map['FairPoint Communi Bill Pmt W/D'].append('Expenses:Utilities')
-        expected_desc_map['Asset Fees'].append('Assets:Wells Fargo:401(k)')
-        expected_desc_map['Asset Fees'].append('Assets:Wells Fargo:401(k)')
-        self.assertEqual(journal.description_map, expected_desc_map)
+        self.assertEqual(len(journal.description_map), 2)
+        self.assertEqual(
+            journal.description_map.candidates('FairPoint Communi Bill Pmt W/D'),
+            ['Expenses:Utilities', 'Assets:NECU:Checking']
+        )
+        self.assertEqual(
+            journal.description_map.candidates('Asset Fees'),
+            ['Assets:Wells Fargo:401(k)']
+        )
+
+    def test_parse_file_header_sections(self):
+        test_data = """account Expenses
+commodity VFIAX
+P 2016/01/04 00:00:00 VFIAX $188.98
+; /^FairPoint/ Expenses:Utilities
+  ; /^Bantam/ Expenses:Groceries
+
+"""
+        with patch.object(builtins, 'open', mock_open(read_data=test_data)):
+            journal = Journal.parse_file('this file name is ignored by the mock')
+
+        self.assertEqual(journal.accounts, {'Expenses'})
+        self.assertEqual([c.name for c in journal.commodities], ['VFIAX'])
+        self.assertEqual(len(journal.prices), 1)
+        self.assertEqual(journal.prices[0].date, datetime(2016, 1, 4))
+        self.assertEqual(journal.prices[0].commodity, 'VFIAX')
+        self.assertEqual(journal.prices[0].value, Decimal('188.98'))
+        self.assertEqual(
+            [(r.regex, r.account) for r in journal.regexes],
+            [('^FairPoint', 'Expenses:Utilities'), ('^Bantam', 'Expenses:Groceries')]
+        )
+        self.assertEqual(journal.transactions, [])
+
+    def test_parse_file_unexpected_line(self):
+        for line in ['accrual', 'Pfoo', 'commodities', '*']:
+            with patch.object(builtins, 'open', mock_open(read_data=line+'\n')):
+                with self.assertRaises(Exception):
+                    Journal.parse_file('this file name is ignored by the mock')
+
+    def test_write_to(self):
+        def trans(day, desc, quantity):
+            return Transaction(datetime(2016, 3, day), desc, [
+                Posting('Assets:NECU:Checking', Decimal(quantity)),
+                Posting('Expenses:Groceries'),
+            ])
+
+        journal = Journal([trans(2, 'b', '-1'), trans(2, 'a', '-2'), trans(5, 'c', '-3')],
+            accounts={'Expenses:Groceries', 'Assets:NECU:Checking'},
+            regexes=[AccountRegEx('Expenses:Groceries', '^Bantam')])
+        journal.transactions.extend([trans(5, 'd', '-4'), trans(1, 'e', '-5')])
+
+        expected = '\n\n'.join([
+            '\n'.join('account '+ a for a in sorted(journal.accounts)),
+            '',
+            '',
+            '\n'.join(str(regex) for regex in journal.regexes),
+            '\n'.join(str(t) for t in sorted(journal.transactions, key=lambda t: t.date))
+        ]) + '\n'
+        for chunk_size in [1, 3, 1000]:
+            out = StringIO()
+            journal.write_to(out, chunk_size)
+            self.assertEqual(out.getvalue(), expected)
+        self.assertEqual(str(journal), expected)
+
+        # saved transactions out of order on disk
+        journal.mark_saved()
+        journal.transactions.append(trans(3, 'f', '-6'))
+        self.assertEqual(
+            [t.desc for t in journal.sorted_transactions()],
+            ['e', 'b', 'a', 'f', 'c', 'd']
+        )
 
     def test_already_imported(self):
         date = datetime(2016, 3, 20)
@@ -325,6 +785,18 @@ account Income
         trans = Transaction(date=date, desc='foobar', postings=postings)
         self.assertFalse(journal.already_imported(trans))
 
+        # same total written with more places
+        trans = Transaction(date=date, desc=desc, postings=[
+            Posting(account='account 1', quantity=Decimal('23.4500'))
+        ])
+        self.assertTrue(journal.already_imported(trans))
+
+        # more places than anything in the journal
+        trans = Transaction(date=date, desc=desc, postings=[
+            Posting(account='account 1', quantity=Decimal('23.4501'))
+        ])
+        self.assertFalse(journal.already_imported(trans))
+
     def test_is_mirror_trans(self):
         date = datetime(2016, 3, 20)
         desc = 'desc desc desc'
@@ -355,6 +827,993 @@ account Income
         trans = Transaction(date=datetime(2016, 4, 2), desc=desc, postings=postings)
         self.assertFalse(journal.is_mirror_trans(trans))
 
+        # original added after the index was built, dated after its mirror
+        journal.add_transaction(Transaction(date=datetime(2016, 4, 30), desc=desc,
+            postings=postings))
+        trans = Transaction(date=datetime(2016, 4, 2), desc=desc, postings=[
+            Posting(account=p.account, quantity=Decimal(str(-p.quantity)))
+            for p in postings[::-1]
+        ])
+        self.assertTrue(journal.is_mirror_trans(trans))
+
+class TestJournalCache(TestCase):
+    test_data = """account Expenses
+
+2016/02/26 FairPoint Communi Bill Pmt W/D
+  Assets:NECU:Checking $-68.47
+  Expenses:Utilities
+
+"""
+
+    def setUp(self):
+        self.tmp = TemporaryDirectory()
+        self.fn = os.path.join(self.tmp.name, 'accounts.dat')
+        with open(self.fn, 'w') as f:
+            f.write(self.test_data)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_load_uses_cache(self):
+        journal = Journal.load(self.fn)
+        self.assertTrue(os.path.exists(self.fn + '.cache'))
+
+        with patch.object(Journal, 'parse_lines') as parse_lines:
+            cached = Journal.load(self.fn)
+        parse_lines.assert_not_called()
+        self.assertEqual(str(cached), str(journal))
+        self.assertEqual(cached.by_quantity.keys(), journal.by_quantity.keys())
+
+    def test_load_stale_cache(self):
+        Journal.load(self.fn)
+        with open(self.fn, 'a') as f:
+            f.write('2016/02/27 Bantam Market\n  Assets:NECU:Checking $-1.00\n  Expenses\n\n')
+
+        journal = Journal.load(self.fn)
+        self.assertEqual(len(journal.transactions), 2)
+
+    def test_write_refreshes_cache(self):
+        "Saving an import caches what was written, so the next load need not parse"
+        journal = Journal.load(self.fn)
+        journal.accounts.add('Expenses:Groceries')
+        for date in [datetime(2016, 2, 1), datetime(2016, 3, 1)]:
+            journal.add_transaction(Transaction(date, 'Bantam Market', [
+                Posting('Assets:NECU:Checking', Decimal('-1.50')),
+                Posting('Expenses:Groceries'),
+            ]))
+        self.assertTrue(write_journal(journal, self.fn, cache=True))
+
+        with patch.object(Journal, 'parse_lines') as parse_lines:
+            cached = Journal.load(self.fn)
+        parse_lines.assert_not_called()
+        self.assertEqual(cached.snapshot(), Journal.parse_file(self.fn).snapshot())
+
+    def test_load_corrupt_cache(self):
+        with open(self.fn + '.cache', 'wb') as f:
+            f.write(b'not a pickle')
+
+        journal = Journal.load(self.fn)
+        self.assertEqual(len(journal.transactions), 1)
+
+class TestParallelParse(TestCase):
+    def journal_data(self):
+        lines = ['account Assets:Checking', '', '; /Rent/ Expenses:Rent', '']
+        for i in range(60):
+            # the same description with more accounts than DescriptionMap keeps
+            lines.extend([
+                '2016/{:02}/{:02} {}'.format(i // 28 + 1, i % 28 + 1, 'Rent' if i % 3 else 'Misc'),
+                '  Assets:Checking    ${}.{:02}'.format(-i, i),
+                '  Expenses:{}'.format(i % 11),
+                '',
+            ])
+        lines.append('P 2016/03/01 00:00:00 VFIAX $200')
+        lines.append('')
+        return '\r\n'.join(lines).encode('utf-8')
+
+    def test_chunk_ranges(self):
+        data = self.journal_data()
+        ranges = chunk_ranges(data, 8)
+        self.assertEqual(len(ranges), 8)
+        self.assertEqual(ranges[0][0], 0)
+        self.assertEqual(ranges[-1][1], len(data))
+        for (start, end), (next_start, next_end) in zip(ranges, ranges[1:]):
+            self.assertEqual(end, next_start)
+            self.assertTrue(data[:end].endswith(b'\r\n\r\n'))
+        self.assertEqual(chunk_ranges(b'no blank lines\n', 4), [(0, 15)])
+
+    def test_parse_parallel(self):
+        data = self.journal_data()
+        expected = Journal.parse_bytes(data)
+        journal = Journal.parse_parallel(data, 2)
+        self.assertEqual(str(journal), str(expected))
+        self.assertEqual(len(journal.transactions), 60)
+        self.assertEqual(journal.by_quantity.keys(), expected.by_quantity.keys())
+        self.assertEqual(journal.regexes[0].account, 'Expenses:Rent')
+        self.assertEqual(len(journal.prices), 1)
+        for desc in ['Rent', 'Misc']:
+            self.assertEqual(journal.description_map.candidates(desc),
+                expected.description_map.candidates(desc))
+        self.assertFalse(journal.has_changes())
+
+class TestJournalWriter(TestCase):
+    test_data = """account Assets:NECU:Checking
+account Expenses:Utilities
+
+; /^FairPoint/ Expenses:Utilities
+
+; hand-written comment that a full rewrite would drop
+2016/02/26 FairPoint Communi Bill Pmt W/D
+  Assets:NECU:Checking     $-68.47
+  Expenses:Utilities
+
+2016/03/26 FairPoint Communi Bill Pmt W/D
+  Assets:NECU:Checking     $-70.00
+  ; paid via a/b/c
+  Expenses:Utilities
+
+"""
+
+    def setUp(self):
+        self.tmp = TemporaryDirectory()
+        self.fn = os.path.join(self.tmp.name, 'accounts.dat')
+        with open(self.fn, 'w') as f:
+            f.write(self.test_data)
+        self.journal = Journal.parse_file(self.fn)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def read(self):
+        with open(self.fn) as f:
+            return f.read()
+
+    def test_no_changes(self):
+        with patch('journal_writer.atomic_write') as atomic_write:
+            self.assertFalse(write_journal(self.journal, self.fn))
+        atomic_write.assert_not_called()
+
+    def test_splice(self):
+        self.journal.accounts.add('Expenses:Groceries')
+        self.journal.regexes.append(AccountRegEx('Expenses:Groceries', '^Bantam'))
+        self.journal.transactions.append(Transaction(
+            datetime(2016, 3, 1), 'Bantam Market',
+            [Posting('Assets:NECU:Checking', Decimal('-12.00')), Posting('Expenses:Groceries')]
+        ))
+        self.journal.transactions.append(Transaction(
+            datetime(2016, 4, 1), 'Bantam Market',
+            [Posting('Assets:NECU:Checking', Decimal('-3.00')), Posting('Expenses:Groceries')]
+        ))
+
+        self.assertTrue(write_journal(self.journal, self.fn))
+        self.assertFalse(self.journal.has_changes())
+        self.assertEqual(self.read(), """account Assets:NECU:Checking
+account Expenses:Groceries
+account Expenses:Utilities
+
+; /^FairPoint/ Expenses:Utilities
+; /^Bantam/ Expenses:Groceries
+
+; hand-written comment that a full rewrite would drop
+2016/02/26 FairPoint Communi Bill Pmt W/D
+  Assets:NECU:Checking     $-68.47
+  Expenses:Utilities
+
+2016/03/01 Bantam Market
+  Assets:NECU:Checking    $-12.00
+  Expenses:Groceries
+
+2016/03/26 FairPoint Communi Bill Pmt W/D
+  Assets:NECU:Checking     $-70.00
+  ; paid via a/b/c
+  Expenses:Utilities
+
+2016/04/01 Bantam Market
+  Assets:NECU:Checking    $-3.00
+  Expenses:Groceries
+
+""")
+
+        reparsed = Journal.parse_file(self.fn)
+        self.assertEqual(str(reparsed), str(self.journal))
+
+class TestBalanceEngine(TestCase):
+    def setUp(self):
+        self.transactions = [
+            Transaction(datetime(2016, 2, 26), 'FairPoint Communi Bill Pmt W/D', [
+                Posting('Assets:NECU:Checking', Decimal('-68.47')),
+                Posting('Expenses:Utilities'),
+            ]),
+            Transaction(datetime(2016, 2, 27), 'Buy VFIAX', [
+                Posting('Assets:Vanguard:CTC IRA', Decimal('1.5'), 'VFIAX', Decimal('200')),
+                Posting('Assets:NECU:Checking'),
+            ]),
+            Transaction(datetime(2016, 2, 28), 'Transfer to Ally', [
+                Posting('Assets:NECU:Checking', Decimal('-100.00')),
+                Posting('Assets:Ally Bank:Money Market', Decimal('100.00')),
+            ]),
+        ]
+
+    def test_posting_amounts(self):
+        self.assertEqual(list(posting_amounts(self.transactions[1])), [
+            ('Assets:Vanguard:CTC IRA', 'VFIAX', Decimal('1.5')),
+            ('Assets:NECU:Checking', '$', Decimal('-300.0')),
+        ])
+        with self.assertRaises(Exception):
+            list(posting_amounts(Transaction(datetime(2016, 1, 1), 'x', [
+                Posting('Assets:NECU:Checking'), Posting('Expenses:Utilities')])))
+
+    def test_rollup(self):
+        engine = BalanceEngine(self.transactions)
+        self.assertEqual(engine.balance('Assets:NECU:Checking'), {'$': Decimal('-468.47')})
+        self.assertEqual(engine.balance('Assets'), {
+            '$': Decimal('-368.47'), 'VFIAX': Decimal('1.5')})
+        self.assertEqual(engine.balance('Assets', rollup=False), {})
+        self.assertEqual(engine.balance('Expenses'), {'$': Decimal('68.47')})
+        self.assertEqual(engine.accounts(['Assets:N']), ['Assets:NECU', 'Assets:NECU:Checking'])
+        self.assertEqual(engine.report(['Expenses']), [
+            '              $68.47  Expenses',
+            '              $68.47  Expenses:Utilities',
+        ])
+
+    def test_incremental(self):
+        "Balances follow transactions added to the journal"
+        journal = Journal(self.transactions[:1])
+        engine = journal.balances()
+        self.assertEqual(engine.balance('Assets'), {'$': Decimal('-68.47')})
+        for trans in self.transactions[1:]:
+            journal.add_transaction(trans)
+        self.assertIs(journal.balances(), engine)
+        self.assertEqual(engine.balance('Assets'),
+            BalanceEngine(self.transactions).balance('Assets'))
+
+class TestPriceIndex(TestCase):
+    def setUp(self):
+        self.prices = [
+            Price(datetime(2016, 1, 1), 'VFIAX', Decimal('180')),
+            Price(datetime(2016, 3, 1), 'VFIAX', Decimal('190')),
+            Price(datetime(2016, 2, 1), 'VBTLX', Decimal('10')),
+        ]
+        self.transactions = [
+            Transaction(datetime(2016, 1, 15), 'Transfer to Vanguard', [
+                Posting('Assets:Vanguard:CTC IRA', Decimal('1000')),
+                Posting('Assets:NECU:Checking'),
+            ]),
+            Transaction(datetime(2016, 2, 1), 'Buy VFIAX', [
+                Posting('Assets:Vanguard:CTC IRA', Decimal('2'), 'VFIAX', Decimal('200')),
+                Posting('Assets:Vanguard:CTC IRA'),
+            ]),
+            Transaction(datetime(2016, 2, 10), 'Groceries', [
+                Posting('Assets:NECU:Checking', Decimal('-50')),
+                Posting('Expenses:Groceries'),
+            ]),
+        ]
+        self.index = PriceIndex(self.prices, self.transactions)
+
+    def test_price(self):
+        self.assertEqual(self.index.price('VFIAX', datetime(2015, 12, 31)), None)
+        self.assertEqual(self.index.price('VFIAX', datetime(2016, 1, 31)), Decimal('180'))
+        self.assertEqual(self.index.price('VFIAX', datetime(2016, 2, 1)), Decimal('200'))
+        self.assertEqual(self.index.price('VFIAX', datetime(2016, 3, 1)), Decimal('190'))
+        self.assertEqual(self.index.price('$', datetime(2016, 3, 1)), Decimal(1))
+        self.index.add(datetime(2016, 3, 1), 'VFIAX', Decimal('191'))
+        self.assertEqual(self.index.price('VFIAX', datetime(2016, 3, 1)), Decimal('191'))
+        self.assertEqual(
+            self.index.value({'VFIAX': Decimal('2'), '$': Decimal('5'), 'XXX': Decimal('1')},
+                datetime(2016, 2, 15)),
+            Decimal('405')
+        )
+
+    def test_net_worth(self):
+        dates = month_ends(datetime(2016, 1, 15), datetime(2016, 3, 2))
+        self.assertEqual(dates, [datetime(2016, 1, 31), datetime(2016, 2, 29), datetime(2016, 3, 31)])
+        series = self.index.net_worth(self.transactions, dates + [datetime(2015, 1, 1)])
+        self.assertEqual(series, [
+            (datetime(2015, 1, 1), Decimal(0)),
+            (datetime(2016, 1, 31), Decimal(0)),
+            (datetime(2016, 2, 29), Decimal('-50')),
+            (datetime(2016, 3, 31), Decimal('-70')),
+        ])
+        # the same as valuing each date's balances on their own
+        for date, value in series:
+            engine = BalanceEngine(t for t in self.transactions if t.date <= date)
+            self.assertEqual(self.index.value(engine.balance('Assets'), date), value)
+
+    def test_journal(self):
+        journal = Journal(self.transactions[:1], prices=self.prices)
+        index = journal.price_index()
+        self.assertEqual(index.price('VFIAX', datetime(2016, 2, 1)), Decimal('180'))
+        journal.add_transaction(self.transactions[1])
+        self.assertEqual(index.price('VFIAX', datetime(2016, 2, 1)), Decimal('200'))
+
+class TestExport(TestCase):
+    def test_bundle(self):
+        journal = Journal([
+            Transaction(datetime(2016, 2, 1), 'Buy VFIAX', [
+                Posting('Assets:Vanguard', Decimal('1.5'), 'VFIAX', Decimal('200')),
+                Posting('Assets:Checking'),
+            ]),
+            Transaction(datetime(2016, 1, 31), 'FairPoint', [
+                Posting('Assets:Checking', Decimal('-68.47')),
+                Posting('Expenses:Utilities'),
+            ]),
+            Transaction(datetime(2016, 2, 5), 'FairPoint', [
+                Posting('Assets:Checking', Decimal('-10.00')),
+                Posting('Expenses:Utilities'),
+            ]),
+        ], prices=[Price(datetime(2016, 1, 1), 'VFIAX', Decimal('180'))])
+        data = bundle(journal)
+
+        self.assertEqual(data['descs'], ['FairPoint', 'Buy VFIAX'])
+        self.assertEqual(data['accounts'], ['Assets:Checking', 'Expenses:Utilities', 'Assets:Vanguard'])
+        self.assertEqual(data['transactions'], {
+            'date': [16831, 16832, 16836], 'desc': [0, 1, 0], 'start': [0, 2, 4, 6]})
+        self.assertEqual(data['postings']['quantity'],
+            ['-68.47', None, '1.5', None, '-10.00', None])
+        self.assertEqual(data['postings']['unit_price'], [None, None, '200', None, None, None])
+        self.assertEqual(data['prices'], {'VFIAX': {'date': [16801, 16832], 'price': ['180', '200']}})
+        self.assertEqual(data['months'], ['2016/01', '2016/02'])
+        monthly = data['monthly']
+        cells = dict(
+            ((data['months'][m], data['accounts'][a], data['commodities'][c]), total)
+            for m, a, c, total in zip(monthly['month'], monthly['account'],
+                monthly['commodity'], monthly['total'])
+        )
+        self.assertEqual(cells[('2016/02', 'Assets:Checking', '$')], '-310.00')
+        self.assertEqual(cells[('2016/02', 'Assets:Vanguard', 'VFIAX')], '1.5')
+        self.assertEqual(len(cells), 5)
+
+    def test_dashboard_fixture(self):
+        "src/lib/bundle.test.js checks that this bundle loads as priced.dat parses"
+        fixtures = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+            '..', 'src', 'lib', 'fixtures')
+        with open(os.path.join(fixtures, 'priced.json')) as f:
+            expected = json.load(f)
+        journal = Journal.parse_file(os.path.join(fixtures, 'priced.dat'))
+        self.assertEqual(json.loads(json.dumps(bundle(journal))), expected)
+
+@skipUnless(numpy, 'needs numpy')
+class TestAggregateCube(TestCase):
+    def setUp(self):
+        self.transactions = [
+            Transaction(datetime(2016, 2, 1), 'Paycheck', [
+                Posting('Assets:NECU:Checking', Decimal('1000')),
+                Posting('Income:Salary'),
+            ]),
+            Transaction(datetime(2016, 2, 10), 'Groceries', [
+                Posting('Assets:NECU:Checking', Decimal('-50')),
+                Posting('Expenses:Groceries'),
+            ]),
+            Transaction(datetime(2016, 4, 10), 'Buy VFIAX', [
+                Posting('Assets:Vanguard:CTC IRA', Decimal('2'), 'VFIAX', Decimal('200')),
+                Posting('Assets:NECU:Checking'),
+            ]),
+        ]
+
+    def test_series(self):
+        cube = AggregateCube(self.transactions)
+        self.assertEqual(cube.months(), ['2016/02', '2016/03', '2016/04'])
+        self.assertEqual(list(cube.series(['Income'])), [-1000, 0, 0])
+        self.assertEqual(list(cube.series(['Assets'], cumulative=True)), [950, 950, 550])
+        self.assertEqual(list(cube.series(['Assets'], 'VFIAX')), [0, 0, 2])
+        self.assertEqual(list(cube.series(['Assets'], 'XXX')), [0, 0, 0])
+        rollup = cube.rollup(2, prefixes=['Assets'])
+        self.assertEqual(sorted(rollup), ['Assets:NECU', 'Assets:Vanguard'])
+        self.assertEqual(list(rollup['Assets:NECU']), [950, 0, -400])
+        self.assertEqual(cube.value('2016/02', 'Expenses:Groceries'), 50)
+        self.assertEqual(cube.value('2015/02', 'Expenses:Groceries'), 0)
+
+    def test_incremental(self):
+        "Adding one at a time, in any order, matches building at once"
+        journal = Journal(self.transactions[2:])
+        cube = journal.cube()
+        for trans in reversed(self.transactions[:2]):
+            journal.add_transaction(trans)
+        journal.add_transaction(Transaction(datetime(2015, 12, 31), 'Gift', [
+            Posting('Assets:NECU:Checking', Decimal('25')),
+            Posting('Income:Gifts'),
+        ]))
+        self.assertEqual(cube.months()[0], '2015/12')
+        expected = AggregateCube(journal.transactions)
+        for prefix in ['Assets', 'Income', 'Expenses']:
+            self.assertEqual(list(cube.series([prefix])), list(expected.series([prefix])))
+        self.assertEqual(list(cube.series(['Income:Gifts'])), [-25, 0, 0, 0, 0])
+
+class TestJournalServer(TestCase):
+    journal = '\n'.join([
+        'P 2016/01/01 00:00:00 VFIAX $180',
+        '',
+        '2016/02/01 Buy VFIAX',
+        '    Assets:Vanguard  1.5 VFIAX @ $200',
+        '    Assets:Checking',
+        '',
+        '2016/02/05 FairPoint',
+        '    Assets:Checking  $-68.47',
+        '    Expenses:Utilities',
+        '',
+        '',
+    ])
+
+    def setUp(self):
+        self.tmp = TemporaryDirectory()
+        self.fn = os.path.join(self.tmp.name, 'journal.dat')
+        with open(self.fn, 'w') as f:
+            f.write(self.journal)
+        self.server = JournalServer(self.fn, use_cache=False)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def get(self, target, headers={}):
+        status, response_headers, body = self.server.respond('GET', target, headers)
+        return status, response_headers, json.loads(body.decode('utf-8')) if body else None
+
+    def test_queries(self):
+        status, headers, body = self.get('/balances?account=Assets:Checking')
+        self.assertEqual(status, 200)
+        self.assertEqual(body, {'Assets:Checking': {'$': '-368.47'}})
+
+        status, headers, body = self.get('/register?account=Expenses&start=2016/02/02')
+        self.assertEqual([row['desc'] for row in body], ['FairPoint'])
+        self.assertEqual(body[0]['postings'][1], ['Expenses:Utilities', '$', None])
+
+        status, headers, body = self.get('/prices?commodity=VFIAX&date=2016/01/15')
+        self.assertEqual(body, {'VFIAX': '180'})
+
+        self.assertEqual(self.get('/register?start=yesterday')[0], 400)
+        self.assertEqual(self.get('/nothing')[0], 404)
+        self.assertEqual(self.server.respond('POST', '/balances', {})[0], 405)
+
+    @skipUnless(numpy, 'needs numpy')
+    def test_aggregate(self):
+        status, headers, body = self.get('/aggregate?account=Expenses&cumulative=1')
+        self.assertEqual(body, {'months': ['2016/02'], 'values': [68.47]})
+
+    def test_aggregate_without_numpy(self):
+        with patch('cube.numpy', None):
+            status, headers, body = self.get('/aggregate?account=Expenses')
+        self.assertEqual(status, 501)
+        self.assertIn('numpy', body['error'])
+        self.assertEqual(self.get('/balances?account=Assets:Checking')[0], 200)
+
+    def test_etag(self):
+        status, headers, body = self.get('/balances')
+        etag = headers['ETag']
+        self.assertEqual(self.get('/balances', {'if-none-match': etag})[0], 304)
+        self.assertNotEqual(self.get('/balances?account=Assets')[1]['ETag'], etag)
+
+        # a changed file means a new version, so the old tag no longer matches
+        with open(self.fn, 'a') as f:
+            f.write('2016/02/06 FairPoint\n    Assets:Checking  $-1.00\n    Expenses:Utilities\n\n')
+        os.utime(self.fn, ns=(0, 0))
+        self.assertTrue(asyncio.run(self.server.reload()))
+        self.assertFalse(asyncio.run(self.server.reload()))
+        status, headers, body = self.get('/balances?account=Assets:Checking',
+            {'if-none-match': etag})
+        self.assertEqual(status, 200)
+        self.assertEqual(body, {'Assets:Checking': {'$': '-369.47'}})
+
+    async def request(self, reader, writer, lines, body=b''):
+        "Sends one request and returns (status, headers, body) of its response"
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + body)
+        status = (await reader.readline()).decode('latin-1').split()[1]
+        headers = {}
+        while True:
+            line = (await reader.readline()).decode('latin-1').strip()
+            if not line:
+                break
+            name, value = line.split(': ', 1)
+            headers[name] = value
+        return status, headers, await reader.readexactly(int(headers['Content-Length']))
+
+    def exchange(self, *conversations):
+        "Runs each conversation(reader, writer) on its own connection to the server"
+        async def run():
+            server = await asyncio.start_server(self.server.handle, '127.0.0.1', 0)
+            port = server.sockets[0].getsockname()[1]
+
+            async def connect(conversation):
+                reader, writer = await asyncio.open_connection('127.0.0.1', port)
+                try:
+                    return await conversation(reader, writer)
+                finally:
+                    writer.close()
+
+            try:
+                return await asyncio.gather(*[connect(c) for c in conversations])
+            finally:
+                server.close()
+                await server.wait_closed()
+        return asyncio.run(run())
+
+    def test_http(self):
+        "Two requests on one connection, the second conditional"
+        async def conversation(reader, writer):
+            lines = ['GET /balances HTTP/1.1', 'Host: localhost']
+            first = await self.request(reader, writer, lines)
+            second = await self.request(reader, writer,
+                lines + ['If-None-Match: {}'.format(first[1]['ETag'])])
+            return first, second
+
+        [(first, second)] = self.exchange(conversation)
+        self.assertEqual(first[0], '200')
+        self.assertIn(b'"Expenses:Utilities"', first[2])
+        self.assertEqual((second[0], second[2]), ('304', b''))
+
+    def test_http_body(self):
+        "A request body is skipped, so the next request on the connection is read right"
+        async def conversation(reader, writer):
+            body = b'GET /nothing HTTP/1.1\r\n\r\n'
+            posted = await self.request(reader, writer, ['POST /balances HTTP/1.1',
+                'Content-Length: {}'.format(len(body))], body)
+            got = await self.request(reader, writer, ['GET /balances HTTP/1.1'])
+            chunked = await self.request(reader, writer, ['PUT /balances HTTP/1.1',
+                'Transfer-Encoding: chunked'], b'5\r\nhello\r\n0\r\n\r\n')
+            return posted[0], got[0], chunked[0], chunked[1]['Connection'], await reader.read()
+
+        [result] = self.exchange(conversation)
+        self.assertEqual(result, ('405', '200', '405', 'close', b''))
+
+    def test_http_slow_query(self):
+        "A query in progress does not hold up requests that need no work"
+        started = threading.Event()
+        finish = threading.Event()
+        def slow(query):
+            started.set()
+            # released by the conditional request; blocking the loop would time out
+            return {'released': finish.wait(2)}
+        self.server.handlers['/slow'] = slow
+
+        async def waiting(reader, writer):
+            return await self.request(reader, writer, ['GET /slow HTTP/1.1'])
+
+        async def conditional(reader, writer):
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(None, started.wait, 5)
+            response = await self.request(reader, writer, ['GET /balances HTTP/1.1',
+                'If-None-Match: {}'.format(self.server.etag('/balances'))])
+            finish.set()
+            return response[0]
+
+        slow_response, conditional_status = self.exchange(waiting, conditional)
+        self.assertEqual(conditional_status, '304')
+        self.assertEqual(json.loads(slow_response[2].decode('utf-8')), {'released': True})
+
+class TestSqliteJournal(TestCase):
+    journal = '\n'.join([
+        'account Assets:Checking',
+        'account Expenses:Utilities',
+        '',
+        'P 2016/01/01 00:00:00 VFIAX $180',
+        '',
+        '; /FairPoint/ Expenses:Utilities',
+        '',
+        '2016/02/05 FairPoint',
+        '  Assets:Checking    $-68.47',
+        '  Expenses:Utilities',
+        '',
+        '2016/02/01 Buy VFIAX',
+        '  Assets:Vanguard    1.5 VFIAX @ $200',
+        '  Assets:Checking',
+        '',
+        '2016/03/01 Transfer',
+        '  Assets:Checking    $100.00',
+        '  Assets:Savings    $-100.00',
+        '',
+        '',
+    ])
+
+    def setUp(self):
+        self.tmp = TemporaryDirectory()
+        self.fn = os.path.join(self.tmp.name, 'journal.dat')
+        self.db_fn = os.path.join(self.tmp.name, 'journal.db')
+        with open(self.fn, 'w') as f:
+            f.write(self.journal)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def open(self):
+        return SqliteJournal.open(self.db_fn, self.fn, use_cache=False)
+
+    def test_round_trip(self):
+        parsed = Journal.parse_file(self.fn)
+        text = str(parsed)
+        journal = self.open()
+        self.assertEqual(str(journal), text)
+        journal.db.close()
+
+        # reopened without the ledger file
+        journal = SqliteJournal.open(self.db_fn)
+        self.assertEqual(journal._transactions, None)
+        self.assertEqual(str(journal), text)
+        self.assertEqual(journal.description_map.entries, parsed.description_map.entries)
+        self.assertEqual([(r.account, r.regex) for r in journal.regexes],
+            [('Expenses:Utilities', 'FairPoint')])
+        self.assertEqual(journal.balances().balance('Assets:Vanguard'), {'VFIAX': Decimal('1.5')})
+        self.assertEqual([t.desc for t in journal.register(['Expenses'])], ['FairPoint'])
+        self.assertEqual([t.desc for t in journal.register(['Assets:Check'])], [])
+        self.assertEqual(
+            [t.desc for t in journal.register(['Assets:Checking'], start=datetime(2016, 2, 2))],
+            ['FairPoint', 'Transfer'])
+
+    def test_lookups(self):
+        journal = self.open()
+        self.assertTrue(journal.already_imported(Transaction(datetime(2016, 2, 5), 'FairPoint', [
+            Posting('Assets:Checking', Decimal('-68.470')),
+            Posting('Expenses:Utilities'),
+        ])))
+        self.assertFalse(journal.already_imported(Transaction(datetime(2016, 2, 6), 'FairPoint', [
+            Posting('Assets:Checking', Decimal('-68.47')),
+        ])))
+
+        mirror = Transaction(datetime(2016, 3, 14), 'Transfer', [
+            Posting('Assets:Savings', Decimal('100')),
+            Posting('Assets:Checking', Decimal('-100')),
+        ])
+        self.assertTrue(journal.is_mirror_trans(mirror))
+        mirror.date = datetime(2016, 3, 15)
+        self.assertFalse(journal.is_mirror_trans(mirror))
+
+        # added transactions are found before they are saved
+        journal.add_transaction(mirror)
+        self.assertTrue(journal.already_imported(mirror))
+
+    def test_save(self):
+        journal = self.open()
+        trans = Transaction(datetime(2016, 2, 20), 'Comcast', [
+            Posting('Assets:Checking', Decimal('-50.00')),
+            Posting('Expenses:Internet'),
+        ])
+        journal.accounts.add('Expenses:Internet')
+        journal.add_desc_to_map(trans.desc, 'Expenses:Internet', trans.date)
+        journal.regexes.append(AccountRegEx('Expenses:Internet', 'Comcast'))
+        journal.add_transaction(trans)
+        self.assertTrue(journal.has_changes())
+
+        # closing without saving keeps none of it
+        journal.db.close()
+        journal = self.open()
+        self.assertFalse(journal.already_imported(trans))
+
+        expected = Journal.parse_file(self.fn)
+        for j in [journal, expected]:
+            j.accounts.add('Expenses:Internet')
+            j.add_desc_to_map(trans.desc, 'Expenses:Internet', trans.date)
+            j.regexes.append(AccountRegEx('Expenses:Internet', 'Comcast'))
+            j.add_transaction(trans)
+        self.assertTrue(journal.save())
+        self.assertFalse(journal.save())
+        journal.db.close()
+
+        journal = self.open()
+        self.assertEqual(str(journal), str(expected))
+        self.assertEqual(journal.description_map.candidates('Comcast'), ['Expenses:Internet'])
+        output = os.path.join(self.tmp.name, 'out.dat')
+        journal.export(output)
+        with open(output) as f:
+            self.assertEqual(f.read(), str(expected))
+
+class TestLazyJournal(TestCase):
+    journal = '\n'.join([
+        'account Assets:Checking',
+        'account Expenses:Utilities',
+        '',
+        'P 2016/01/01 00:00:00 VFIAX $180',
+        '',
+        '; /FairPoint/ Expenses:Utilities',
+        '',
+        '2016/01/05 FairPoint',
+        '  Assets:Checking    $-68.47',
+        '  Expenses:Utilities',
+        '',
+        '2016/03/01 Transfer',
+        '  Assets:Checking    $100.00',
+        '  Assets:Savings    $-100.00',
+        '',
+        '; moved here by hand',
+        '2016/02/01 Buy VFIAX',
+        '  Assets:Vanguard    1.5 VFIAX @ $200',
+        '  Assets:Checking',
+        '',
+        '2016/04/01 Unfinished',
+        '  Assets:Checking    $1.00',
+    ])
+
+    def setUp(self):
+        self.tmp = TemporaryDirectory()
+        self.fn = os.path.join(self.tmp.name, 'journal.dat')
+        with open(self.fn, 'w') as f:
+            f.write(self.journal)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def decoded(self, journal):
+        return [trans.desc for trans in journal.decoded if trans is not None]
+
+    def test_lazy(self):
+        expected = Journal.parse_file(self.fn)
+        journal = LazyJournal(self.fn)
+        self.assertEqual(sorted(journal.accounts), sorted(expected.accounts))
+        self.assertEqual([str(r) for r in journal.regexes], [str(r) for r in expected.regexes])
+        self.assertEqual([r.account for r in journal.regexes], ['Expenses:Utilities'])
+        self.assertEqual([str(p) for p in journal.prices], [str(p) for p in expected.prices])
+        self.assertEqual(self.decoded(journal), [])
+
+        self.assertTrue(journal.already_imported(Transaction(datetime(2016, 3, 1), 'Transfer', [
+            Posting('Assets:Checking', Decimal('100')),
+            Posting('Assets:Savings', Decimal('-100.0')),
+        ])))
+        self.assertEqual(self.decoded(journal), ['Transfer'])
+        self.assertEqual([t.desc for t in journal.between(datetime(2016, 2, 1))],
+            ['Buy VFIAX', 'Transfer'])
+        self.assertEqual(self.decoded(journal), ['Transfer', 'Buy VFIAX'])
+
+        mirror = Transaction(datetime(2016, 1, 15), 'FairPoint', [
+            Posting('Expenses:Utilities'),
+            Posting('Assets:Checking', Decimal('68.47')),
+        ])
+        self.assertTrue(journal.is_mirror_trans(mirror))
+        mirror.date = datetime(2016, 1, 19)
+        self.assertFalse(journal.is_mirror_trans(mirror))
+
+        self.assertEqual(str(journal), str(expected))
+        self.assertEqual(journal.description_map.entries, expected.description_map.entries)
+
+    def test_import(self):
+        "Suggesting and recording accounts only decodes the dates being checked"
+        expected = Journal.parse_file(self.fn)
+        cmd = LedgerImportCmd()
+        cmd.journal = LazyJournal(self.fn)
+        cmd.new_transactions = [Transaction(datetime(2016, 3, 20), 'Transfer', [
+            Posting('Assets:Checking', Decimal('-5.00')),
+        ])]
+        with patch('builtins.print'):
+            self.assertTrue(cmd.process_transactions(check_already_imported=True))
+        self.assertEqual([t.postings[-1].account for t in cmd.journal.added], ['Assets:Savings'])
+        self.assertEqual(self.decoded(cmd.journal), [])
+
+        # later loads read the map from the sidecar
+        with patch('lazy_journal.scan_descriptions') as scan:
+            journal = LazyJournal(self.fn)
+            self.assertEqual(journal.description_map.entries, expected.description_map.entries)
+        scan.assert_not_called()
+
+    def test_write(self):
+        "Writing an import splices it in without decoding anything else"
+        trans = Transaction(datetime(2016, 3, 2), 'Comcast', [
+            Posting('Assets:Checking', Decimal('-50.00')),
+            Posting('Expenses:Internet'),
+        ])
+        expected = Journal.parse_file(self.fn)
+        journal = LazyJournal(self.fn)
+        for j, fn in [(expected, 'expected.dat'), (journal, 'lazy.dat')]:
+            j.accounts.add('Expenses:Internet')
+            j.add_transaction(trans)
+            write_journal(j, self.fn, os.path.join(self.tmp.name, fn))
+        self.assertEqual(self.decoded(journal), [])
+
+        with open(os.path.join(self.tmp.name, 'expected.dat')) as f, \
+            open(os.path.join(self.tmp.name, 'lazy.dat')) as g:
+            self.assertEqual(g.read(), f.read())
+
+class TestShardedJournal(TestCase):
+    journal = TestLazyJournal.journal.replace('2016/04/01', '2015/12/30') + '\n\n'
+
+    def setUp(self):
+        self.tmp = TemporaryDirectory()
+        self.fn = os.path.join(self.tmp.name, 'journal.dat')
+        with open(self.fn, 'w') as f:
+            f.write(self.journal)
+        parsed = Journal.parse_file(self.fn)
+        # shards hold their transactions by date, so compare with a journal that does
+        self.expected = Journal.parse_lines(StringIO(str(Journal(
+            list(parsed.sorted_transactions()), accounts=parsed.accounts,
+            regexes=parsed.regexes, prices=parsed.prices, commodities=parsed.commodities,
+        ))))
+        self.root = os.path.join(self.tmp.name, 'root.dat')
+        split_journal(self.expected, self.root)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def read(self, name):
+        with open(os.path.join(self.tmp.name, name)) as f:
+            return f.read()
+
+    def test_split(self):
+        root = Journal.load(self.root, includes=False)
+        self.assertEqual(root.includes, ['2015.dat', '2016.dat'])
+        self.assertEqual(root.transactions, [])
+        self.assertIn('include 2015.dat\ninclude 2016.dat\n', self.read('root.dat'))
+
+        joined = Journal.load(self.root)
+        self.assertEqual(joined.includes, [])
+        self.assertEqual(str(joined), str(self.expected))
+        self.assertEqual(joined.description_map.entries, self.expected.description_map.entries)
+
+    def test_lookups(self):
+        journal = ShardedJournal(self.root)
+        self.assertEqual(journal.shards, {})
+        self.assertTrue(journal.already_imported(Transaction(datetime(2016, 3, 1), 'Transfer', [
+            Posting('Assets:Checking', Decimal('100')),
+            Posting('Assets:Savings', Decimal('-100.0')),
+        ])))
+        self.assertEqual(sorted(journal.shards), [2016])
+        self.assertFalse(journal.is_mirror_trans(Transaction(datetime(2016, 1, 20), 'Transfer', [
+            Posting('Assets:Checking', Decimal('-5')),
+            Posting('Assets:Savings', Decimal('5')),
+        ])))
+        self.assertEqual(sorted(journal.shards), [2016])
+        self.assertFalse(journal.is_mirror_trans(Transaction(datetime(2016, 1, 10), 'Unfinished', [
+            Posting('Assets:Checking', Decimal('-1.00')),
+        ])))
+        self.assertEqual(sorted(journal.shards), [2015, 2016])
+
+        self.assertEqual([t.desc for t in journal.sorted_transactions()],
+            [t.desc for t in self.expected.sorted_transactions()])
+        self.assertEqual(journal.description_map.entries, self.expected.description_map.entries)
+
+    def test_save(self):
+        "An import only rewrites the shards it touches, and the root when it changes"
+        root, old = self.read('root.dat'), self.read('2015.dat')
+        journal = ShardedJournal(self.root)
+        self.assertFalse(journal.save())
+
+        journal.add_transaction(Transaction(datetime(2016, 3, 2), 'Comcast', [
+            Posting('Assets:Checking', Decimal('-50.00')),
+            Posting('Expenses:Utilities'),
+        ]))
+        self.assertTrue(journal.save())
+        self.assertEqual(sorted(journal.shards), [2016])
+        self.assertEqual(self.read('root.dat'), root)
+        self.assertEqual(self.read('2015.dat'), old)
+        self.assertIn('2016/03/02 Comcast', self.read('2016.dat'))
+
+        journal.accounts.add('Expenses:Internet')
+        journal.add_transaction(Transaction(datetime(2017, 1, 2), 'Comcast', [
+            Posting('Assets:Checking', Decimal('-50.00')),
+            Posting('Expenses:Internet'),
+        ]))
+        self.assertTrue(journal.save())
+        self.assertEqual(self.read('2015.dat'), old)
+        self.assertIn('account Expenses:Internet\n', self.read('root.dat'))
+        self.assertIn('include 2016.dat\ninclude 2017.dat\n', self.read('root.dat'))
+
+        expected = Journal.load(self.root)
+        journal = ShardedJournal(self.root)
+        self.assertEqual(len(journal.transactions), len(self.expected.transactions) + 2)
+        self.assertEqual(str(journal), str(expected))
+        journal.export(os.path.join(self.tmp.name, 'flat.dat'))
+        self.assertEqual(self.read('flat.dat'), str(expected))
+
+    def test_save_refreshes_caches(self):
+        "The shards and root that save writes are cached as written"
+        Journal.load(self.root)
+        journal = ShardedJournal(self.root)
+        journal.accounts.add('Expenses:Internet')
+        for date in [datetime(2016, 1, 1), datetime(2017, 1, 2)]:
+            journal.add_transaction(Transaction(date, 'Comcast', [
+                Posting('Assets:Checking', Decimal('-50.00')),
+                Posting('Expenses:Internet'),
+            ]))
+        self.assertTrue(journal.save())
+
+        with patch.object(Journal, 'parse_lines') as parse_lines:
+            cached = Journal.load(self.root)
+        parse_lines.assert_not_called()
+        self.assertEqual(cached.snapshot(), Journal.load(self.root, use_cache=False).snapshot())
+
+    def test_server_reload(self):
+        "A server over the root reloads when an import only rewrites a shard"
+        server = JournalServer(self.root, use_cache=False)
+        etag = server.respond('GET', '/balances', {})[1]['ETag']
+
+        journal = ShardedJournal(self.root)
+        journal.add_transaction(Transaction(datetime(2016, 3, 2), 'Comcast', [
+            Posting('Assets:Checking', Decimal('-50.00')),
+            Posting('Expenses:Utilities'),
+        ]))
+        root = self.read('root.dat')
+        self.assertTrue(journal.save())
+        self.assertEqual(self.read('root.dat'), root)
+
+        self.assertTrue(asyncio.run(server.reload()))
+        self.assertEqual(len(server.journal.transactions), len(self.expected.transactions) + 1)
+        status, headers, body = server.respond('GET', '/balances', {'if-none-match': etag})
+        self.assertEqual(status, 200)
+        self.assertNotEqual(headers['ETag'], etag)
+
+    def test_description_map(self):
+        "Account suggestions read each shard's map from its sidecar, not the shard"
+        journal = ShardedJournal(self.root)
+        self.assertEqual(journal.description_map.entries, self.expected.description_map.entries)
+        self.assertEqual(journal.shards, {})
+
+        journal.add_transaction(Transaction(datetime(2016, 3, 2), 'Comcast', [
+            Posting('Assets:Checking', Decimal('-50.00')),
+            Posting('Expenses:Utilities'),
+        ]))
+        journal.save()
+        # only the shard that changed is scanned again
+        with patch('shards.scan_descriptions', wraps=scan_descriptions) as scan:
+            journal = ShardedJournal(self.root)
+            self.assertEqual(journal.description_map.entries,
+                Journal.load(self.root).description_map.entries)
+        self.assertEqual(scan.call_count, 1)
+        self.assertEqual(journal.shards, {})
+
+    def test_description_map_crowded(self):
+        "Descriptions with more accounts than the map keeps are recounted from the sidecars"
+        text = ''.join(
+            '{}/01/{:02d} Misc\n  Assets:Checking    $-1.00\n  Expenses:Misc{}\n\n'.format(
+                2014 + i % 2, i + 1, i % 9)
+            for i in range(12)
+        ) + '2016/01/01 Transfer\n  Assets:Checking    $1.00\n  Assets:Savings\n\n'
+        os.mkdir(os.path.join(self.tmp.name, 'crowded'))
+        root = os.path.join(self.tmp.name, 'crowded', 'root.dat')
+        split_journal(Journal.parse_lines(StringIO(text)), root)
+
+        journal = ShardedJournal(root)
+        self.assertEqual(journal.description_map.entries, Journal.load(root).description_map.entries)
+        self.assertEqual(journal.shards, {})
+
+    def test_include_cycle(self):
+        for name, include in [('self.dat', 'self.dat'), ('a.dat', 'b.dat'), ('b.dat', 'a.dat')]:
+            with open(os.path.join(self.tmp.name, name), 'w') as f:
+                f.write('include {}\n'.format(include))
+        for name in ['self.dat', 'a.dat']:
+            with self.assertRaisesRegex(Exception, 'include cycle: .*{} -> '.format(name)):
+                Journal.load(os.path.join(self.tmp.name, name))
+
+class TestTransactionStore(TestCase):
+    def test_round_trip(self):
+        transactions = [
+            Transaction(datetime(2016, 2, 26), 'FairPoint Communi Bill Pmt W/D', [
+                Posting('Assets:NECU:Checking', Decimal('-68.470')),
+                Posting('Expenses:Utilities'),
+            ]),
+            Transaction(datetime(2016, 4, 8), 'Asset Fees', [
+                Posting('Assets:Wells Fargo:401(k)', Decimal('-0.0210'), 'VFIAX',
+                    Decimal('188.9800')),
+                Posting('Assets:Wells Fargo:401(k)', Decimal('0')),
+            ]),
+        ]
+        store = TransactionStore.from_transactions(transactions)
+
+        self.assertEqual(len(store), 2)
+        self.assertEqual(store.accounts.names, [
+            'Assets:NECU:Checking', 'Expenses:Utilities', 'Assets:Wells Fargo:401(k)'
+        ])
+        for trans, view in zip(transactions, store):
+            self.assertEqual(view.date, trans.date)
+            self.assertEqual(view.desc, trans.desc)
+            self.assertEqual(view.total, trans.total)
+            self.assertEqual(view.accounts, tuple(p.account for p in trans.postings))
+            self.assertEqual(str(view), str(trans))
+        self.assertEqual(str(store[-1].total), '-0.0210')
+        with self.assertRaises(IndexError):
+            store[2]
+
+    def test_amount_range(self):
+        store = TransactionStore()
+        for quantity in ['1E-40000', '1E+40000', '-12345678901234567890', 'NaN']:
+            with self.assertRaises(Exception):
+                store.append(Transaction(datetime(2016, 2, 26), 'Huge', [
+                    Posting('Assets:Checking', Decimal(quantity)),
+                ]))
+            self.assertEqual((len(store), len(store.account_ids)), (0, 0))
+
+        # -128 was the missing amount marker when exponents were one byte
+        store.append(Transaction(datetime(2016, 2, 26), 'Extremes', [
+            Posting('Assets:Checking', Decimal('1E-128')),
+            Posting('Assets:Checking', None, '$', Decimal('1E+200')),
+        ]))
+        self.assertEqual(
+            [(p.quantity, p.unit_price) for p in store[0].postings],
+            [(Decimal('1E-128'), None), (None, Decimal('1E+200'))]
+        )
+
 class TestTransaction(TestCase):
     def test_total(self):
         date = datetime(2016, 3, 20)
@@ -367,5 +1826,27 @@ class TestTransaction(TestCase):
         trans = Transaction(date=date, desc=desc, postings=postings)
         self.assertEqual(Decimal('23.45'), trans.total)
 
+    def test_total_cache(self):
+        trans = Transaction(postings=[Posting('account 1', Decimal('1.25'))])
+        self.assertEqual(trans.total, Decimal('1.25'))
+        self.assertEqual(trans.total_units(2), 125)
+        self.assertEqual(trans.total_units(4), 12500)
+        self.assertIsNone(trans.total_units(1))
+
+        trans.add_posting(Posting('account 2', Decimal('0.5')))
+        self.assertEqual(trans.total, Decimal('1.75'))
+        trans.postings.append(Posting('account 3', Decimal('0.25')))
+        self.assertEqual(trans.total_units(2), 200)
+        trans.postings = []
+        self.assertEqual(trans.total, 0)
+        self.assertEqual(trans.total_units(2), 0)
+
+        posting = Posting('account 1', Decimal('1'))
+        trans.postings = [posting]
+        self.assertEqual(trans.total, 1)
+        posting.quantity = Decimal('2')
+        trans.invalidate_total()
+        self.assertEqual(trans.total, 2)
+
 if __name__ == '__main__':
     unittest_main()
@@ -0,0 +1,170 @@
+from array import array
+from datetime import datetime
+from decimal import Decimal
+
+from import_model import Posting, Transaction
+
+# exponents are stored as signed shorts, coefficients as signed 64 bit
+# ints; the lowest exponent marks a missing quantity or unit price
+NO_AMOUNT = -2**15
+MAX_EXPONENT = 2**15 - 1
+MAX_COEFFICIENT = 2**63 - 1
+
+def encode_amount(value):
+    "Splits a Decimal into an integer coefficient and exponent"
+    if value is None:
+        return 0, NO_AMOUNT
+    if not isinstance(value, Decimal):
+        value = Decimal(value)
+    if not value.is_finite():
+        raise Exception('{} cannot be stored'.format(value))
+    exponent = value.as_tuple().exponent
+    coefficient = int(value.scaleb(-exponent))
+    if not NO_AMOUNT < exponent <= MAX_EXPONENT or abs(coefficient) > MAX_COEFFICIENT:
+        raise Exception('{} is out of range for a TransactionStore'.format(value))
+    return coefficient, exponent
+
+def decode_amount(coefficient, exponent):
+    if exponent == NO_AMOUNT:
+        return None
+    return Decimal(coefficient).scaleb(exponent)
+
+class NameTable(object):
+    "Assigns small integer ids to repeated strings"
+    __slots__ = ('names', 'ids')
+
+    def __init__(self):
+        self.names = []
+        self.ids = {}
+
+    def id(self, name):
+        i = self.ids.get(name)
+        if i is None:
+            i = self.ids[name] = len(self.names)
+            self.names.append(name)
+        return i
+
+class TransactionView(object):
+    "Read-only access to one transaction in a TransactionStore"
+    __slots__ = ('store', 'index')
+
+    def __init__(self, store, index):
+        self.store = store
+        self.index = index
+
+    @property
+    def date(self):
+        return datetime.fromordinal(self.store.dates[self.index])
+
+    @property
+    def desc(self):
+        return self.store.descs.names[self.store.desc_ids[self.index]]
+
+    @property
+    def total(self):
+        return decode_amount(
+            self.store.total_coefficients[self.index],
+            self.store.total_exponents[self.index]
+        )
+
+    @property
+    def accounts(self):
+        store = self.store
+        names = store.accounts.names
+        return tuple(
+            names[store.account_ids[i]]
+            for i in range(store.posting_starts[self.index], store.posting_starts[self.index+1])
+        )
+
+    @property
+    def postings(self):
+        return self.store.postings(self.index)
+
+    def to_transaction(self):
+        return Transaction(self.date, self.desc, self.postings)
+
+    def __str__(self):
+        return str(self.to_transaction())
+
+class TransactionStore(object):
+    """
+    Transactions kept column by column in typed arrays, with account,
+    commodity and description strings stored once in name tables.  Amounts
+    are kept as integer coefficient/exponent pairs so they decode to the
+    same Decimal that was stored.
+    """
+
+    def __init__(self):
+        self.accounts = NameTable()
+        self.commodities = NameTable()
+        self.descs = NameTable()
+
+        # one entry per transaction
+        self.dates = array('i')
+        self.desc_ids = array('i')
+        self.total_coefficients = array('q')
+        self.total_exponents = array('h')
+        # postings of transaction i are posting_starts[i]:posting_starts[i+1]
+        self.posting_starts = array('i', [0])
+
+        # one entry per posting
+        self.account_ids = array('i')
+        self.commodity_ids = array('i')
+        self.quantity_coefficients = array('q')
+        self.quantity_exponents = array('h')
+        self.price_coefficients = array('q')
+        self.price_exponents = array('h')
+
+    @classmethod
+    def from_transactions(cls, transactions):
+        store = cls()
+        for trans in transactions:
+            store.append(trans)
+        return store
+
+    def append(self, trans):
+        # encoded up front so an amount that does not fit changes nothing
+        total = encode_amount(trans.total)
+        amounts = [
+            (encode_amount(posting.quantity), encode_amount(posting.unit_price))
+            for posting in trans.postings
+        ]
+
+        self.dates.append(trans.date.toordinal())
+        self.desc_ids.append(self.descs.id(trans.desc))
+        self.total_coefficients.append(total[0])
+        self.total_exponents.append(total[1])
+
+        for posting, (quantity, price) in zip(trans.postings, amounts):
+            self.account_ids.append(self.accounts.id(posting.account))
+            self.commodity_ids.append(self.commodities.id(posting.commodity))
+            self.quantity_coefficients.append(quantity[0])
+            self.quantity_exponents.append(quantity[1])
+            self.price_coefficients.append(price[0])
+            self.price_exponents.append(price[1])
+        self.posting_starts.append(len(self.account_ids))
+
+    def postings(self, index):
+        "Builds Posting objects for the transaction at index"
+        return [
+            Posting(
+                self.accounts.names[self.account_ids[i]],
+                decode_amount(self.quantity_coefficients[i], self.quantity_exponents[i]),
+                self.commodities.names[self.commodity_ids[i]],
+                decode_amount(self.price_coefficients[i], self.price_exponents[i]),
+            )
+            for i in range(self.posting_starts[index], self.posting_starts[index+1])
+        ]
+
+    def __len__(self):
+        return len(self.dates)
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        return TransactionView(self, index)
+
+    def __iter__(self):
+        return (TransactionView(self, i) for i in range(len(self)))
@@ -10,6 +10,10 @@ import Explorer from './Explorer';
 
 import { balanceTransactions, convertTransactions } from '../lib/analyze';
 import { ledger } from '../lib/parse';
+import { bundle } from '../lib/bundle';
+
+// bundles written by py/export.py are JSON
+const isBundle = fileName => R.test(/\.json$/, fileName || '');
 
 class MainTabs extends React.Component {
   constructor(props) {
@@ -20,7 +24,10 @@ class MainTabs extends React.Component {
 
   loadFromStorage() {
     if (localStorage.ledgerData) {
-      const ledgerData = ledger(localStorage.ledgerData);
+      const fromBundle = isBundle(localStorage.ledgerFileName);
+      const ledgerData = fromBundle
+        ? bundle(JSON.parse(localStorage.ledgerData))
+        : ledger(localStorage.ledgerData);
       const transactions = R.compose(
         convertTransactions('$', ledgerData['commodityPrices']),
         balanceTransactions
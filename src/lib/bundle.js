@@ -0,0 +1,51 @@
+const R = require('ramda');
+import { parseDecimal } from './util';
+
+// days since 1970/01/01 -> local midnight, like new Date('2014/02/14')
+export const fromDays = days => {
+  const utc = new Date(days * 86400000);
+  return new Date(utc.getUTCFullYear(), utc.getUTCMonth(), utc.getUTCDate());
+};
+
+// a null quantity is an elided amount, {} as in parse.js
+const amount = (bundle, i) => {
+  const p = bundle.postings;
+  if (p.quantity[i] === null) {
+    return {};
+  }
+  const base = {
+    quantity: parseDecimal(p.quantity[i]),
+    commodity: bundle.commodities[p.commodity[i]]
+  };
+  return p.unit_price[i] === null
+    ? base
+    : R.assoc('unitPrice', {commodity: '$', quantity: parseDecimal(p.unit_price[i])}, base);
+};
+
+const posting = bundle => i => ({
+  account: bundle.accounts[bundle.postings.account[i]],
+  amount: amount(bundle, i)
+});
+
+const transaction = bundle => (days, t) => ({
+  date: fromDays(days),
+  desc: bundle.descs[bundle.transactions.desc[t]],
+  postings: R.map(
+    posting(bundle),
+    R.range(bundle.transactions.start[t], bundle.transactions.start[t+1])
+  )
+});
+
+// latest price of each commodity, as commodityPrices in parse.js
+const latestPrice = series => ({
+  date: fromDays(R.last(series.date)),
+  unit: '$',
+  price: parseDecimal(R.last(series.price))
+});
+
+/* JSON bundle written by py/export.py -> the same shape as ledger() in
+ * parse.js, postings still to be balanced with balanceTransactions */
+export const bundle = data => ({
+  transactions: data.transactions.date.map(transaction(data)),
+  commodityPrices: R.map(latestPrice, data.prices)
+});
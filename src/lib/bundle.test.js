@@ -0,0 +1,70 @@
+import { balanceTransactions } from './analyze';
+import { bundle, fromDays } from './bundle';
+import { ledger } from './parse';
+import { parseDecimal } from './util';
+const fs = require('fs');
+const path = require('path');
+
+// priced.json is py/export.py's bundle of priced.dat; py/test_ledger_import.py
+// checks that it still is
+const priced = require('./fixtures/priced.json');
+const pricedText = fs.readFileSync(path.join(__dirname, 'fixtures', 'priced.dat'), 'utf8');
+
+const bundleInput = {
+  version: 1,
+  accounts: ['Assets:Vanguard', 'Assets:Checking'],
+  commodities: ['VFIAX', '$'],
+  descs: ['Buy VFIAX'],
+  months: ['2016/02'],
+  transactions: {date: [16832], desc: [0], start: [0, 2]},
+  postings: {
+    account: [0, 1],
+    commodity: [0, 1],
+    quantity: ['1.5', null],
+    unit_price: ['200', null]
+  },
+  prices: {VFIAX: {date: [16801, 16832], price: ['180', '200']}},
+  monthly: {month: [0, 0], account: [0, 1], commodity: [0, 1], total: ['1.5', '-300.0']}
+};
+
+describe('fromDays', function () {
+  it('should give local midnight', function () {
+    expect(fromDays(16832)).toEqual(new Date('2016/02/01'));
+  });
+});
+
+describe('bundle', function () {
+  it('should build transactions', function () {
+    const transactions = bundle(bundleInput).transactions;
+    expect(transactions.length).toEqual(1);
+    expect(transactions[0].date).toEqual(new Date('2016/02/01'));
+    expect(transactions[0].desc).toEqual('Buy VFIAX');
+    expect(transactions[0].postings).toEqual([
+      {
+        account: 'Assets:Vanguard',
+        amount: {
+          quantity: parseDecimal('1.5'),
+          commodity: 'VFIAX',
+          unitPrice: {commodity: '$', quantity: parseDecimal('200')}
+        }
+      },
+      {
+        account: 'Assets:Checking',
+        amount: {}
+      }
+    ]);
+  });
+
+  it('should give the same transactions as the ledger text', function () {
+    expect(bundle(priced).transactions).toEqual(ledger(pricedText).transactions);
+    expect(balanceTransactions(bundle(priced).transactions)).toEqual(
+      balanceTransactions(ledger(pricedText).transactions)
+    );
+  });
+
+  it('should keep the latest prices', function () {
+    expect(bundle(bundleInput).commodityPrices).toEqual({
+      VFIAX: {date: new Date('2016/02/01'), unit: '$', price: parseDecimal('200')}
+    });
+  });
+});